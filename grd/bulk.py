@@ -0,0 +1,464 @@
+"""
+Bulk ingestion of events.
+
+The regular API endpoints process one event per request, resolving
+each device with its own queries. These classes process batches of
+events resolving the devices set-wise and inserting the rows with
+bulk_create in a single transaction.
+
+"""
+from urllib import parse
+
+from django.core.exceptions import ValidationError
+from django.core.urlresolvers import Resolver404, resolve
+from django.core.validators import URLValidator
+from django.db import connection, transaction
+from django.db.models import Q
+
+from .geo import get_point
+from .models import Agent, AgentUser, Device, Event, Location
+from .serializers import (
+    AddSerializer, AllocateSerializer, DeallocateSerializer,
+    EventWritableSerializer, MigrateSerializer, ReceiveSerializer,
+    RegisterSerializer, RemoveSerializer
+)
+from .state import Projector
+
+
+def reserve_pks(model, count):
+    """
+    Reserve `count` primary keys of the model from its sequence, so
+    they are known before inserting the rows with bulk_create.
+    
+    """
+    if count == 0:
+        return []
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT nextval(pg_get_serial_sequence(%s, %s)) "
+            "FROM generate_series(1, %s)",
+            [model._meta.db_table, model._meta.pk.column, count]
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+
+class BulkRegister(object):
+    """
+    Register a batch of devices with their components.
+    
+    Each item is validated with RegisterSerializer; invalid items are
+    reported on `errors` (same position as the item) and skipped.
+    
+    """
+    batch_size = 1000
+    
+    def __init__(self, agent, context=None):
+        self.agent = agent
+        self.context = context or {}
+    
+    def save(self, items):
+        """Return a list with the created event (or None) per item."""
+        self.validate(items)
+        
+        with transaction.atomic():
+            self.resolve_devices()
+            return self.create_events()
+    
+    def validate(self, items):
+        self.data = []
+        self.errors = []
+        for item in items:
+            serializer = RegisterSerializer(data=item, context=self.context)
+            if serializer.is_valid():
+                self.data.append(serializer.validated_data)
+                self.errors.append(None)
+            else:
+                self.data.append(None)
+                self.errors.append(serializer.errors)
+    
+    def resolve_devices(self):
+        """
+        Find the devices of every item (and its components) with a
+        single query and create the missing ones.
+        
+        Devices are identified by their hid or, if they don't have
+        one, by their sameAs.
+        
+        """
+        specs = [spec for data in self.data if data is not None
+                 for spec in [data['device']] + list(data['components'])]
+        hids = set(spec['hid'] for spec in specs if spec['hid'] is not None)
+        urls = set(spec['sameAs'] for spec in specs)
+        
+        existing = Device.objects.filter(Q(hid__in=hids) | Q(sameAs__in=urls))
+        self.hid_pks = {}
+        self.url_pks = {}
+        for pk, hid, url in existing.values_list('pk', 'hid', 'sameAs'):
+            if hid is not None:
+                self.hid_pks[hid] = pk
+            self.url_pks[url] = pk
+        
+        self.new_devices = {}  # key --> Device
+        self.new_urls = set()
+        self.device_keys = []  # keys of the device and components per item
+        for i, data in enumerate(self.data):
+            if data is None:
+                self.device_keys.append(None)
+                continue
+            
+            new_devices = {}
+            try:
+                keys = [self.get_device_key(spec, new_devices)
+                        for spec in [data['device']] + list(data['components'])]
+            except ValueError as e:
+                self.data[i] = None
+                self.errors[i] = {'non_field_errors': [str(e)]}
+                self.device_keys.append(None)
+            else:
+                self.new_devices.update(new_devices)
+                self.new_urls.update(d.sameAs for d in new_devices.values())
+                self.device_keys.append(keys)
+        
+        devices = list(self.new_devices.values())
+        for device, pk in zip(devices, reserve_pks(Device, len(devices))):
+            device.pk = pk
+        Device.objects.bulk_create(devices, batch_size=self.batch_size)
+    
+    def get_device_key(self, spec, new_devices):
+        """Return the pk of an existing device or the key of a new one."""
+        hid, url = spec['hid'], spec['sameAs']
+        if hid is not None:
+            if hid in self.hid_pks:
+                return self.hid_pks[hid]
+            key = ('hid', hid)
+        else:
+            if url in self.url_pks:
+                return self.url_pks[url]
+            key = ('sameAs', url)
+        
+        if key in self.new_devices or key in new_devices:
+            return key
+        
+        item_urls = [device.sameAs for device in new_devices.values()]
+        if url in self.url_pks or url in self.new_urls or url in item_urls:
+            raise ValueError("Device '%s' is already registered with a "
+                             "different hardware identifier." % url)
+        
+        new_devices[key] = Device(hid=hid, sameAs=url, type=spec['type'])
+        return key
+    
+    def get_device_pk(self, key):
+        if isinstance(key, tuple):
+            return self.new_devices[key].pk
+        return key
+    
+    def create_events(self):
+        items = []  # (data, device pk, component pks) of valid items
+        for data, keys in zip(self.data, self.device_keys):
+            if data is not None:
+                pks = [self.get_device_pk(key) for key in keys]
+                components = [pk for i, pk in enumerate(pks[1:])
+                              if pk not in pks[1:i + 1]]
+                items.append((data, pks[0], components))
+        
+        device_pks = set()
+        for _, device_pk, components in items:
+            device_pks.add(device_pk)
+            device_pks.update(components)
+        new_pks = set(device.pk for device in self.new_devices.values())
+        projector = Projector()
+        projector.load(device_pks, new_ids=new_pks)
+        projector.load_component_changes(set(pk for _, pk, _ in items))
+        
+        events = []
+        for (data, device_pk, _), pk in zip(items, reserve_pks(Event, len(items))):
+            events.append(Event(pk=pk, type=Event.REGISTER, agent=self.agent,
+                                device_id=device_pk,
+                                date=data.get('date', None),
+                                dhDate=data['dhDate'],
+                                byUser=data['byUser'],
+                                geo=get_point(data.get('location', None))))
+        Event.objects.bulk_create(events, batch_size=self.batch_size)
+        
+        Through = Event.components.through
+        relations = set((event.pk, component_pk)
+                        for event, (_, _, components) in zip(events, items)
+                        for component_pk in components)
+        Through.objects.bulk_create(
+            [Through(event_id=event_pk, device_id=device_pk)
+             for event_pk, device_pk in relations],
+            batch_size=self.batch_size
+        )
+        
+        Location.objects.bulk_create(
+            [Location(event_id=event.pk, **data['location'])
+             for event, (data, _, _) in zip(events, items)
+             if data.get('location', None) is not None],
+            batch_size=self.batch_size
+        )
+        
+        for event, (_, _, components) in zip(events, items):
+            projector.apply(event, components)
+        projector.save()
+        
+        created = iter(events)
+        return [next(created) if data is not None else None
+                for data in self.data]
+
+
+class BulkEvents(object):
+    """
+    Ingest an ordered batch of events of several types and devices.
+    
+    Each item defines its '@type' and the 'device' (pk, hid or sameAs)
+    and is validated with the serializer of its type (the same that
+    the device endpoint uses) against the state of the devices after
+    the previous items, which is computed in memory instead of
+    querying it for every event.
+    
+    """
+    batch_size = 1000
+    
+    def __init__(self, agent, context=None):
+        self.agent = agent
+        self.context = context or {}
+    
+    # Register events are processed by BulkRegister
+    SERIALIZERS = {
+        Event.ADD: AddSerializer,
+        Event.ALLOCATE: AllocateSerializer,
+        Event.DEALLOCATE: DeallocateSerializer,
+        Event.MIGRATE: MigrateSerializer,
+        Event.RECEIVE: ReceiveSerializer,
+        Event.RECYCLE: EventWritableSerializer,
+        Event.REMOVE: RemoveSerializer,
+        Event.STOPUSAGE: EventWritableSerializer,
+        Event.USAGEPROOF: EventWritableSerializer,
+    }
+    
+    def save(self, items):
+        """Return a list with the created event (or None) per item."""
+        self.errors = [None] * len(items)
+        
+        with transaction.atomic():
+            self.resolve_devices(items)
+            self.resolve_owners(items)
+            self.resolve_agents(items)
+            # the pks are assigned before inserting the events because
+            # the state references them (e.g. Ownership.event)
+            self.pks = iter(reserve_pks(Event, len(items)))
+            self.projector = Projector()
+            self.projector.load(self.devices.keys())
+            self.load_related()
+            for device in self.devices.values():
+                self.bind(device)
+            
+            events = [self.validate(i, item) for i, item in enumerate(items)]
+            self.create_events([event for event in events if event is not None])
+            self.projector.save()
+        
+        for device in self.devices.values():
+            self.unbind(device)
+        return events
+    
+    @staticmethod
+    def get_device_lookup(value):
+        if isinstance(value, int):
+            return 'pk', value
+        if not isinstance(value, str):
+            return None, value
+        if value.isdigit():
+            return 'pk', int(value)
+        try:
+            URLValidator(schemes=['http', 'https'])(value)
+        except ValidationError:
+            return 'hid', value
+        return 'sameAs', value
+    
+    def resolve_devices(self, items):
+        """Get the devices and components of all the items at once."""
+        lookups = {'pk': set(), 'hid': set(), 'sameAs': set()}
+        for item in items:
+            if not isinstance(item, dict):
+                continue
+            field, value = self.get_device_lookup(item.get('device', None))
+            if field is not None:
+                lookups[field].add(value)
+            components = item.get('components', [])
+            if isinstance(components, list):
+                lookups['hid'].update(c for c in components
+                                      if isinstance(c, str))
+        
+        devices = Device.objects.filter(
+            Q(pk__in=lookups['pk']) | Q(hid__in=lookups['hid']) |
+            Q(sameAs__in=lookups['sameAs'])
+        )
+        self.devices = dict((device.pk, device) for device in devices)
+        self.device_lookups = {}
+        for device in self.devices.values():
+            self.device_lookups[('pk', device.pk)] = device
+            self.device_lookups[('hid', device.hid)] = device
+            self.device_lookups[('sameAs', device.sameAs)] = device
+        self.devices_by_hid = dict((device.hid, device) for device in
+                                   self.devices.values() if device.hid)
+    
+    @staticmethod
+    def is_owner_url(value):
+        max_length = AgentUser._meta.get_field('url').max_length
+        if not isinstance(value, str) or len(value) > max_length:
+            return False
+        try:
+            URLValidator()(value)
+        except ValidationError:
+            return False
+        return True
+    
+    def resolve_owners(self, items):
+        """
+        Get the owners allocated and deallocated by the items at once,
+        creating the ones of the allocations which don't exist yet (as
+        AllocateSerializer does).
+        
+        """
+        allocated, deallocated = set(), set()
+        for item in items:
+            if not isinstance(item, dict):
+                continue
+            if item.get('@type', None) == Event.ALLOCATE:
+                allocated.add(item.get('to', None))
+            elif item.get('@type', None) == Event.DEALLOCATE:
+                deallocated.add(item.get('from', None))
+        urls = set(url for url in allocated | deallocated
+                   if self.is_owner_url(url))
+        
+        owners = AgentUser.objects.filter(url__in=urls)
+        self.owners_by_url = dict((owner.url, owner) for owner in owners)
+        missing = [url for url in allocated & urls
+                   if url not in self.owners_by_url]
+        if missing:
+            AgentUser.objects.bulk_create([AgentUser(url=url)
+                                           for url in missing])
+            owners = AgentUser.objects.filter(url__in=missing)
+            self.owners_by_url.update((owner.url, owner) for owner in owners)
+    
+    @staticmethod
+    def get_agent_pk(value):
+        """Return the pk of the agent linked by the hyperlink or None."""
+        if not isinstance(value, str):
+            return None
+        try:
+            match = resolve(parse.urlparse(value).path)
+        except Resolver404:
+            return None
+        pk = str(match.kwargs.get('pk', ''))
+        if match.url_name != 'agent-detail' or not pk.isdigit():
+            return None
+        return int(pk)
+    
+    def resolve_agents(self, items):
+        """Get the agents which the devices are migrated to at once."""
+        pks = {}
+        for item in items:
+            if isinstance(item, dict) and \
+                    item.get('@type', None) == Event.MIGRATE:
+                pk = self.get_agent_pk(item.get('to', None))
+                if pk is not None:
+                    pks[item['to']] = pk
+        agents = Agent.objects.in_bulk(set(pks.values()))
+        self.agents_by_url = dict((url, agents[pk])
+                                  for url, pk in pks.items() if pk in agents)
+    
+    def load_related(self):
+        """Load the devices and owners referenced by the state."""
+        folds = self.projector.folds.values()
+        pks = set()
+        owner_pks = set()
+        for fold in folds:
+            pks.update(fold.component_ids)
+            if fold.parent_id is not None:
+                pks.add(fold.parent_id)
+            owner_pks.update(fold.owner_ids)
+        
+        pks -= set(self.devices)
+        self.related = dict((d.pk, d) for d in Device.objects.filter(pk__in=pks))
+        self.related.update(self.devices)
+        self.owner_urls = dict(
+            AgentUser.objects.filter(pk__in=owner_pks).values_list('pk', 'url')
+        )
+    
+    def bind(self, device):
+        """Make the device's properties return its in-memory state."""
+        fold = self.projector.folds[device.pk]
+        device._replayed_components = [self.related[pk]
+                                       for pk in fold.component_ids]
+        device._replayed_owners = [self.owner_urls[pk]
+                                   for pk in fold.owner_ids]
+        if fold.parent_id is None:
+            device._replayed_parent = None
+        else:
+            device._replayed_parent = self.related[fold.parent_id]
+    
+    @staticmethod
+    def unbind(device):
+        for attr in ['_replayed_components', '_replayed_owners',
+                     '_replayed_parent']:
+            delattr(device, attr)
+    
+    def validate(self, index, item):
+        """Validate the item and apply it to the in-memory state."""
+        if not isinstance(item, dict):
+            self.errors[index] = {'non_field_errors': ['Invalid data.']}
+            return None
+        
+        item = dict(item)
+        type = item.pop('@type', None)
+        serializer_class = self.SERIALIZERS.get(type, None)
+        if serializer_class is None:
+            self.errors[index] = {'@type': ["Invalid event type '%s'." % type]}
+            return None
+        
+        lookup = self.get_device_lookup(item.pop('device', None))
+        device = self.device_lookups.get(lookup, None)
+        if device is None:
+            self.errors[index] = {'device': ['Device not found.']}
+            return None
+        
+        context = dict(self.context, device=device,
+                       devices_by_hid=self.devices_by_hid,
+                       owners_by_url=self.owners_by_url,
+                       agents_by_url=self.agents_by_url)
+        serializer = serializer_class(data=item, context=context)
+        if not serializer.is_valid():
+            self.errors[index] = serializer.errors
+            return None
+        
+        data = dict(serializer.validated_data)
+        components = data.pop('components', [])
+        location = data.pop('location', None)
+        
+        event = Event(pk=next(self.pks), type=type, agent=self.agent,
+                      device=device, geo=get_point(location), **data)
+        event._components = components
+        event._location = location
+        if event.owner is not None:
+            self.owner_urls[event.owner.pk] = event.owner.url
+        
+        self.projector.apply(event, [c.pk for c in components])
+        for pk in [device.pk] + [c.pk for c in components]:
+            self.bind(self.devices[pk])
+        return event
+    
+    def create_events(self, events):
+        Event.objects.bulk_create(events, batch_size=self.batch_size)
+        
+        Through = Event.components.through
+        Through.objects.bulk_create(
+            [Through(event_id=event.pk, device_id=component.pk)
+             for event in events for component in set(event._components)],
+            batch_size=self.batch_size
+        )
+        Location.objects.bulk_create(
+            [Location(event_id=event.pk, **event._location)
+             for event in events if event._location is not None],
+            batch_size=self.batch_size
+        )
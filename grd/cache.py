@@ -0,0 +1,101 @@
+import hashlib
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+
+
+class DevicePayloadCache(object):
+    """
+    Serialized representation of the devices stored on the Django cache
+    backend of the GRD_DEVICE_CACHE alias.
+    
+    The entries are keyed by the version of the projected state of the
+    device, which is increased in the same transaction that stores any
+    event affecting it (see grd.state.Projector), so they don't need
+    to be invalidated and stale entries are never served, whatever the
+    process that stored them is. Devices without projected state are
+    not cached.
+    
+    The entries of previous versions aren't read anymore, they are
+    evicted by the backend: memcached evicts the least recently used
+    entries, but the locmem and filebased backends of Django 1.8 cull
+    a fraction (1 / CULL_FREQUENCY) of arbitrary entries when reaching
+    MAX_ENTRIES (not the least recently used ones) or the entries are
+    expired after TIMEOUT. Size MAX_ENTRIES for the devices being read.
+    
+    """
+    prefix = 'grd:device'
+    
+    def __init__(self, alias):
+        self.alias = alias
+    
+    @property
+    def cache(self):
+        return caches[self.alias]
+    
+    @staticmethod
+    def get_scope(request, format=None):
+        """
+        Identify the variant of the representation: the hyperlinks
+        depend on the host and the format of the request.
+        
+        """
+        base = '%s %s' % (request.build_absolute_uri('/'), format)
+        return hashlib.md5(base.encode('utf-8')).hexdigest()
+    
+    def get_key(self, device, scope):
+        return '%s:%s:%d:%d' % (self.prefix, scope, device.pk,
+                                device.state.version)
+    
+    @staticmethod
+    def get_fields(device):
+        # the attributes of the device can be updated without events
+        return (device.hid, device.sameAs, device.type)
+    
+    def get_many(self, devices, scope):
+        """Return the cached payloads of the devices {pk: payload}."""
+        keys = dict((self.get_key(device, scope), device)
+                    for device in devices if device.current_state is not None)
+        payloads = {}
+        for key, (fields, payload) in self.cache.get_many(list(keys)).items():
+            device = keys[key]
+            if fields == self.get_fields(device):
+                payloads[device.pk] = payload
+        self.incr('hits', len(payloads))
+        self.incr('misses', len(devices) - len(payloads))
+        return payloads
+    
+    def set_many(self, devices, payloads, scope):
+        """Store the payloads of the devices {pk: payload}."""
+        self.cache.set_many(dict(
+            (self.get_key(device, scope),
+             (self.get_fields(device), payloads[device.pk]))
+            for device in devices if device.current_state is not None
+        ))
+    
+    def incr(self, name, delta=1):
+        if delta <= 0:
+            return
+        key = '%s:%s' % (self.prefix, name)
+        try:
+            self.cache.incr(key, delta)
+        except ValueError:  # the counter doesn't exist yet
+            if not self.cache.add(key, delta, timeout=None):
+                self.cache.incr(key, delta)
+    
+    def get_stats(self):
+        # NOTE the counters are stored on the backend: they are per
+        # process with locmem (as the entries) and can be culled too
+        keys = ['%s:%s' % (self.prefix, name) for name in ['hits', 'misses']]
+        values = self.cache.get_many(keys)
+        return OrderedDict((key.rsplit(':', 1)[1], values.get(key, 0))
+                           for key in keys)
+    
+    def reset_stats(self):
+        self.cache.delete_many(['%s:hits' % self.prefix,
+                                '%s:misses' % self.prefix])
+
+
+device_payloads = DevicePayloadCache(getattr(settings, 'GRD_DEVICE_CACHE',
+                                             'default'))
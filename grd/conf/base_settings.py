@@ -15,6 +15,27 @@ DATABASES = {
     }
 }
 
+# Cache
+# https://docs.djangoproject.com/en/1.8/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # Serialized devices (see grd.cache), about 1 KB each. NOTE locmem
+    # caches are per process: use a shared backend (e.g. memcached,
+    # which evicts the least recently used entries) in production.
+    'grd-devices': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'grd-devices',
+        'TIMEOUT': 24 * 3600,
+        'OPTIONS': {
+            'MAX_ENTRIES': 100000,
+            'CULL_FREQUENCY': 10,
+        },
+    },
+}
+
 # Application definition
 
 INSTALLED_APPS = (
@@ -117,3 +138,10 @@ REST_FRAMEWORK = {
     'PAGE_SIZE': 100,
     'TEST_REQUEST_DEFAULT_FORMAT': 'json',
 }
+
+
+#########################
+#          GRD          #
+#########################
+# Cache of the serialized devices (an alias of CACHES)
+GRD_DEVICE_CACHE = 'grd-devices'
@@ -0,0 +1,88 @@
+"""
+Export of the event log as newline delimited JSON (one event per line).
+
+Exporting the whole log paging through the API is slow: each page
+builds model instances and reverses the hyperlinks of every event.
+EventExporter produces the same representation as EventSerializer
+(see grd.fastpath) fetching the events as plain values, in chunks
+ordered by their (logDate, id) position, so the memory usage is
+constant whatever the size of the log is and an interrupted export
+can be resumed.
+
+The events are streamed in the order they were stored in this log
+(logDate) instead of the order they were registered (grdDate): the
+events imported from another GRD keep their grdDate, which would place
+them behind the position of the consumers of the feed.
+
+"""
+import json
+from datetime import timedelta
+
+from django.conf import settings
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+
+from .fastpath import FastEventSerializer
+from .models import Event
+from .pagination import encode_cursor, get_position, iterate_chunks_after
+
+
+# Events are only streamed (feed and export) once every transaction that
+# could write events with a previous logDate has been committed (see
+# EventManager.committed_until). The lag covers the difference between
+# the clocks of the application and database servers.
+FEED_LAG = timedelta(seconds=getattr(settings, 'GRD_FEED_LAG', 5))
+
+# Position of the events in the feed and the export
+FEED_ORDERING = ('logDate', 'id')
+
+
+def filter_committed(queryset):
+    """Events stored before the ones that may not be committed yet."""
+    return queryset.filter(
+        logDate__lt=Event.objects.committed_until() - FEED_LAG
+    )
+
+
+class NDJSONRenderer(BaseRenderer):
+    media_type = 'application/x-ndjson'
+    format = 'ndjson'
+    charset = 'utf-8'
+    
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        # NOTE the events are streamed: only errors are rendered
+        return (json.dumps(data) + '\n').encode(self.charset)
+
+
+class EventExporter(object):
+    """Iterate over the events serialized with FastEventSerializer."""
+    
+    ordering = FEED_ORDERING
+    
+    def __init__(self, request=None, base_url='', chunk_size=1000):
+        self.chunk_size = chunk_size
+        self.serializer = FastEventSerializer(request=request,
+                                              base_url=base_url)
+        self.renderer = JSONRenderer()
+        self.position = None  # of the latest exported event
+    
+    @property
+    def cursor(self):
+        """Token to resume the export after the latest exported event."""
+        if self.position is None:
+            return None
+        return encode_cursor(self.position)
+    
+    def iterate(self, queryset, position=None):
+        """Yield the events of the queryset placed after `position`."""
+        chunks = iterate_chunks_after(self.serializer.get_rows(queryset),
+                                      self.ordering, position,
+                                      self.chunk_size)
+        for chunk in chunks:
+            for row, data in zip(chunk, self.serializer.serialize(chunk)):
+                self.position = get_position(row, self.ordering)
+                yield data
+    
+    def lines(self, queryset, position=None):
+        # NOTE rendered like the API responses
+        for data in self.iterate(queryset, position):
+            yield self.renderer.render(data).decode('utf-8') + '\n'
@@ -0,0 +1,126 @@
+"""
+Read-only serialization of events and devices for the list and export
+endpoints.
+
+EventSerializer and DeviceSerializer reverse every hyperlink (url,
+device, agent, to and each component) and build an absolute URI from
+it. These serializers produce the same representation (the rendered
+JSON is byte-identical) formatting URL templates that are reversed
+once per request, and the events are serialized from .values() rows.
+
+"""
+from collections import OrderedDict, defaultdict
+
+from rest_framework.reverse import reverse
+
+from .models import Event
+
+
+def format_datetime(value):
+    """ISO 8601 representation of the dates (as DRF renders them)."""
+    if value is None:
+        return None
+    value = value.isoformat()
+    if value.endswith('+00:00'):
+        value = value[:-6] + 'Z'
+    return value
+
+
+def get_url_template(view_name, request=None, format=None, base_url=''):
+    """
+    Return the URL of the detail view with a placeholder for the pk,
+    e.g. 'http://example.org/api/devices/%d/'.
+    
+    """
+    url = reverse(view_name, kwargs={'pk': 0}, request=request,
+                  format=format)
+    head, tail = url.rsplit('/0', 1)
+    return (base_url + head).replace('%', '%%') + '/%d' + tail
+
+
+class URLTemplates(object):
+    def __init__(self, request=None, format=None, base_url=''):
+        self.templates = dict(
+            (name, get_url_template('%s-detail' % name, request, format,
+                                    base_url))
+            for name in ['agent', 'device', 'event']
+        )
+    
+    def get_url(self, name, pk):
+        return self.templates[name] % pk if pk is not None else None
+
+
+class FastEventSerializer(object):
+    """Equivalent of EventSerializer working from .values() rows."""
+    
+    fields = ('id', 'dhDate', 'grdDate', 'logDate', 'type', 'device_id',
+              'agent_id', 'to_agent_id', 'owner__url', 'location__lat',
+              'location__lon')
+    
+    def __init__(self, request=None, format=None, base_url=''):
+        self.urls = URLTemplates(request, format, base_url)
+    
+    def get_rows(self, queryset):
+        return queryset.values(*self.fields)
+    
+    @staticmethod
+    def get_components(event_ids):
+        """Return the components of the events {event_id: [device_id]}."""
+        components = defaultdict(list)
+        through = Event.components.through.objects.filter(
+            event_id__in=event_ids).order_by('pk')
+        for event_id, device_id in through.values_list('event_id',
+                                                       'device_id'):
+            components[event_id].append(device_id)
+        return components
+    
+    def serialize(self, rows):
+        """Serialize the rows fetching their components at once."""
+        components = self.get_components([row['id'] for row in rows])
+        return [self.to_representation(row, components[row['id']])
+                for row in rows]
+    
+    def to_representation(self, row, component_ids):
+        get_url = self.urls.get_url
+        location = None
+        if row['location__lat'] is not None:
+            location = OrderedDict([('lat', row['location__lat']),
+                                    ('lon', row['location__lon'])])
+        return OrderedDict([
+            ('url', get_url('event', row['id'])),
+            ('dhDate', format_datetime(row['dhDate'])),
+            ('grdDate', format_datetime(row['grdDate'])),
+            ('device', get_url('device', row['device_id'])),
+            ('agent', get_url('agent', row['agent_id'])),
+            ('components', [get_url('device', pk) for pk in component_ids]),
+            ('to', get_url('agent', row['to_agent_id'])),
+            ('location', location),
+            ('owner', row['owner__url']),
+            ('@type', row['type']),
+        ])
+
+
+class FastDeviceSerializer(object):
+    """
+    Equivalent of DeviceSerializer. The devices are model instances
+    because their components and owners are provided by their state
+    (see DeviceManager.prefetch_state).
+    
+    """
+    def __init__(self, request=None, format=None, base_url=''):
+        self.urls = URLTemplates(request, format, base_url)
+    
+    def serialize(self, devices):
+        return [self.to_representation(device) for device in devices]
+    
+    def to_representation(self, device):
+        get_url = self.urls.get_url
+        return OrderedDict([
+            ('url', get_url('device', device.pk)),
+            ('hid', device.hid),
+            ('sameAs', device.sameAs),
+            ('components', [get_url('device', component.pk)
+                            for component in device.components]),
+            ('owners', device.owners),
+            ('@type', device.type),
+        ])
@@ -0,0 +1,102 @@
+"""
+Spatial queries over the location of the events.
+
+The location of each event is stored on Event.geo (WGS84) besides the
+Location model, so PostGIS can filter the events using its indexes
+(see migration 0012).
+
+"""
+from django.contrib.gis.geos import GEOSException, GEOSGeometry, Point, Polygon
+from django.db.models import Count
+
+
+SRID = 4326
+
+
+def get_point(location):
+    """Return the point of the location data {'lat': .., 'lon': ..}."""
+    if location is None:
+        return None
+    return Point(location['lon'], location['lat'], srid=SRID)
+
+
+def parse_floats(value, count):
+    """Parse a comma separated list of `count` numbers."""
+    try:
+        values = [float(v) for v in value.split(',')]
+    except ValueError:
+        raise ValueError("Expected %d comma separated numbers." % count)
+    if len(values) != count:
+        raise ValueError("Expected %d comma separated numbers." % count)
+    return values
+
+
+def parse_polygon(value):
+    """Parse a (multi)polygon defined as WKT or GeoJSON."""
+    try:
+        geometry = GEOSGeometry(value, srid=SRID)
+    except (GEOSException, ValueError, TypeError):
+        raise ValueError("Invalid geometry.")
+    if geometry.geom_type not in ['Polygon', 'MultiPolygon']:
+        raise ValueError("Expected a Polygon or a MultiPolygon.")
+    return geometry
+
+
+def filter_within(queryset, lon, lat, radius):
+    """Events located less than `radius` meters away from the point."""
+    # NOTE the cast to geography (computations on meters) matches the
+    # expression index on grd_event.
+    return queryset.extra(
+        where=['ST_DWithin("grd_event"."geo"::geography, '
+               'ST_SetSRID(ST_MakePoint(%s, %s), 4326)::geography, %s)'],
+        params=[lon, lat, radius],
+    )
+
+
+def filter_bbox(queryset, min_lon, min_lat, max_lon, max_lat):
+    """Events located inside the bounding box."""
+    bbox = Polygon.from_bbox((min_lon, min_lat, max_lon, max_lat))
+    bbox.srid = SRID
+    return queryset.filter(geo__intersects=bbox)
+
+
+def filter_located_within(queryset, polygon):
+    """
+    Devices whose latest location (the latest event with location,
+    e.g. a Locate) is inside the polygon.
+    
+    """
+    return queryset.extra(
+        where=['"grd_device"."id" IN ('
+               'SELECT e."device_id" FROM "grd_event" e '
+               'WHERE ST_Intersects(e."geo", ST_GeomFromText(%s, 4326)) '
+               'AND NOT EXISTS ('
+               'SELECT 1 FROM "grd_event" l '
+               'WHERE l."device_id" = e."device_id" '
+               'AND l."geo" IS NOT NULL '
+               'AND (l."grdDate", l."id") > (e."grdDate", e."id")))'],
+        params=[polygon.wkt],
+    )
+
+
+def aggregate_grid(queryset, cell_size, limit=None):
+    """
+    Count the located events of the queryset per cell of a grid of
+    `cell_size` degrees. Return a list of (lon, lat, count) where
+    lon and lat are the center of the cell (at most `limit` cells).
+    
+    """
+    queryset = queryset.filter(geo__isnull=False).order_by()
+    queryset = queryset.extra(
+        select={
+            'cell_x': 'FLOOR(ST_X("grd_event"."geo") / %s)',
+            'cell_y': 'FLOOR(ST_Y("grd_event"."geo") / %s)',
+        },
+        select_params=[cell_size, cell_size],
+    )
+    cells = queryset.values('cell_x', 'cell_y').annotate(count=Count('id'))
+    if limit is not None:
+        cells = cells[:limit]
+    return [((cell['cell_x'] + 0.5) * cell_size,
+             (cell['cell_y'] + 0.5) * cell_size,
+             cell['count']) for cell in cells]
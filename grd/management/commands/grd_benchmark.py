@@ -0,0 +1,229 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test.client import RequestFactory
+from rest_framework.renderers import JSONRenderer
+
+from grd.fastpath import FastDeviceSerializer, FastEventSerializer
+from grd.models import Agent, Device, Event
+from grd.serializers import DeviceSerializer, EventSerializer
+
+
+BENCH_HID_PREFIX = 'BENCH'
+BENCH_URL_PREFIX = 'http://bench.example.org/device/'
+
+
+def timeit(func, repeat):
+    """Return the median and the maximum time (in ms) of calling func."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append((time.perf_counter() - start) * 1000)
+    times.sort()
+    return times[len(times) // 2], times[-1]
+
+
+class Command(BaseCommand):
+    help = ("Benchmark the queries used to compute the state of the "
+            "devices or the serialization of the list endpoints. WARNING: "
+            "it inserts synthetic data on the database, use a scratch "
+            "database.")
+    
+    # Indexes created by migration 0007 {table: columns}
+    INDEXES = [
+        ('grd_event', ['device_id', 'type', 'grdDate']),
+        ('grd_event_components', ['device_id', 'event_id']),
+    ]
+    
+    def add_arguments(self, parser):
+        parser.add_argument('suite', choices=['queries', 'serializers'],
+                            help="Set of benchmarks to run.")
+        parser.add_argument('--seed', type=int, default=0, metavar='EVENTS',
+                            help="Insert EVENTS synthetic events before "
+                                 "running the benchmark (e.g. 10000000).")
+        parser.add_argument('--events-per-device', type=int, default=20)
+        parser.add_argument('--samples', type=int, default=50,
+                            help="Number of devices queried.")
+        parser.add_argument('--compare-indexes', action='store_true',
+                            default=False,
+                            help="Also run the benchmark without the "
+                                 "indexes (they are dropped and rebuilt).")
+        parser.add_argument('--cleanup', action='store_true', default=False,
+                            help="Delete the synthetic data and exit.")
+    
+    def handle(self, *args, **options):
+        if options['cleanup']:
+            self.cleanup()
+            return
+        
+        if options['seed']:
+            self.seed(options['seed'], options['events_per_device'])
+        
+        devices = list(Device.objects.filter(
+            hid__startswith=BENCH_HID_PREFIX).values_list('pk', flat=True))
+        if not devices:
+            raise CommandError("There is no synthetic data, use --seed.")
+        samples = [Device(pk=pk) for pk in
+                   random.sample(devices, min(options['samples'], len(devices)))]
+        
+        getattr(self, 'bench_%s' % options['suite'])(samples, options)
+    
+    def seed(self, events, events_per_device):
+        agent = Agent.objects.first()
+        if agent is None:
+            raise CommandError("Create an agent before seeding data.")
+        
+        devices = max(1, events // events_per_device)
+        self.stdout.write("Inserting %d devices and %d events..." %
+                          (devices, events))
+        types = [t for t, _ in Event.TYPES]
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT COALESCE(MAX("id"), 0) FROM "grd_device"'
+            )
+            base = cursor.fetchone()[0] + 1
+            cursor.execute(
+                'INSERT INTO "grd_device" ("id", "sameAs", "hid", "type") '
+                "SELECT %s + i, %s || i, %s || '-' || i || '-X', 'Computer' "
+                'FROM generate_series(0, %s - 1) i',
+                [base, BENCH_URL_PREFIX, BENCH_HID_PREFIX, devices]
+            )
+            cursor.execute(
+                "SELECT setval(pg_get_serial_sequence('grd_device', 'id'), "
+                '(SELECT MAX("id") FROM "grd_device"))'
+            )
+            cursor.execute(
+                'INSERT INTO "grd_event" ("type", "date", "dhDate", '
+                '"grdDate", "logDate", "secured", "incidence", "byUser", '
+                '"agent_id", "device_id", "data") '
+                'SELECT (%s::varchar[])[1 + (i %% %s)], '
+                "TIMESTAMP '2010-01-01' + i * INTERVAL '1 second', "
+                "TIMESTAMP '2010-01-01' + i * INTERVAL '1 second', "
+                "TIMESTAMP '2010-01-01' + i * INTERVAL '1 second', "
+                "TIMESTAMP '2010-01-01' + i * INTERVAL '1 second', "
+                "TRUE, FALSE, 'http://bench.example.org/user', %s, "
+                "%s + ((i * 7919) %% %s), ''::hstore "
+                'FROM generate_series(0, %s - 1) i',
+                [types, len(types), agent.pk, base, devices, events]
+            )
+            cursor.execute(
+                'INSERT INTO "grd_event_components" ("event_id", "device_id") '
+                'SELECT "id", %s + (("id" * 31) %% %s) FROM "grd_event" '
+                'WHERE "type" IN (%s, %s, %s) AND "device_id" >= %s',
+                [base, devices, Event.REGISTER, Event.ADD, Event.REMOVE, base]
+            )
+            cursor.execute('ANALYZE "grd_device", "grd_event", '
+                           '"grd_event_components"')
+    
+    def cleanup(self):
+        with transaction.atomic(), connection.cursor() as cursor:
+            devices = ('SELECT "id" FROM "grd_device" WHERE "hid" LIKE %s')
+            events = ('SELECT "id" FROM "grd_event" WHERE "device_id" IN (%s)'
+                      % devices)
+            pattern = BENCH_HID_PREFIX + '%'
+            cursor.execute('DELETE FROM "grd_event_components" WHERE '
+                           '"event_id" IN (%s)' % events, [pattern])
+            cursor.execute('DELETE FROM "grd_event" WHERE "id" IN (%s)'
+                           % events, [pattern])
+            cursor.execute('DELETE FROM "grd_device" WHERE "id" IN (%s)'
+                           % devices, [pattern])
+    
+    def get_index(self, table, columns):
+        """Return the name and definition of the index on columns."""
+        with connection.cursor() as cursor:
+            constraints = connection.introspection.get_constraints(cursor,
+                                                                   table)
+            for name, constraint in constraints.items():
+                if constraint['index'] and constraint['columns'] == columns:
+                    cursor.execute('SELECT indexdef FROM pg_indexes '
+                                   'WHERE indexname = %s', [name])
+                    return name, cursor.fetchone()[0]
+        return None, None
+    
+    def bench_queries(self, devices, options):
+        paths = [
+            ('latest register',
+             lambda d: Event.objects.filter(
+                 device=d, type=Event.REGISTER).order_by('-grdDate')[:1]),
+            ('add/remove history',
+             lambda d: Event.objects.filter(
+                 device=d, type__in=[Event.ADD, Event.REMOVE])),
+            ('usage history',
+             lambda d: Event.objects.filter(
+                 device=d, type__in=[Event.USAGEPROOF, Event.STOPUSAGE])),
+            ('latest parent event',
+             lambda d: Event.objects.filter(
+                 components=d,
+                 type__in=[Event.REGISTER, Event.ADD, Event.REMOVE]
+             ).order_by('-grdDate')[:1]),
+            ('related to device',
+             lambda d: Event.objects.related_to_device(d)),
+        ]
+        
+        def run():
+            for name, query in paths:
+                median, worst = timeit(
+                    lambda: [list(query(d)) for d in devices], repeat=5
+                )
+                self.stdout.write("  %-20s median %9.2f ms  max %9.2f ms  "
+                                  "(%d devices)" % (name, median, worst,
+                                                    len(devices)))
+        
+        self.stdout.write("With indexes:")
+        run()
+        
+        if options['compare_indexes']:
+            dropped = []
+            for table, columns in self.INDEXES:
+                name, definition = self.get_index(table, columns)
+                if name is not None:
+                    with connection.cursor() as cursor:
+                        cursor.execute('DROP INDEX "%s"' % name)
+                    dropped.append(definition)
+            try:
+                self.stdout.write("Without indexes:")
+                run()
+            finally:
+                with connection.cursor() as cursor:
+                    for definition in dropped:
+                        cursor.execute(definition)
+    
+    def bench_serializers(self, devices, options):
+        """Compare the DRF serializers with the ones of grd.fastpath."""
+        request = RequestFactory().get('/api/events/')
+        context = {'request': request}
+        renderer = JSONRenderer()
+        events = Event.objects.filter(device__in=devices).order_by(
+            'grdDate', 'id')[:100]
+        
+        def drf_events():
+            queryset = events.select_related('location', 'owner')
+            queryset = queryset.prefetch_related('components')
+            return EventSerializer(queryset, many=True, context=context).data
+        
+        def fast_events():
+            serializer = FastEventSerializer(request=request)
+            return serializer.serialize(list(serializer.get_rows(events)))
+        
+        def drf_devices():
+            page = Device.objects.prefetch_state(
+                list(Device.objects.filter(pk__in=[d.pk for d in devices])))
+            return DeviceSerializer(page, many=True, context=context).data
+        
+        def fast_devices():
+            page = Device.objects.prefetch_state(
+                list(Device.objects.filter(pk__in=[d.pk for d in devices])))
+            return FastDeviceSerializer(request=request).serialize(page)
+        
+        for name, drf, fast in [('events', drf_events, fast_events),
+                                ('devices', drf_devices, fast_devices)]:
+            if renderer.render(drf()) != renderer.render(fast()):
+                raise CommandError("The %s serialized by the fast path "
+                                   "don't match." % name)
+            for path, func in [('drf', drf), ('fast', fast)]:
+                median, worst = timeit(func, repeat=20)
+                self.stdout.write("  %-7s %-4s median %9.2f ms  max %9.2f ms"
+                                  % (name, path, median, worst))
@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+
+from grd.models import DeviceState
+from grd.state import CHECKPOINT_INTERVAL, create_checkpoints
+
+
+class Command(BaseCommand):
+    help = ("Store a checkpoint of the state of the devices which have "
+            "changed since their latest one, so their state at a given "
+            "date (?as_of=) doesn't require replaying their whole history. "
+            "It should be run periodically.")
+    
+    def add_arguments(self, parser):
+        parser.add_argument('devices', nargs='*', type=int,
+                            help="Primary keys of the devices (default all).")
+        parser.add_argument('--interval', type=int,
+                            default=CHECKPOINT_INTERVAL,
+                            help="Minimum number of changes of the state "
+                                 "between two checkpoints.")
+        parser.add_argument('--chunk-size', type=int, default=1000,
+                            help="Number of devices processed at once.")
+    
+    def handle(self, *args, **options):
+        queryset = DeviceState.objects.order_by('pk')
+        if options['devices']:
+            queryset = queryset.filter(pk__in=options['devices'])
+        pks = list(queryset.values_list('pk', flat=True))
+        chunk_size = options['chunk_size']
+        
+        created = 0
+        for start in range(0, len(pks), chunk_size):
+            chunk = pks[start:start + chunk_size]
+            created += create_checkpoints(chunk, options['interval'])
+        self.stdout.write("Created %d checkpoints of %d devices." %
+                          (created, len(pks)))
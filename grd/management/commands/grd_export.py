@@ -0,0 +1,58 @@
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+
+from grd.export import EventExporter, filter_committed
+from grd.models import Event
+from grd.pagination import decode_cursor
+
+
+class Command(BaseCommand):
+    help = ("Export the event log as newline delimited JSON (one event per "
+            "line) in the order they were stored (logDate, id).")
+    
+    def add_arguments(self, parser):
+        parser.add_argument('--output', '-o', default=None,
+                            help="File where the events are written "
+                                 "(default stdout).")
+        parser.add_argument('--since', default=None, metavar='CURSOR',
+                            help="Resume the export after the position "
+                                 "printed by a previous execution.")
+        parser.add_argument('--base-url', default='',
+                            help="Prefix of the hyperlinks, e.g. "
+                                 "https://grd.example.org")
+        parser.add_argument('--chunk-size', type=int, default=1000,
+                            help="Number of events fetched at once.")
+    
+    def handle(self, *args, **options):
+        position = None
+        if options['since']:
+            try:
+                position = decode_cursor(options['since'])
+            except ValueError as e:
+                raise CommandError(str(e))
+        
+        # the events being registered aren't committed yet
+        queryset = filter_committed(Event.objects.all())
+        exporter = EventExporter(base_url=options['base_url'],
+                                 chunk_size=options['chunk_size'])
+        
+        # NOTE the file is appended to so an export can be resumed
+        output = None
+        if options['output'] is not None:
+            output = open(options['output'], 'a', encoding='utf-8')
+        count = 0
+        try:
+            for line in exporter.lines(queryset, position):
+                if output is None:
+                    self.stdout.write(line, ending='')
+                else:
+                    output.write(line)
+                count += 1
+        except (ValueError, ValidationError) as e:
+            raise CommandError("Invalid position: %s" % e)
+        finally:
+            if output is not None:
+                output.close()
+            if exporter.cursor is not None:
+                self.stderr.write("Exported %d events, resume with "
+                                  "--since %s" % (count, exporter.cursor))
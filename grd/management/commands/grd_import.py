@@ -0,0 +1,427 @@
+import csv
+import io
+import json
+import sys
+import time
+from urllib import parse
+
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+from django.core.urlresolvers import Resolver404, resolve
+from django.core.validators import URLValidator
+from django.db import connection, transaction
+
+from grd.models import Event
+from grd.state import rebuild_state
+
+
+# Staging tables (dropped at the end of the transaction)
+STAGING_SQL = """
+CREATE TEMPORARY TABLE "grd_import_event" (
+    "line" integer PRIMARY KEY,
+    "type" text NOT NULL,
+    "agent" text NOT NULL,
+    "device_hid" text,
+    "device_url" text,
+    "device_type" text,
+    "date" timestamp with time zone,
+    "dhDate" timestamp with time zone NOT NULL,
+    "grdDate" timestamp with time zone,
+    "byUser" text NOT NULL,
+    "owner" text,
+    "to_agent" text,
+    "receiver" text,
+    "receiverType" text,
+    "place" text,
+    "lat" double precision,
+    "lon" double precision,
+    "event_id" integer,
+    "agent_id" integer,
+    "device_id" integer,
+    "owner_id" integer,
+    "to_agent_id" integer
+) ON COMMIT DROP;
+CREATE TEMPORARY TABLE "grd_import_component" (
+    "line" integer NOT NULL,
+    "hid" text,
+    "url" text,
+    "type" text,
+    "device_id" integer
+) ON COMMIT DROP;
+"""
+
+EVENT_COLUMNS = ('line', 'type', 'agent', 'device_hid', 'device_url',
+                 'device_type', 'date', 'dhDate', 'grdDate', 'byUser',
+                 'owner', 'to_agent', 'receiver', 'receiverType', 'place',
+                 'lat', 'lon', 'agent_id', 'device_id', 'to_agent_id')
+COMPONENT_COLUMNS = ('line', 'hid', 'url', 'type', 'device_id')
+
+# Devices referenced by the dump (as the events' device or component)
+# by their hid or url
+DEVICES_SQL = """
+SELECT "device_hid" AS "hid", "device_url" AS "url",
+       "device_type" AS "type", "line"
+FROM "grd_import_event" WHERE "device_id" IS NULL
+UNION ALL
+SELECT "hid", "url", "type", "line" FROM "grd_import_component"
+WHERE "device_id" IS NULL
+"""
+
+
+def get_hyperlinked_pk(value, base_url, view_name):
+    """
+    Return the pk of the object linked by `value` if it is a hyperlink
+    of the GRD served at `base_url` to `view_name` (as emitted by
+    grd_export --base-url), None otherwise.
+    
+    """
+    if base_url is None or not isinstance(value, str) or \
+            not value.startswith(base_url):
+        return None
+    path = value[len(base_url):]
+    if not path.startswith('/'):
+        return None
+    try:
+        match = resolve(parse.urlparse(path).path)
+    except Resolver404:
+        return None
+    pk = str(match.kwargs.get('pk', ''))
+    if match.url_name != view_name or not pk.isdigit():
+        return None
+    return int(pk)
+
+
+def get_device_spec(value, base_url=None):
+    """
+    Return the (hid, url, type, pk) of a device defined by an object
+    like the ones accepted by Register ({"hid", "url", "@type"}), by
+    its hid or url or by its hyperlink in this GRD (only its pk).
+    
+    """
+    if isinstance(value, dict):
+        spec = value.get('hid', None), value.get('url', None), \
+            value.get('@type', None), None
+        if spec[0] is None and spec[1] is None:
+            raise ValueError("The device must define its hid or url.")
+        return spec
+    if not isinstance(value, str) or not value:
+        raise ValueError("Invalid device %r." % value)
+    pk = get_hyperlinked_pk(value, base_url, 'device-detail')
+    if pk is not None:
+        return None, None, None, pk
+    try:
+        URLValidator(schemes=['http', 'https'])(value)
+    except ValidationError:
+        return value, None, None, None
+    return None, value, None, None
+
+
+class Command(BaseCommand):
+    help = ("Import newline delimited JSON event dumps (e.g. from a "
+            "DeviceHub or grd_export) loading them with COPY into staging "
+            "tables and inserting the devices, events, components and "
+            "locations set-wise in a single transaction. The events keep "
+            "their grdDate (those which don't define one are registered at "
+            "the time of the import) and are streamed by the feed in the "
+            "order they are imported. The state of the affected devices is "
+            "rebuilt afterwards in chunks (until then it doesn't include "
+            "the imported events, run grd_rebuild_state if the import is "
+            "interrupted).")
+    
+    # Number of lines parsed and copied at once
+    batch_size = 10000
+    
+    def add_arguments(self, parser):
+        parser.add_argument('files', nargs='+',
+                            help="NDJSON files ('-' to read from stdin).")
+        parser.add_argument('--agent', default=None,
+                            help="Name of the agent of the events that don't "
+                                 "define one.")
+        parser.add_argument('--by-user', default=None,
+                            help="URL of the user who performed the events "
+                                 "that don't define one (byUser isn't "
+                                 "exported by GRD).")
+        parser.add_argument('--base-url', default=None,
+                            help="Prefix of the hyperlinks of the GRD whose "
+                                 "export is imported, e.g. "
+                                 "https://grd.example.org. The agents and "
+                                 "devices they link to are the ones with the "
+                                 "same pk in this GRD (e.g. when restoring "
+                                 "its log).")
+        parser.add_argument('--chunk-size', type=int, default=500,
+                            help="Number of devices whose state is rebuilt "
+                                 "at once.")
+    
+    def handle(self, *args, **options):
+        self.default_agent = options['agent']
+        self.default_user = options['by_user']
+        self.base_url = options['base_url']
+        start = time.perf_counter()
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(STAGING_SQL)
+            
+            lines = 0
+            for path in options['files']:
+                if path == '-':
+                    lines += self.copy(cursor, sys.stdin, lines)
+                else:
+                    with open(path, encoding='utf-8') as f:
+                        lines += self.copy(cursor, f, lines)
+            self.report("Copied", lines, "lines", start)
+            
+            phase = time.perf_counter()
+            self.resolve_agents(cursor)
+            self.resolve_devices(cursor)
+            self.resolve_owners(cursor)
+            counts = self.insert_events(cursor)
+            for name, count in counts:
+                self.report("Inserted", count, name, phase)
+            pks = self.get_affected_devices(cursor)
+        
+        self.rebuild_devices(pks, options['chunk_size'])
+        self.report("Imported", lines, "events", start)
+    
+    def report(self, action, count, name, start):
+        elapsed = time.perf_counter() - start
+        self.stdout.write("%s %d %s in %.2f s (%.0f rows/s)" %
+                          (action, count, name, elapsed,
+                           count / elapsed if elapsed else 0))
+    
+    def copy(self, cursor, lines, offset):
+        """Parse the events and COPY them into the staging tables."""
+        count = 0
+        events, components = io.StringIO(), io.StringIO()
+        writers = csv.writer(events), csv.writer(components)
+        for number, line in enumerate(lines, start=offset + 1):
+            if not line.strip():
+                continue
+            try:
+                self.parse(number, json.loads(line), *writers)
+            except (ValueError, KeyError, TypeError) as e:
+                raise CommandError("Line %d: %s" % (number, e))
+            count += 1
+            if count % self.batch_size == 0:
+                self.copy_buffers(cursor, events, components)
+                events, components = io.StringIO(), io.StringIO()
+                writers = csv.writer(events), csv.writer(components)
+        self.copy_buffers(cursor, events, components)
+        return count
+    
+    def parse(self, number, item, events, components):
+        valid_types = [t for t, _ in Event.TYPES]
+        if item.get('@type', None) not in valid_types:
+            raise ValueError("Invalid event type %r." % item.get('@type'))
+        agent = item.get('agent', None) or self.default_agent
+        if agent is None:
+            raise ValueError("The agent is not defined (see --agent).")
+        by_user = item.get('byUser', None) or self.default_user
+        if by_user is None:
+            raise ValueError("The user is not defined (see --by-user).")
+        to = item.get('to', None)
+        hid, url, type, pk = get_device_spec(item['device'], self.base_url)
+        location = item.get('location', None) or {}
+        events.writerow([
+            number, item['@type'], agent, hid, url, type,
+            item.get('date', None), item['dhDate'], item.get('grdDate', None),
+            by_user, item.get('owner', None), to,
+            item.get('receiver', None), item.get('receiverType', None),
+            item.get('place', None), location.get('lat', None),
+            location.get('lon', None),
+            get_hyperlinked_pk(agent, self.base_url, 'agent-detail'), pk,
+            get_hyperlinked_pk(to, self.base_url, 'agent-detail'),
+        ])
+        for component in item.get('components', []):
+            components.writerow(
+                [number] + list(get_device_spec(component, self.base_url))
+            )
+    
+    @staticmethod
+    def copy_buffers(cursor, events, components):
+        # NOTE CSV empty values are loaded as NULL
+        for table, columns, buffer in [
+                ('grd_import_event', EVENT_COLUMNS, events),
+                ('grd_import_component', COMPONENT_COLUMNS, components)]:
+            buffer.seek(0)
+            cursor.copy_expert(
+                'COPY "%s" (%s) FROM STDIN WITH (FORMAT csv)' %
+                (table, ', '.join('"%s"' % c for c in columns)), buffer
+            )
+    
+    def resolve_agents(self, cursor):
+        """Resolve the agents by their name or hyperlink (pk)."""
+        cursor.execute(
+            'UPDATE "grd_import_event" s SET "agent_id" = a."id" '
+            'FROM "grd_agent" a WHERE s."agent_id" IS NULL '
+            'AND a."name" = s."agent"'
+        )
+        cursor.execute(
+            'UPDATE "grd_import_event" s SET "to_agent_id" = a."id" '
+            'FROM "grd_agent" a WHERE s."to_agent_id" IS NULL '
+            'AND a."name" = s."to_agent"'
+        )
+        cursor.execute(
+            'SELECT DISTINCT "agent" FROM "grd_import_event" s '
+            'WHERE NOT EXISTS (SELECT 1 FROM "grd_agent" a '
+            'WHERE a."id" = s."agent_id") UNION '
+            'SELECT DISTINCT "to_agent" FROM "grd_import_event" s '
+            'WHERE "to_agent" IS NOT NULL AND NOT EXISTS ('
+            'SELECT 1 FROM "grd_agent" a WHERE a."id" = s."to_agent_id")'
+        )
+        unknown = [row[0] for row in cursor.fetchall()]
+        if unknown:
+            raise CommandError("Unknown agents: %s." % ', '.join(unknown))
+    
+    def resolve_devices(self, cursor):
+        """
+        Create the devices that don't exist yet and resolve the pk of
+        every device. As in BulkRegister, devices are identified by
+        their hid or, if they don't have one, by their url (sameAs).
+        Hyperlinked devices (exported by GRD) must exist.
+        
+        """
+        cursor.execute(
+            'CREATE TEMPORARY TABLE "grd_import_device" ON COMMIT DROP AS '
+            'SELECT DISTINCT ON (COALESCE("hid", "url")) '
+            '"hid", "url", "type" FROM (%s) d '
+            'WHERE CASE WHEN "hid" IS NOT NULL '
+            'THEN NOT EXISTS (SELECT 1 FROM "grd_device" e '
+            'WHERE e."hid" = d."hid") '
+            'ELSE NOT EXISTS (SELECT 1 FROM "grd_device" e '
+            'WHERE e."sameAs" = d."url") END '
+            'ORDER BY COALESCE("hid", "url"), "line"' % DEVICES_SQL
+        )
+        cursor.execute(
+            'SELECT COALESCE("hid", \'?\') FROM "grd_import_device" '
+            'WHERE "url" IS NULL OR "type" IS NULL LIMIT 10'
+        )
+        incomplete = [row[0] for row in cursor.fetchall()]
+        if incomplete:
+            raise CommandError("New devices must define their url and "
+                               "@type: %s." % ', '.join(incomplete))
+        cursor.execute(
+            'SELECT n."url" FROM "grd_import_device" n '
+            'WHERE EXISTS (SELECT 1 FROM "grd_device" e '
+            'WHERE e."sameAs" = n."url") '
+            'UNION SELECT "url" FROM "grd_import_device" '
+            'GROUP BY "url" HAVING COUNT(*) > 1 LIMIT 10'
+        )
+        conflicts = [row[0] for row in cursor.fetchall()]
+        if conflicts:
+            raise CommandError("Devices registered with a different hardware "
+                               "identifier: %s." % ', '.join(conflicts))
+        cursor.execute(
+            'INSERT INTO "grd_device" ("hid", "sameAs", "type") '
+            'SELECT "hid", "url", "type" FROM "grd_import_device"'
+        )
+        self.new_devices = cursor.rowcount
+        
+        for table, prefix in [('grd_import_event', 'device_'),
+                              ('grd_import_component', '')]:
+            cursor.execute(
+                'SELECT DISTINCT "device_id" FROM "%(table)s" s '
+                'WHERE "device_id" IS NOT NULL AND NOT EXISTS ('
+                'SELECT 1 FROM "grd_device" d WHERE d."id" = s."device_id") '
+                'LIMIT 10' % {'table': table}
+            )
+            unknown = [str(row[0]) for row in cursor.fetchall()]
+            if unknown:
+                raise CommandError("Unknown devices (pk): %s." %
+                                   ', '.join(unknown))
+            cursor.execute(
+                'UPDATE "%(table)s" s SET "device_id" = d."id" '
+                'FROM "grd_device" d WHERE s."device_id" IS NULL '
+                'AND d."hid" = s."%(prefix)shid"'
+                % {'table': table, 'prefix': prefix}
+            )
+            cursor.execute(
+                'UPDATE "%(table)s" s SET "device_id" = d."id" '
+                'FROM "grd_device" d WHERE s."device_id" IS NULL '
+                'AND s."%(prefix)shid" IS NULL '
+                'AND d."sameAs" = s."%(prefix)surl"'
+                % {'table': table, 'prefix': prefix}
+            )
+            cursor.execute(
+                'SELECT COALESCE("%(prefix)shid", "%(prefix)surl") '
+                'FROM "%(table)s" WHERE "device_id" IS NULL LIMIT 10'
+                % {'table': table, 'prefix': prefix}
+            )
+            unknown = [row[0] for row in cursor.fetchall()]
+            if unknown:
+                raise CommandError("Unknown devices: %s." % ', '.join(unknown))
+    
+    def resolve_owners(self, cursor):
+        cursor.execute(
+            'INSERT INTO "grd_agentuser" ("url") '
+            'SELECT DISTINCT "owner" FROM "grd_import_event" s '
+            'WHERE "owner" IS NOT NULL AND NOT EXISTS ('
+            'SELECT 1 FROM "grd_agentuser" u WHERE u."url" = s."owner")'
+        )
+        cursor.execute(
+            'UPDATE "grd_import_event" s SET "owner_id" = u."id" '
+            'FROM "grd_agentuser" u WHERE u."url" = s."owner"'
+        )
+    
+    def insert_events(self, cursor):
+        """
+        Insert the events, their components and locations.
+        
+        The events are stored now (logDate) so the consumers of the feed
+        receive them even if they were registered in the past. As they
+        share the logDate, the ids are allocated in order of the lines.
+        
+        """
+        cursor.execute(
+            'UPDATE "grd_import_event" s SET "event_id" = n."id" FROM ('
+            'SELECT "line", nextval(pg_get_serial_sequence(\'grd_event\', '
+            '\'id\')) AS "id" FROM (SELECT "line" FROM "grd_import_event" '
+            'ORDER BY "line") o) n WHERE n."line" = s."line"'
+        )
+        cursor.execute(
+            'INSERT INTO "grd_event" ("id", "type", "date", "dhDate", '
+            '"grdDate", "logDate", "secured", "incidence", "geo", "byUser", '
+            '"agent_id", "device_id", "owner_id", "to_agent_id", "receiver", '
+            '"receiverType", "place", "data") '
+            'SELECT "event_id", "type", "date", "dhDate", '
+            'COALESCE("grdDate", now()), now(), TRUE, FALSE, '
+            'CASE WHEN "lat" IS NOT NULL THEN '
+            'ST_SetSRID(ST_MakePoint("lon", "lat"), 4326) END, "byUser", '
+            '"agent_id", "device_id", "owner_id", "to_agent_id", '
+            '"receiver", "receiverType", "place", \'\'::hstore '
+            'FROM "grd_import_event" ORDER BY "line"'
+        )
+        events = cursor.rowcount
+        cursor.execute(
+            'INSERT INTO "grd_event_components" ("event_id", "device_id") '
+            'SELECT DISTINCT s."event_id", c."device_id" '
+            'FROM "grd_import_component" c '
+            'JOIN "grd_import_event" s ON s."line" = c."line"'
+        )
+        components = cursor.rowcount
+        cursor.execute(
+            'INSERT INTO "grd_location" ("event_id", "lat", "lon") '
+            'SELECT "event_id", "lat", "lon" FROM "grd_import_event" '
+            'WHERE "lat" IS NOT NULL'
+        )
+        locations = cursor.rowcount
+        return [('devices', self.new_devices), ('events', events),
+                ('components', components), ('locations', locations)]
+    
+    @staticmethod
+    def get_affected_devices(cursor):
+        cursor.execute(
+            'SELECT "device_id" FROM "grd_import_event" UNION '
+            'SELECT "device_id" FROM "grd_import_component" ORDER BY 1'
+        )
+        return [row[0] for row in cursor.fetchall()]
+    
+    def rebuild_devices(self, pks, chunk_size):
+        """
+        Project again the state of the devices affected by the dump,
+        committing each chunk so the devices aren't locked until the
+        end of the import.
+        
+        """
+        for start in range(0, len(pks), chunk_size):
+            with transaction.atomic():
+                rebuild_state(pks[start:start + chunk_size])
+        self.stdout.write("Rebuilt the state of %d devices." % len(pks))
@@ -0,0 +1,62 @@
+import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+
+from grd import partitions
+
+
+class Command(BaseCommand):
+    help = ("Manage the monthly partitions of the event log: list them, "
+            "create the ones of the following months or detach the old "
+            "ones (e.g. after archiving them).")
+    
+    def add_arguments(self, parser):
+        parser.add_argument('action', choices=['list', 'create', 'detach'])
+        parser.add_argument('--months', type=int, default=3,
+                            help="Number of months ahead whose partitions "
+                                 "are created.")
+        parser.add_argument('--before', default=None, metavar='YYYY-MM-DD',
+                            help="Detach the partitions of the events "
+                                 "stored before the date.")
+        parser.add_argument('--drop', action='store_true', default=False,
+                            help="Drop the detached partitions.")
+    
+    def handle(self, *args, **options):
+        if not partitions.is_supported(connection):
+            raise CommandError("The events can't be partitioned on this "
+                               "database (PostgreSQL %d or newer is "
+                               "required)." % (partitions.MIN_VERSION // 10000))
+        with transaction.atomic(), connection.cursor() as cursor:
+            if not partitions.is_partitioned(cursor):
+                raise CommandError("The events aren't partitioned, apply "
+                                   "the migrations first.")
+            getattr(self, options['action'])(cursor, options)
+    
+    def list(self, cursor, options):
+        for name, start, end in partitions.get_partitions(cursor):
+            if start is None and end is None:
+                bounds = 'default'
+            else:
+                bounds = '%s - %s' % (start.date() if start else '',
+                                      end.date())
+            self.stdout.write("%-24s %s" % (name, bounds))
+    
+    def create(self, cursor, options):
+        created = partitions.create_partitions(cursor, options['months'])
+        self.stdout.write("Created %d partitions: %s" %
+                          (len(created), ', '.join(created)))
+    
+    def detach(self, cursor, options):
+        date = parse_date(options['before'] or '')
+        if date is None:
+            raise CommandError("Define the date with --before YYYY-MM-DD.")
+        before = datetime.datetime(date.year, date.month, date.day,
+                                   tzinfo=timezone.utc)
+        detached = partitions.detach_partitions(cursor, before,
+                                                drop=options['drop'])
+        self.stdout.write("%s %d partitions: %s" %
+                          ('Dropped' if options['drop'] else 'Detached',
+                           len(detached), ', '.join(detached)))
@@ -0,0 +1,59 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from grd.models import Device
+from grd.state import rebuild_state, verify
+
+
+class Command(BaseCommand):
+    help = ("Rebuild the projected state of the devices from the event log "
+            "and verify that it matches the result of replaying the events.")
+    
+    def add_arguments(self, parser):
+        parser.add_argument('devices', nargs='*', type=int,
+                            help="Primary keys of the devices (default all).")
+        parser.add_argument('--chunk-size', type=int, default=500,
+                            help="Number of devices processed at once.")
+        parser.add_argument('--missing', action='store_true', default=False,
+                            help="Only the devices whose state hasn't been "
+                                 "projected yet (e.g. after upgrading).")
+        parser.add_argument('--no-rebuild', action='store_false',
+                            dest='rebuild', default=True,
+                            help="Only verify the stored state.")
+        parser.add_argument('--no-verify', action='store_false',
+                            dest='verify', default=True,
+                            help="Don't verify the rebuilt state.")
+    
+    def handle(self, *args, **options):
+        queryset = Device.objects.order_by('pk')
+        if options['devices']:
+            queryset = queryset.filter(pk__in=options['devices'])
+        if options['missing']:
+            queryset = queryset.filter(state__isnull=True)
+        pks = list(queryset.values_list('pk', flat=True))
+        chunk_size = options['chunk_size']
+        
+        mismatches = 0
+        for start in range(0, len(pks), chunk_size):
+            chunk = pks[start:start + chunk_size]
+            
+            if options['rebuild']:
+                with transaction.atomic():
+                    rebuild_state(chunk)
+            
+            if options['verify']:
+                for device in Device.objects.filter(pk__in=chunk):
+                    errors = verify(device)
+                    if errors:
+                        mismatches += 1
+                        self.stderr.write("%s: %s mismatch." %
+                                          (device, ', '.join(errors)))
+            
+            if int(options['verbosity']) > 1:
+                self.stdout.write("Processed %d of %d devices." %
+                                  (start + len(chunk), len(pks)))
+        
+        if mismatches:
+            raise CommandError("The state of %d devices doesn't match "
+                               "the event log." % mismatches)
+        self.stdout.write("Processed %d devices." % len(pks))
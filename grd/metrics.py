@@ -0,0 +1,123 @@
+"""
+Fleet-wide metrics computed by the database.
+
+Device.running_time and Device.durability are computed from the state
+of a single device; these functions aggregate the same metrics from
+the projected state of all the devices (see grd.state.Projector),
+grouped by some of their attributes. Devices whose state hasn't been
+projected yet are counted as neither used nor recycled.
+
+"""
+from collections import OrderedDict
+
+from django.db import connection
+
+
+# Attributes that the metrics can be grouped by {name: SQL expression}
+# NOTE the agent of a device is the one which currently holds it.
+GROUP_BY = OrderedDict([
+    ('type', 'd."type"'),
+    ('agent', 's."holder_id"'),
+    ('year', 'EXTRACT(YEAR FROM d."productionDate")::integer'),
+])
+
+# Running time (seconds) and durability (years) of each device, as
+# DeviceState.running_time and DeviceState.get_durability.
+DEVICE_METRICS_SQL = """
+WITH "device" AS (
+    SELECT %(columns)s,
+           COALESCE(s."running_seconds", 0) + COALESCE(EXTRACT(EPOCH FROM
+               COALESCE(s."recycled_on", now()) - s."usage_start"), 0)
+               AS "running_time",
+           EXTRACT(YEAR FROM s."recycled_on")::integer - COALESCE(
+               EXTRACT(YEAR FROM d."productionDate"),
+               EXTRACT(YEAR FROM s."registered_on"))::integer AS "durability"
+    FROM "grd_device" d
+    LEFT JOIN "grd_devicestate" s ON s."device_id" = d."id"
+)
+"""
+
+FLEET_METRICS_SQL = DEVICE_METRICS_SQL + """
+SELECT %(group)s
+       COUNT(*),
+       SUM("running_time"),
+       AVG("running_time"),
+       COUNT("durability"),
+       AVG("durability"),
+       MIN("durability"),
+       MAX("durability"),
+       percentile_cont(0.5) WITHIN GROUP (ORDER BY "durability")
+FROM "device"
+%(group_by)s
+ORDER BY %(order_by)s
+"""
+
+DURABILITY_SQL = DEVICE_METRICS_SQL + """
+SELECT %(group)s "durability", COUNT(*)
+FROM "device"
+WHERE "durability" IS NOT NULL
+GROUP BY %(group)s "durability"
+ORDER BY %(group)s "durability"
+"""
+
+
+def get_sql(template, group_by):
+    columns = ['%s AS "%s"' % (GROUP_BY[name], name) for name in group_by]
+    group = ''.join('"%s", ' % name for name in group_by)
+    params = {
+        'columns': ', '.join(columns + ['d."id"']),
+        'group': group,
+        'group_by': 'GROUP BY %s' % group.rstrip(', ') if group_by else '',
+        'order_by': group.rstrip(', ') or '1',
+    }
+    return template % params
+
+
+def fleet_metrics(group_by=()):
+    """
+    Return the running time (seconds) and durability (years) metrics
+    of the devices grouped by the attributes `group_by` (see GROUP_BY).
+    
+    """
+    for name in group_by:
+        if name not in GROUP_BY:
+            raise ValueError("Cannot group by '%s'." % name)
+    
+    groups = OrderedDict()
+    with connection.cursor() as cursor:
+        cursor.execute(get_sql(FLEET_METRICS_SQL, group_by))
+        for row in cursor.fetchall():
+            key = tuple(row[:len(group_by)])
+            (devices, total, average, recycled, durability_average,
+             durability_min, durability_max, durability_median) = \
+                row[len(group_by):]
+            group = OrderedDict(zip(group_by, key))
+            group.update([
+                ('devices', devices),
+                ('running_time', OrderedDict([
+                    ('total', float(total or 0)),
+                    ('average', float(average or 0)),
+                ])),
+                ('durability', OrderedDict([
+                    ('recycled', recycled),
+                    ('average', to_float(durability_average)),
+                    ('min', durability_min),
+                    ('max', durability_max),
+                    ('median', to_float(durability_median)),
+                    ('distribution', OrderedDict()),
+                ])),
+            ])
+            groups[key] = group
+        
+        cursor.execute(get_sql(DURABILITY_SQL, group_by))
+        for row in cursor.fetchall():
+            key = tuple(row[:len(group_by)])
+            durability, count = row[len(group_by):]
+            distribution = groups[key]['durability']['distribution']
+            distribution[str(durability)] = count
+    
+    return list(groups.values())
+
+
+def to_float(value):
+    return float(value) if value is not None else None
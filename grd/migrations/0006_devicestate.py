@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('grd', '0005_auto_add_event_receive_attributes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DeviceState',
+            fields=[
+                ('device', models.OneToOneField(primary_key=True, serialize=False, to='grd.Device', related_name='state')),
+                ('migrated', models.BooleanField(default=False)),
+                ('running_seconds', models.FloatField(default=0)),
+                ('usage_start', models.DateTimeField(null=True)),
+                ('recycled_on', models.DateTimeField(null=True)),
+                ('components', models.ManyToManyField(to='grd.Device', related_name='+')),
+                ('holder', models.ForeignKey(null=True, to='grd.Agent', related_name='+')),
+                ('owners', models.ManyToManyField(to='grd.AgentUser', related_name='+')),
+                ('parent', models.ForeignKey(null=True, to='grd.Device', related_name='+')),
+            ],
+        ),
+    ]
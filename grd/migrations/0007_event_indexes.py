@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+    
+    dependencies = [
+        ('grd', '0006_devicestate'),
+    ]
+    
+    operations = [
+        migrations.AlterIndexTogether(
+            name='event',
+            index_together=set([('device', 'type', 'grdDate')]),
+        ),
+        # Django only creates an index on (event_id, device_id) for the
+        # M2M table: add the reverse one to look up the events which
+        # include a device as component (Device.parent_events).
+        migrations.RunSQL(
+            'CREATE INDEX "grd_event_components_device_id_event_id" '
+            'ON "grd_event_components" ("device_id", "event_id");',
+            'DROP INDEX "grd_event_components_device_id_event_id";'
+        ),
+    ]
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+    
+    dependencies = [
+        ('grd', '0007_event_indexes'),
+    ]
+    
+    operations = [
+        migrations.AddField(
+            model_name='devicestate',
+            name='registered_on',
+            field=models.DateTimeField(null=True),
+        ),
+        # Backfill the states which have been already projected.
+        migrations.RunSQL(
+            'UPDATE "grd_devicestate" SET "registered_on" = ('
+            'SELECT "date" FROM "grd_event" '
+            'WHERE "device_id" = "grd_devicestate"."device_id" '
+            'AND "type" = \'Register\' '
+            'ORDER BY "grdDate" LIMIT 1);',
+            migrations.RunSQL.noop
+        ),
+    ]
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+    
+    dependencies = [
+        ('grd', '0008_devicestate_registered_on'),
+    ]
+    
+    operations = [
+        migrations.CreateModel(
+            name='Ownership',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False, auto_created=True, verbose_name='ID')),
+                ('device', models.ForeignKey(to='grd.Device', related_name='ownerships')),
+                ('event', models.ForeignKey(to='grd.Event', related_name='+')),
+                ('owner', models.ForeignKey(to='grd.AgentUser', related_name='ownerships')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='ownership',
+            unique_together=set([('device', 'owner')]),
+        ),
+        # Move the owners of the projected states to the new relation
+        # (the allocation event is the latest Allocate of the owner).
+        migrations.RunSQL(
+            'INSERT INTO "grd_ownership" ("device_id", "owner_id", "event_id") '
+            'SELECT "device_id", "owner_id", "event_id" FROM ('
+            'SELECT o."devicestate_id" AS "device_id", '
+            'o."agentuser_id" AS "owner_id", ('
+            'SELECT e."id" FROM "grd_event" e '
+            'WHERE e."device_id" = o."devicestate_id" '
+            'AND e."owner_id" = o."agentuser_id" '
+            'AND e."type" = \'Allocate\' '
+            'ORDER BY e."grdDate" DESC, e."id" DESC LIMIT 1) AS "event_id" '
+            'FROM "grd_devicestate_owners" o) ownership '
+            'WHERE "event_id" IS NOT NULL ORDER BY "event_id";',
+            migrations.RunSQL.noop
+        ),
+        migrations.RemoveField(
+            model_name='devicestate',
+            name='owners',
+        ),
+    ]
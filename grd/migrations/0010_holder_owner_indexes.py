@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+    
+    dependencies = [
+        ('grd', '0009_ownership'),
+    ]
+    
+    operations = [
+        migrations.AlterIndexTogether(
+            name='devicestate',
+            index_together=set([('holder', 'device')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='ownership',
+            index_together=set([('owner', 'device')]),
+        ),
+    ]
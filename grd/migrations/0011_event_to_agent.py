@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+    
+    dependencies = [
+        ('grd', '0010_holder_owner_indexes'),
+    ]
+    
+    operations = [
+        migrations.AddField(
+            model_name='event',
+            name='to_agent',
+            field=models.ForeignKey(null=True, to='grd.Agent', related_name='+'),
+        ),
+        # Migrate events stored the agent's pk as the HStore data 'to'
+        migrations.RunSQL(
+            'UPDATE "grd_event" SET "to_agent_id" = a."id" '
+            'FROM "grd_agent" a '
+            'WHERE "grd_event"."type" = \'Migrate\' '
+            'AND "grd_event"."data" -> \'to\' ~ \'^[0-9]+$\' '
+            'AND a."id" = ("grd_event"."data" -> \'to\')::integer;',
+            'UPDATE "grd_event" SET "data" = "data" || '
+            'hstore(\'to\', "to_agent_id"::text) '
+            'WHERE "to_agent_id" IS NOT NULL;'
+        ),
+    ]
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+    
+    dependencies = [
+        ('grd', '0011_event_to_agent'),
+    ]
+    
+    operations = [
+        # Copy the existing locations to the geometry column
+        migrations.RunSQL(
+            'UPDATE "grd_event" SET "geo" = '
+            'ST_SetSRID(ST_MakePoint(l."lon", l."lat"), 4326) '
+            'FROM "grd_location" l WHERE l."event_id" = "grd_event"."id";',
+            migrations.RunSQL.noop
+        ),
+        # Distance queries (meters) use the geography type
+        migrations.RunSQL(
+            'CREATE INDEX "grd_event_geo_geography" ON "grd_event" '
+            'USING GIST (("geo"::geography));',
+            'DROP INDEX "grd_event_geo_geography";'
+        ),
+        # Latest location of a device
+        migrations.RunSQL(
+            'CREATE INDEX "grd_event_device_id_located" ON "grd_event" '
+            '("device_id", "grdDate", "id") WHERE "geo" IS NOT NULL;',
+            'DROP INDEX "grd_event_device_id_located";'
+        ),
+    ]
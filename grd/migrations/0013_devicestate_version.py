@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+    
+    dependencies = [
+        ('grd', '0012_event_geo'),
+    ]
+    
+    operations = [
+        migrations.AddField(
+            model_name='devicestate',
+            name='version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+from grd import partitions
+
+
+def partition_events(apps, schema_editor):
+    # NOTE the events aren't partitioned on older PostgreSQL versions
+    if not partitions.is_supported(schema_editor.connection):
+        return
+    with schema_editor.connection.cursor() as cursor:
+        if not partitions.is_partitioned(cursor):
+            partitions.partition_events(cursor)
+
+
+class Migration(migrations.Migration):
+    
+    dependencies = [
+        ('grd', '0013_devicestate_version'),
+    ]
+    
+    operations = [
+        # The partitioned table is compatible with the previous schema
+        # (but the foreign keys that reference the events are dropped).
+        migrations.RunPython(partition_events, migrations.RunPython.noop),
+    ]
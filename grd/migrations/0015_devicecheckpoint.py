@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import django.contrib.postgres.fields
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+    
+    dependencies = [
+        ('grd', '0014_event_partitions'),
+    ]
+    
+    operations = [
+        migrations.CreateModel(
+            name='DeviceCheckpoint',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False, auto_created=True, verbose_name='ID')),
+                ('grdDate', models.DateTimeField()),
+                ('event_id', models.IntegerField()),
+                ('version', models.PositiveIntegerField()),
+                ('component_ids', django.contrib.postgres.fields.ArrayField(base_field=models.IntegerField(), size=None, default=list)),
+                ('owner_ids', django.contrib.postgres.fields.ArrayField(base_field=models.IntegerField(), size=None, default=list)),
+                ('migrated', models.BooleanField(default=False)),
+                ('running_seconds', models.FloatField(default=0)),
+                ('usage_start', models.DateTimeField(null=True)),
+                ('recycled_on', models.DateTimeField(null=True)),
+                ('registered_on', models.DateTimeField(null=True)),
+                ('device', models.ForeignKey(to='grd.Device', related_name='checkpoints')),
+                ('holder', models.ForeignKey(to='grd.Agent', null=True, related_name='+')),
+                ('parent', models.ForeignKey(to='grd.Device', null=True, related_name='+')),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='devicecheckpoint',
+            index_together=set([('device', 'grdDate', 'event_id')]),
+        ),
+    ]
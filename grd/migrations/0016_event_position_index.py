@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+    
+    dependencies = [
+        ('grd', '0015_devicecheckpoint'),
+    ]
+    
+    operations = [
+        # keyset pagination, feed and export of the event log
+        migrations.AlterIndexTogether(
+            name='event',
+            index_together=set([('device', 'type', 'grdDate'),
+                                ('grdDate', 'id')]),
+        ),
+    ]
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+    
+    dependencies = [
+        ('grd', '0016_event_position_index'),
+    ]
+    
+    operations = [
+        migrations.AlterModelOptions(
+            name='event',
+            options={'get_latest_by': 'grdDate',
+                     'ordering': ['grdDate', 'id']},
+        ),
+        migrations.AddField(
+            model_name='event',
+            name='logDate',
+            field=models.DateTimeField(null=True),
+        ),
+        # the events stored so far were registered by this GRD
+        migrations.RunSQL(
+            'UPDATE "grd_event" SET "logDate" = "grdDate"',
+            migrations.RunSQL.noop,
+        ),
+        migrations.AlterField(
+            model_name='event',
+            name='logDate',
+            field=models.DateTimeField(auto_now_add=True),
+        ),
+        # feed and export of the event log
+        migrations.AlterIndexTogether(
+            name='event',
+            index_together=set([('device', 'type', 'grdDate'),
+                                ('grdDate', 'id'), ('logDate', 'id')]),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+from grd import partitions
+
+
+def drop_references(apps, schema_editor):
+    # NOTE the foreign key of the components to the event can't be
+    # defined on the model (the through table is created by Django)
+    with schema_editor.connection.cursor() as cursor:
+        partitions.drop_references(cursor)
+
+
+class Migration(migrations.Migration):
+    
+    dependencies = [
+        ('grd', '0017_event_logdate'),
+    ]
+    
+    operations = [
+        # The events can't be referenced once partitioned (see 0014),
+        # so the foreign keys are dropped on every server.
+        migrations.AlterField(
+            model_name='location',
+            name='event',
+            field=models.OneToOneField(primary_key=True, serialize=False,
+                                       to='grd.Event', db_constraint=False),
+        ),
+        migrations.AlterField(
+            model_name='ownership',
+            name='event',
+            field=models.ForeignKey(related_name='+', to='grd.Event',
+                                    db_constraint=False),
+        ),
+        migrations.RunPython(drop_references, migrations.RunPython.noop),
+    ]
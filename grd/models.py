@@ -1,13 +1,115 @@
 from django.conf import settings
 from django.contrib.gis.db import models as gis_models
-from django.contrib.postgres.fields import HStoreField
+from django.contrib.postgres.fields import ArrayField, HStoreField
 from django.core.urlresolvers import reverse
 from django.core.validators import RegexValidator
-from django.db import models
-from django.db.models import Q
+from django.db import connection, models
+from django.db.models.query import prefetch_related_objects
 from django.utils import timezone
 
 
+class DeviceManager(models.Manager):
+    def prefetch_state(self, devices):
+        """
+        Retrieve the components and owners of the devices using a
+        fixed number of queries, whatever the number of devices is.
+        
+        Devices whose state hasn't been projected yet are computed
+        folding all their events at once (see Device.replay_*).
+        
+        """
+        prefetch_related_objects(devices, ['state__components'])
+        
+        projected = dict((d.pk, d) for d in devices
+                         if d.current_state is not None)
+        for device in projected.values():
+            device._replayed_owners = []
+        ownerships = Ownership.objects.filter(device__in=list(projected))
+        ownerships = ownerships.order_by('pk')
+        for pk, url in ownerships.values_list('device_id', 'owner__url'):
+            projected[pk]._replayed_owners.append(url)
+        
+        pending = dict((d.pk, d) for d in devices if d.current_state is None)
+        if not pending:
+            return devices
+        
+        events = Event.objects.filter(
+            device__in=list(pending),
+            type__in=[Event.REGISTER, Event.ADD, Event.REMOVE,
+                      Event.ALLOCATE, Event.DEALLOCATE]
+        ).order_by('grdDate', 'id').select_related('owner').prefetch_related(
+            'components'
+        )
+        
+        # Get the latest register event (can exist several because
+        # of snapshots)
+        registers = dict((e.device_id, e) for e in events
+                         if e.type == Event.REGISTER)
+        for pk, device in pending.items():
+            if pk in registers:
+                components = list(registers[pk].components.all())
+            else:
+                components = []
+            device._replayed_components = components
+            device._replayed_owners = []
+        
+        for e in events:
+            device = pending[e.device_id]
+            if e.type == Event.ADD:
+                device._replayed_components += e.components.all()
+            elif e.type == Event.REMOVE:
+                device._replayed_components = list(
+                    set(device._replayed_components) - set(e.components.all())
+                )
+            elif e.type == Event.ALLOCATE:
+                if e.owner.url not in device._replayed_owners:
+                    device._replayed_owners.append(e.owner.url)
+            elif e.type == Event.DEALLOCATE:
+                if e.owner.url in device._replayed_owners:
+                    device._replayed_owners.remove(e.owner.url)
+        
+        return devices
+    
+    def get_parents(self, devices):
+        """
+        Return the pk of the current parent of each device (None if it
+        hasn't a parent) {device_pk: parent_pk} using at most two
+        queries, whatever the number of devices is.
+        
+        """
+        parents = {}
+        pending = set()
+        for device in devices:
+            if hasattr(device, '_replayed_parent'):
+                parent = device._replayed_parent
+                parents[device.pk] = parent.pk if parent is not None else None
+            else:
+                pending.add(device.pk)
+        if not pending:
+            return parents
+        
+        states = DeviceState.objects.filter(pk__in=pending)
+        for pk, parent_id in states.values_list('pk', 'parent_id'):
+            parents[pk] = parent_id
+            pending.discard(pk)
+        if not pending:
+            return parents
+        
+        # Devices whose state hasn't been projected yet: the latest
+        # event which includes the device as component defines it.
+        for pk in pending:
+            parents[pk] = None
+        events = Event.objects.filter(
+            components__in=list(pending),
+            type__in=[Event.REGISTER, Event.ADD, Event.REMOVE]
+        ).order_by('grdDate', 'id')
+        for pk, type, parent_id in events.values_list('components', 'type',
+                                                      'device_id'):
+            if pk in pending:
+                parents[pk] = None if type == Event.REMOVE else parent_id
+        return parents
+
+
 class Device(models.Model):
     # Device types
     COMPUTER = 'Computer'
@@ -46,16 +148,90 @@ class Device(models.Model):
     type = models.CharField(max_length=16, choices=TYPES)
     productionDate = models.DateField(blank=True, null=True)
     
+    objects = DeviceManager()
+    
     def __str__(self):
         return "%s %s" % (self.type, self.pk)
     
     @property
-    def components(self):
+    def current_state(self):
+        """Projected state of the device or None if it isn't built yet."""
         try:
-            # Get the latest register event (can exist several because
-            # of snapshots)
-            last_event = self.events.filter(type=Event.REGISTER).latest()
-        except Event.DoesNotExist:
+            return self.state
+        except DeviceState.DoesNotExist:
+            return None
+    
+    # NOTE the state can be provided by the attributes _replayed_* when
+    # it has been computed in memory (e.g. while processing a batch).
+    @property
+    def components(self):
+        if hasattr(self, '_replayed_components'):
+            return self._replayed_components
+        state = self.current_state
+        if state is None:
+            return self.replay_components()
+        return list(state.components.all())
+    
+    @property
+    def holder(self):
+        state = self.current_state
+        if state is None:
+            return self.replay_holder()
+        if state.holder_id is None:
+            # TODO inherit owner from parent device
+            raise NotImplementedError
+        return state.holder
+    
+    @property
+    def owners(self):
+        if hasattr(self, '_replayed_owners'):
+            return self._replayed_owners
+        state = self.current_state
+        if state is None:
+            return self.replay_owners()
+        ownerships = self.ownerships.order_by('pk')
+        return list(ownerships.values_list('owner__url', flat=True))
+    
+    def has_owner(self, url):
+        """Return True if the device is currently allocated to `url`."""
+        if hasattr(self, '_replayed_owners') or self.current_state is None:
+            return url in self.owners
+        return self.ownerships.filter(owner__url=url).exists()
+    
+    @property
+    def parent(self):
+        if hasattr(self, '_replayed_parent'):
+            return self._replayed_parent
+        state = self.current_state
+        if state is None:
+            return self.replay_parent()
+        return state.parent
+    
+    # TODO create metrics module and move to it
+    @property
+    def running_time(self):
+        state = self.current_state
+        if state is None:
+            return self.replay_running_time()
+        return state.running_time
+    
+    # TODO create metrics module and move to it
+    @property
+    def durability(self):
+        state = self.current_state
+        if state is None:
+            return self.replay_durability()
+        
+        return state.get_durability(self.productionDate)
+    
+    # The replay_* methods compute the device's state processing its
+    # whole history of events. They are used when the state has not
+    # been projected yet and to verify the projection.
+    def replay_components(self):
+        # Get the latest register event (can exist several because
+        # of snapshots)
+        last_event = self.events.filter(type=Event.REGISTER).last()
+        if last_event is None:
             # Device has been registered as component of another Device
             # so it doesn't have a registered event.
             components = []
@@ -72,21 +248,17 @@ class Device(models.Model):
         
         return components
     
-    @property
-    def holder(self):
-        try:
-            last_migration = self.events.filter(type=Event.MIGRATE).latest()
-        except Event.DoesNotExist:
-            pass
-        else:
-            return Agent.objects.get(pk=last_migration.to)
+    def replay_holder(self):
+        migrations = self.events.filter(type=Event.MIGRATE)
+        last_migration = migrations.select_related('to_agent').last()
+        if last_migration is not None:
+            return last_migration.to_agent
         
         # There is no migrations, so find which agent registered the device
-        try:
-            # Get the latest register event (can exist several because
-            # of snapshots)
-            last_event = self.events.filter(type=Event.REGISTER).latest()
-        except Event.DoesNotExist:
+        # Get the latest register event (can exist several because
+        # of snapshots)
+        last_event = self.events.filter(type=Event.REGISTER).last()
+        if last_event is None:
             # Device has been registered as component of another Device
             # so it doesn't have a registered event.
             # TODO inherit owner from parent device
@@ -96,8 +268,7 @@ class Device(models.Model):
             owner = last_event.agent
         return owner
     
-    @property
-    def owners(self):
+    def replay_owners(self):
         ASSIGNATION_EVENTS = [Event.ALLOCATE, Event.DEALLOCATE]
         
         # Compute allocate and deallocate events. Get both together
@@ -105,19 +276,18 @@ class Device(models.Model):
         device_owners = []
         for e in self.events.filter(type__in=ASSIGNATION_EVENTS):
             if e.type == Event.ALLOCATE:
-                device_owners.append(e.owner.url)
-            else:  # Event.DEALLOCATE
+                if e.owner.url not in device_owners:
+                    device_owners.append(e.owner.url)
+            elif e.owner.url in device_owners:  # Event.DEALLOCATE
                 device_owners.remove(e.owner.url)
         
         return device_owners
     
-    @property
-    def parent(self):
+    def replay_parent(self):
         # Compute events that modify relation between devices.
         DEV_REL_EVENTS = [Event.REGISTER, Event.ADD, Event.REMOVE]
-        try:
-            event = self.parent_events.filter(type__in=DEV_REL_EVENTS).latest()
-        except Event.DoesNotExist:
+        event = self.parent_events.filter(type__in=DEV_REL_EVENTS).last()
+        if event is None:
             return None
         
         if event.type == Event.REMOVE:
@@ -125,9 +295,7 @@ class Device(models.Model):
         
         return event.device
     
-    # TODO create metrics module and move to it
-    @property
-    def running_time(self):
+    def replay_running_time(self):
         USAGE_EVENTS = [Event.USAGEPROOF, Event.STOPUSAGE]
         qs = self.events.filter(type__in=USAGE_EVENTS)
         
@@ -150,26 +318,27 @@ class Device(models.Model):
             # TODO(santiago) which kind of events means that the device
             # is not being used anymore?
             try:
-                end_date = self.events.get(type=Event.RECYCLE).date
+                recycle = self.events.get(type=Event.RECYCLE)
+                end_date = recycle.date or recycle.grdDate
             except Event.DoesNotExist:
                 end_date = timezone.now()
             seconds += (end_date - beg_date).total_seconds()
         
         return seconds
     
-    # TODO create metrics module and move to it
-    @property
-    def durability(self):
+    def replay_durability(self):
         # Tiempo entre el año de fabricación (Device.productionDate) y su reciclaje.
         try:
-            recycled_on = self.events.get(type=Event.RECYCLE).date.year
+            recycle = self.events.get(type=Event.RECYCLE)
+            recycled_on = (recycle.date or recycle.grdDate).year
         except Event.DoesNotExist:
             raise ValueError("Cannot obtain durability of a device that has "
                              "not been recycled yet.")
         
         if self.productionDate is None:
             qs_register = self.events.filter(type=Event.REGISTER)
-            produced_on = qs_register.earliest().date.year
+            register = qs_register.earliest()
+            produced_on = (register.date or register.grdDate).year
         else:
             produced_on = self.productionDate.year
         
@@ -178,7 +347,45 @@ class Device(models.Model):
 
 class EventManager(models.Manager):
     def related_to_device(self, device):
-        return self.filter(Q(device=device) | Q(components__in=[device])).distinct()
+        """
+        Events performed on the device or which include it as component.
+        
+        NOTE: a UNION of both lookups allows PostgreSQL to use the
+        indexes of each table instead of joining the whole M2M table
+        (OR + DISTINCT).
+        
+        """
+        pk = getattr(device, 'pk', device)
+        return self.extra(
+            where=['"grd_event"."id" IN ('
+                   'SELECT "id" FROM "grd_event" WHERE "device_id" = %s '
+                   'UNION '
+                   'SELECT "event_id" FROM "grd_event_components" '
+                   'WHERE "device_id" = %s)'],
+            params=[pk, pk],
+        ).order_by('grdDate', 'id')
+    
+    def committed_until(self):
+        """
+        Date before which all the events have been committed.
+        
+        logDate is defined when the event is inserted, not when it is
+        committed, so a transaction in flight (e.g. a bulk request or
+        an import) can commit events older than the visible ones.
+        Writing transactions (those with a transaction id) of other
+        sessions started at the returned date at the earliest.
+        
+        NOTE the sessions of other database roles are only visible to
+        superusers (or pg_read_all_stats members).
+        
+        """
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT LEAST(clock_timestamp(), MIN("xact_start")) '
+                'FROM pg_stat_activity WHERE "backend_xid" IS NOT NULL '
+                'AND "pid" <> pg_backend_pid()'
+            )
+            return cursor.fetchone()[0]
 
 
 class Event(models.Model):
@@ -220,6 +427,10 @@ class Event(models.Model):
                                 blank=True, null=True)
     dhDate = models.DateTimeField('Time when the event has happened.')
     grdDate = models.DateTimeField(auto_now_add=True)
+    # Time when the event was stored in this log: the events are streamed
+    # (feed and export) in this order, as imported events keep the grdDate
+    # of the GRD where they were registered.
+    logDate = models.DateTimeField(auto_now_add=True)
     errors = models.TextField(null=True)  # XXX serialize array as coma separated?
     secured = models.BooleanField(default=True)
     incidence = models.BooleanField(default=False)
@@ -228,11 +439,16 @@ class Event(models.Model):
     
     agent = models.ForeignKey('Agent', related_name='+')
     device = models.ForeignKey('Device', related_name='events')
+    # NOTE the foreign key of the components to the event is dropped
+    # as the ones of Location and Ownership (see grd.partitions)
     components = models.ManyToManyField('Device', related_name='parent_events')
     
     # Allocate/Deallocate Event attributes
     owner = models.ForeignKey('AgentUser', null=True)
     
+    # Migrate event attributes
+    to_agent = models.ForeignKey('Agent', null=True, related_name='+')
+    
     # Receive event attributes
     FINAL_USER = 'FinalUser'
     COLLECTION_POINT = 'CollectionPoint'
@@ -254,8 +470,15 @@ class Event(models.Model):
         get_latest_by = 'grdDate'
         # WARNING: the order of the events affects the computation of
         # the device's state, so be sure that you know what are you
-        # doing before changing this field.
-        ordering = ['grdDate']
+        # doing before changing this field. The id breaks the ties of
+        # the events registered at the same time (e.g. imported).
+        ordering = ['grdDate', 'id']
+        # The device's state is computed filtering its events by type
+        # and ordering them by date. The log is paginated by the
+        # position (grdDate, id) of the events (see grd.pagination)
+        # and streamed by their position (logDate, id) (see grd.export).
+        index_together = [('device', 'type', 'grdDate'), ('grdDate', 'id'),
+                          ('logDate', 'id')]
     
     def __str__(self):
         event_date = self.grdDate.strftime("%Y-%m-%d")
@@ -263,12 +486,7 @@ class Event(models.Model):
     
     @property
     def to(self):
-        # TODO return an agent instance instead a string?
-        # agent_pk = self.data.get('to', None)
-        # if agent_pk is not None:
-        #     return Agent.objects.get(pk=agent_pk)
-        # return None
-        return self.data.get('to', None)
+        return self.to_agent
 
 
 class Agent(models.Model):
@@ -296,9 +514,132 @@ class Location(gis_models.Model):
     lat = models.FloatField()
     lon = models.FloatField()
     
-    event = models.OneToOneField('Event', primary_key=True)
+    event = models.OneToOneField('Event', primary_key=True,
+                                 db_constraint=False)
     
     objects = gis_models.GeoManager()
     
     def __str__(self):
         return self.label
+
+
+class DeviceState(models.Model):
+    """
+    Current state of a device projected from its events.
+    
+    It is updated in the same transaction that inserts each event
+    (see grd.state.Projector) so reading the state of a device doesn't
+    require processing its whole history. It can be rebuilt from the
+    event log using the `grd_rebuild_state` management command.
+    
+    """
+    device = models.OneToOneField('Device', primary_key=True,
+                                  related_name='state')
+    parent = models.ForeignKey('Device', null=True, related_name='+')
+    components = models.ManyToManyField('Device', related_name='+')
+    holder = models.ForeignKey('Agent', null=True, related_name='+')
+    # True when the holder has been defined by a Migrate event
+    migrated = models.BooleanField(default=False)
+    
+    # Accumulated time of the closed usage intervals and beginning
+    # of the current one (if the device is on use).
+    running_seconds = models.FloatField(default=0)
+    usage_start = models.DateTimeField(null=True)
+    recycled_on = models.DateTimeField(null=True)
+    # Date of the first register event (used to compute durability)
+    registered_on = models.DateTimeField(null=True)
+    # Increased every time an event affecting the device is stored
+    # (see grd.cache.DevicePayloadCache)
+    version = models.PositiveIntegerField(default=0)
+    
+    class Meta:
+        # devices held by an agent (ordered by device)
+        index_together = [('holder', 'device')]
+    
+    def __str__(self):
+        return "State of %s" % self.device_id
+    
+    @property
+    def recycled(self):
+        return self.recycled_on is not None
+    
+    @property
+    def running_time(self):
+        seconds = self.running_seconds
+        if self.usage_start is not None:
+            # There is no StopUsage event: is the device currently on use?
+            end_date = self.recycled_on or timezone.now()
+            seconds += (end_date - self.usage_start).total_seconds()
+        return seconds
+    
+    def get_durability(self, production_date=None):
+        """Years between the production (or register) and the recycle."""
+        if not self.recycled:
+            raise ValueError("Cannot obtain durability of a device that has "
+                             "not been recycled yet.")
+        
+        if production_date is not None:
+            produced_on = production_date.year
+        elif self.registered_on is not None:
+            produced_on = self.registered_on.year
+        else:
+            raise ValueError("Cannot obtain durability of a device without "
+                             "production date nor register events.")
+        
+        return self.recycled_on.year - produced_on
+
+
+class DeviceCheckpoint(models.Model):
+    """
+    Copy of the projected state of a device after one of its events,
+    so its state at a given date is computed folding only the events
+    stored after the previous checkpoint (see grd.state.get_state_as_of).
+    
+    They are created periodically by the `grd_checkpoints` command.
+    
+    """
+    device = models.ForeignKey('Device', related_name='checkpoints')
+    # position (grdDate, id) of the latest event folded into the state
+    # NOTE events can't be referenced (see grd.partitions)
+    grdDate = models.DateTimeField()
+    event_id = models.IntegerField()
+    # DeviceState.version of the copied state
+    version = models.PositiveIntegerField()
+    
+    parent = models.ForeignKey('Device', null=True, related_name='+')
+    component_ids = ArrayField(models.IntegerField(), default=list)
+    owner_ids = ArrayField(models.IntegerField(), default=list)
+    holder = models.ForeignKey('Agent', null=True, related_name='+')
+    migrated = models.BooleanField(default=False)
+    running_seconds = models.FloatField(default=0)
+    usage_start = models.DateTimeField(null=True)
+    recycled_on = models.DateTimeField(null=True)
+    registered_on = models.DateTimeField(null=True)
+    
+    class Meta:
+        index_together = [('device', 'grdDate', 'event_id')]
+    
+    def __str__(self):
+        return "Checkpoint of %s at %s" % (self.device_id, self.grdDate)
+
+
+class Ownership(models.Model):
+    """
+    Current allocation of a device to a user (see Device.owners).
+    
+    Like DeviceState it is maintained by grd.state.Projector: an
+    Allocate event creates the row and a Deallocate deletes it.
+    
+    """
+    device = models.ForeignKey('Device', related_name='ownerships')
+    owner = models.ForeignKey('AgentUser', related_name='ownerships')
+    # Allocate event which has created the ownership
+    event = models.ForeignKey('Event', related_name='+', db_constraint=False)
+    
+    class Meta:
+        unique_together = ('device', 'owner')
+        # devices allocated to a user (ordered by device)
+        index_together = [('owner', 'device')]
+    
+    def __str__(self):
+        return "%s owned by %s" % (self.device_id, self.owner_id)
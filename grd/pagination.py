@@ -0,0 +1,184 @@
+import base64
+import datetime
+import json
+from collections import OrderedDict
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+def encode_cursor(values):
+    """Encode the position of an item (its ordering values) as a token."""
+    values = [v.isoformat() if isinstance(v, datetime.datetime) else v
+              for v in values]
+    data = json.dumps(values).encode('utf-8')
+    return base64.urlsafe_b64encode(data).decode('ascii')
+
+
+def decode_cursor(token):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(token.encode('ascii'))
+                                  .decode('utf-8'))
+    except (TypeError, ValueError, UnicodeError):
+        raise ValueError("Invalid cursor '%s'." % token)
+    if not isinstance(values, list):
+        raise ValueError("Invalid cursor '%s'." % token)
+    return values
+
+
+def get_position(obj, ordering):
+    if isinstance(obj, dict):  # .values() rows
+        return [obj[field] for field in ordering]
+    return [getattr(obj, field) for field in ordering]
+
+
+def filter_after(queryset, ordering, position):
+    """
+    Filter the items placed after `position` using the (ascending)
+    `ordering`, e.g. for ('grdDate', 'id'):
+        grdDate > X OR (grdDate = X AND id > Y)
+    
+    """
+    if len(position) != len(ordering):
+        raise ValueError("Invalid position %s." % position)
+    
+    condition = Q()
+    for i, field in enumerate(ordering):
+        lookup = Q(**{field + '__gt': position[i]})
+        for previous, value in zip(ordering[:i], position[:i]):
+            lookup &= Q(**{previous: value})
+        condition |= lookup
+    
+    # Redundant condition which helps the planner to use the index of
+    # the ordering, e.g. (grdDate, id) of the events (migration 0016)
+    first = Q(**{ordering[0] + '__gte': position[0]})
+    return queryset.filter(first, condition)
+
+
+def iterate_chunks_after(queryset, ordering, position=None, chunk_size=500):
+    """
+    Iterate over the chunks (lists) of items placed after `position`,
+    so the memory usage doesn't depend on the number of items.
+    
+    """
+    queryset = queryset.order_by(*ordering)
+    while True:
+        chunk = queryset
+        if position is not None:
+            chunk = filter_after(queryset, ordering, position)
+        chunk = list(chunk[:chunk_size])
+        if chunk:
+            yield chunk
+        if len(chunk) < chunk_size:
+            return
+        position = get_position(chunk[-1], ordering)
+
+
+def iterate_after(queryset, ordering, position=None, chunk_size=500):
+    """Iterate over the items placed after `position` (see above)."""
+    for chunk in iterate_chunks_after(queryset, ordering, position,
+                                      chunk_size):
+        for obj in chunk:
+            yield obj
+
+
+class KeysetPagination(PageNumberPagination):
+    """
+    Page number pagination which also provides a keyset (cursor) mode.
+    
+    If the `cursor` parameter is provided (empty for the first page)
+    the items are filtered using the position of the last item of the
+    previous page instead of an OFFSET, so deep pages cost the same as
+    the first one. The total count is only computed on demand
+    (`count=true`). If `keyset_only` is True the keyset mode is always
+    used.
+    
+    """
+    cursor_query_param = 'cursor'
+    count_query_param = 'count'
+    ordering = ('id',)
+    keyset_only = False
+    
+    keyset = False
+    
+    def paginate_queryset(self, queryset, request, view=None):
+        if not self.keyset_only and \
+           self.cursor_query_param not in request.query_params:
+            self.keyset = False
+            return super(KeysetPagination, self).paginate_queryset(
+                queryset, request, view=view)
+        
+        self.keyset = True
+        self.display_page_controls = False
+        self.request = request
+        
+        page_size = self.get_page_size(request)
+        if not page_size:
+            return None
+        
+        if request.query_params.get(self.count_query_param) in ['true', '1']:
+            self.count = queryset.count()
+        else:
+            self.count = None
+        
+        queryset = queryset.order_by(*self.ordering)
+        token = request.query_params.get(self.cursor_query_param, '')
+        try:
+            if token:
+                position = decode_cursor(token)
+                queryset = filter_after(queryset, self.ordering, position)
+            # fetch one extra item to know if there is a next page
+            results = list(queryset[:page_size + 1])
+        except (ValueError, ValidationError):
+            raise NotFound("Invalid cursor '%s'." % token)
+        if len(results) > page_size:
+            results = results[:page_size]
+            self.next_cursor = encode_cursor(
+                get_position(results[-1], self.ordering)
+            )
+        else:
+            self.next_cursor = None
+        return results
+    
+    def get_count(self):
+        """Total number of items (None if it hasn't been computed)."""
+        if not self.keyset:
+            return self.page.paginator.count
+        return self.count
+    
+    def get_next_link(self):
+        if not self.keyset:
+            return super(KeysetPagination, self).get_next_link()
+        if self.next_cursor is None:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param,
+                                   self.next_cursor)
+    
+    def get_paginated_response(self, data):
+        if not self.keyset:
+            return super(KeysetPagination, self).get_paginated_response(data)
+        
+        content = OrderedDict()
+        if self.count is not None:
+            content['count'] = self.count
+        content['next'] = self.get_next_link()
+        content['results'] = data
+        return Response(content)
+
+
+class DevicePagination(KeysetPagination):
+    ordering = ('id',)
+
+
+class HeldDevicePagination(DevicePagination):
+    # NOTE an agent can hold millions of devices
+    keyset_only = True
+
+
+class EventPagination(KeysetPagination):
+    ordering = ('grdDate', 'id')
@@ -0,0 +1,230 @@
+"""
+Partitioning of the event log by grdDate (one partition per month).
+
+Migration 0014 converts grd_event into a table partitioned by range of
+grdDate (PostgreSQL 12 or newer): the existing table is kept as the
+partition of the history (until the next month), new events are
+stored on monthly partitions and the events without partition on the
+default one. The `grd_partitions` command creates the partitions of
+the following months and detaches the old ones.
+
+The primary key of a partitioned table must include the partition key
+so it becomes (id, grdDate) and the events can't be referenced by
+foreign keys: the ones of the components, location and ownership are
+dropped on every server by migration 0018 (see drop_references), so
+the schema doesn't depend on the version of PostgreSQL. Queries which
+filter by grdDate (e.g. the keyset pagination) only scan the partitions
+of the range. The feed and the export are ordered by logDate, which
+isn't the partition key: they merge the (logDate, id) index of every
+partition.
+
+The history isn't split: it holds every event stored until the month
+after the migration (and the imported ones registered before), so it
+is only detached once all of them can be. To split it, in a single
+transaction, detach it (DETACH PARTITION), create and attach the
+monthly partitions of its range (as create_partitions does), copy its
+rows into grd_event (INSERT INTO "grd_event" SELECT * FROM
+"grd_event_history", which routes them to the new partitions) and drop
+it. The events are rewritten, so it takes as long as copying the
+table and blocks the writes of events meanwhile.
+
+"""
+import hashlib
+import re
+
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+
+TABLE = 'grd_event'
+HISTORY = 'grd_event_history'
+DEFAULT = 'grd_event_default'
+
+# Partitioned tables with primary keys, indexes and foreign keys which
+# are attached to the equivalent ones of the partitions.
+MIN_VERSION = 120000
+
+
+def is_supported(connection):
+    return connection.vendor == 'postgresql' and \
+        connection.pg_version >= MIN_VERSION
+
+
+def is_partitioned(cursor):
+    cursor.execute('SELECT relkind FROM pg_class WHERE relname = %s', [TABLE])
+    row = cursor.fetchone()
+    return row is not None and row[0] == 'p'
+
+
+def get_month(date):
+    """First instant (UTC) of the month of the date."""
+    date = date.astimezone(timezone.utc)
+    return date.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def add_months(date, months):
+    month = date.month - 1 + months
+    return date.replace(year=date.year + month // 12, month=month % 12 + 1)
+
+
+def get_partition_name(start):
+    return '%s_p%04d%02d' % (TABLE, start.year, start.month)
+
+
+def get_partitions(cursor):
+    """
+    Return the partitions of the events ordered by their range
+    [(name, start, end)]. The bounds are None when unbounded (history)
+    and both are None for the default partition.
+    
+    """
+    cursor.execute(
+        'SELECT c."relname", pg_get_expr(c."relpartbound", c."oid") '
+        'FROM pg_inherits i JOIN pg_class c ON c."oid" = i."inhrelid" '
+        'WHERE i."inhparent" = %s::regclass', [TABLE]
+    )
+    partitions = []
+    for name, bound in cursor.fetchall():
+        match = re.search(r'FROM \((.+)\) TO \((.+)\)', bound)
+        start = end = None
+        if match is not None:
+            start, end = [parse_datetime(value.strip("'"))
+                          for value in match.groups()]
+        partitions.append((name, start, end))
+    # NOTE the default partition (without bounds) is the last one
+    partitions.sort(key=lambda p: (p[2] is None, p[2]))
+    return partitions
+
+
+def drop_references(cursor, table=TABLE):
+    """Drop the foreign keys that reference the table."""
+    cursor.execute(
+        "SELECT conrelid::regclass, conname FROM pg_constraint "
+        "WHERE contype = 'f' AND confrelid = %s::regclass", [table]
+    )
+    for referencing, name in cursor.fetchall():
+        cursor.execute('ALTER TABLE %s DROP CONSTRAINT "%s"' %
+                       (referencing, name))
+
+
+def partition_events(cursor, months=3):
+    """
+    Convert grd_event into a partitioned table keeping the current one
+    as the partition of the history (NOTE the data is not copied).
+    
+    """
+    cursor.execute('ALTER TABLE "%s" RENAME TO "%s"' % (TABLE, HISTORY))
+    cursor.execute("SELECT pg_get_serial_sequence(%s, 'id')", [HISTORY])
+    sequence = cursor.fetchone()[0]
+    
+    # The unique key of the events will include grdDate, so they can't
+    # be referenced by foreign keys anymore.
+    drop_references(cursor, HISTORY)
+    
+    cursor.execute(
+        "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint "
+        "WHERE contype = 'f' AND conrelid = %s::regclass", [HISTORY]
+    )
+    foreign_keys = cursor.fetchall()
+    cursor.execute(
+        "SELECT conname FROM pg_constraint "
+        "WHERE contype = 'p' AND conrelid = %s::regclass", [HISTORY]
+    )
+    primary_key = cursor.fetchone()[0]
+    cursor.execute(
+        "SELECT indexname, indexdef FROM pg_indexes WHERE tablename = %s "
+        "AND indexdef NOT LIKE 'CREATE UNIQUE INDEX%%'", [HISTORY]
+    )
+    indexes = cursor.fetchall()
+    
+    cursor.execute(
+        'CREATE TABLE "%s" (LIKE "%s" INCLUDING DEFAULTS) '
+        'PARTITION BY RANGE ("grdDate")' % (TABLE, HISTORY)
+    )
+    cursor.execute('ALTER SEQUENCE %s OWNED BY "%s"."id"' % (sequence, TABLE))
+    
+    # the history includes the current month (the events being stored)
+    cursor.execute('SELECT MAX("grdDate") FROM "%s"' % HISTORY)
+    latest = cursor.fetchone()[0] or timezone.now()
+    boundary = add_months(get_month(max(latest, timezone.now())), 1)
+    cursor.execute('CREATE UNIQUE INDEX "%s_id_grdDate" ON "%s" '
+                   '("id", "grdDate")' % (HISTORY, HISTORY))
+    cursor.execute('ALTER TABLE "%s" ATTACH PARTITION "%s" '
+                   'FOR VALUES FROM (MINVALUE) TO (%%s)' % (TABLE, HISTORY),
+                   [boundary])
+    
+    # the names of the constraints and indexes are kept by the parent
+    cursor.execute('ALTER TABLE "%s" RENAME CONSTRAINT "%s" TO "%s_pkey"' %
+                   (HISTORY, primary_key, HISTORY))
+    cursor.execute('ALTER TABLE "%s" ADD CONSTRAINT "%s" '
+                   'PRIMARY KEY ("id", "grdDate")' % (TABLE, primary_key))
+    for name, definition in foreign_keys:
+        cursor.execute('ALTER TABLE "%s" ADD CONSTRAINT "%s" %s' %
+                       (TABLE, name, definition))
+    for name, definition in indexes:
+        suffix = hashlib.md5(name.encode('utf-8')).hexdigest()[:8]
+        cursor.execute('ALTER INDEX "%s" RENAME TO "%s_%s"' %
+                       (name, HISTORY, suffix))
+        # the equivalent index of the history is attached (not rebuilt)
+        definition = re.sub(r' ON (ONLY )?(\S+\.)?"?%s"? ' % HISTORY,
+                            ' ON "%s" ' % TABLE, definition)
+        cursor.execute(definition)
+    
+    cursor.execute('CREATE TABLE "%s" PARTITION OF "%s" DEFAULT' %
+                   (DEFAULT, TABLE))
+    create_partitions(cursor, months)
+
+
+def create_partitions(cursor, months=3):
+    """
+    Create the partitions of the following `months` (and the current
+    one). Return the names of the created partitions.
+    
+    """
+    partitions = get_partitions(cursor)
+    ends = [end for _, _, end in partitions if end is not None]
+    start = max(ends) if ends else get_month(timezone.now())
+    until = add_months(get_month(timezone.now()), months + 1)
+    
+    created = []
+    while start < until:
+        end = add_months(start, 1)
+        name = get_partition_name(start)
+        # the events of the range stored on the default partition are
+        # moved before attaching the new one
+        cursor.execute('CREATE TABLE "%s" (LIKE "%s" INCLUDING DEFAULTS)' %
+                       (name, TABLE))
+        cursor.execute(
+            'WITH "moved" AS (DELETE FROM "%s" WHERE "grdDate" >= %%s '
+            'AND "grdDate" < %%s RETURNING *) '
+            'INSERT INTO "%s" SELECT * FROM "moved"' % (DEFAULT, name),
+            [start, end]
+        )
+        cursor.execute('ALTER TABLE "%s" ATTACH PARTITION "%s" '
+                       'FOR VALUES FROM (%%s) TO (%%s)' % (TABLE, name),
+                       [start, end])
+        created.append(name)
+        start = end
+    return created
+
+
+def detach_partitions(cursor, before, drop=False):
+    """
+    Detach (or drop) the partitions whose events were all stored
+    before the date. Return the names of the detached partitions.
+    
+    WARNING the detached events aren't included on the event log
+    anymore although they can be referenced by the components and the
+    projected state of the devices.
+    
+    """
+    detached = []
+    for name, _, end in get_partitions(cursor):
+        if end is None or end > before:
+            continue
+        cursor.execute('ALTER TABLE "%s" DETACH PARTITION "%s"' %
+                       (TABLE, name))
+        if drop:
+            cursor.execute('DROP TABLE "%s"' % name)
+        detached.append(name)
+    return detached
@@ -1,7 +1,10 @@
 from django.contrib.auth import get_user_model
+from django.db import transaction
 from rest_framework import serializers
 
+from .geo import get_point
 from .models import Agent, AgentUser, Device, Event, Location
+from .state import Projector
 
 
 User = get_user_model()
@@ -72,10 +75,18 @@ class DeviceSerializer(serializers.HyperlinkedModelSerializer):
 
 
 class DeviceMetricsSerializer(serializers.HyperlinkedModelSerializer):
+    durability = serializers.SerializerMethodField()
+    
     class Meta:
         model = Device
-        fields = ('url', 'running_time')
+        fields = ('url', 'running_time', 'durability')
         read_only_fields = ('url', 'running_time')
+    
+    def get_durability(self, obj):
+        try:
+            return obj.durability
+        except ValueError:  # the device has not been recycled yet
+            return None
 
 
 class LocationSerializer(serializers.ModelSerializer):
@@ -93,6 +104,7 @@ class EventSerializer(serializers.HyperlinkedModelSerializer):
     owner = serializers.SlugRelatedField(slug_field='url', read_only=True)
     to = serializers.HyperlinkedRelatedField(
         read_only=True,
+        source='to_agent',
         view_name='agent-detail'
     )
     
@@ -121,28 +133,63 @@ class RegisterSerializer(serializers.ModelSerializer):
         # create devices and events
         data = self.validated_data
         
-        dev = DeviceRegisterSerializer().create(data.pop('device'))
-        event = dev.events.create(type=Event.REGISTER, agent=agent,
-                                  date=data.get('date', None),
-                                  dhDate=data['dhDate'],
-                                  byUser=data['byUser'])
-        
-        for device_data in data['components']:
-            event.components.add(
-                DeviceRegisterSerializer().create(device_data)
-            )
-        
-        # TODO refactor location creation
-        location = LocationSerializer(data=data.get('location', None))
-        if location.is_valid():
-            location.validated_data['event_id'] = event.pk
-            location.create(location.validated_data)
+        with transaction.atomic():
+            dev = DeviceRegisterSerializer().create(data.pop('device'))
+            components = [DeviceRegisterSerializer().create(device_data)
+                          for device_data in data['components']]
+            component_ids = [component.pk for component in components]
+            
+            projector = Projector()
+            projector.load([dev.pk] + component_ids)
+            
+            event = dev.events.create(type=Event.REGISTER, agent=agent,
+                                      date=data.get('date', None),
+                                      dhDate=data['dhDate'],
+                                      byUser=data['byUser'],
+                                      geo=get_point(data.get('location')))
+            event.components.add(*components)
+            
+            # TODO refactor location creation
+            location = LocationSerializer(data=data.get('location', None))
+            if location.is_valid():
+                location.validated_data['event_id'] = event.pk
+                location.create(location.validated_data)
+            
+            projector.apply(event, component_ids)
+            projector.save()
         
         return event
 
 
+class DeviceSlugRelatedField(serializers.SlugRelatedField):
+    """
+    Device related field which looks up first the devices provided by
+    the context as 'devices_by_hid' (e.g. resolved for a whole batch).
+    
+    """
+    def to_internal_value(self, data):
+        devices = self.context.get('devices_by_hid', {})
+        if isinstance(data, str) and data in devices:
+            return devices[data]
+        return super(DeviceSlugRelatedField, self).to_internal_value(data)
+
+
+class AgentHyperlinkedRelatedField(serializers.HyperlinkedRelatedField):
+    """
+    Agent related field which looks up first the agents provided by
+    the context as 'agents_by_url' (e.g. resolved for a whole batch).
+    
+    """
+    def to_internal_value(self, data):
+        agents = self.context.get('agents_by_url', {})
+        if isinstance(data, str) and data in agents:
+            return agents[data]
+        return super(AgentHyperlinkedRelatedField,
+                     self).to_internal_value(data)
+
+
 class EventWritableSerializer(serializers.ModelSerializer):
-    components = serializers.SlugRelatedField(
+    components = DeviceSlugRelatedField(
         many=True,
         default=[],
         queryset=Device.objects.all(),
@@ -156,10 +203,20 @@ class EventWritableSerializer(serializers.ModelSerializer):
     
     def create(self, validated_data):
         location_data = validated_data.pop('location', None)
-        event = super(EventWritableSerializer, self).create(validated_data)
+        validated_data['geo'] = get_point(location_data)
+        component_ids = [c.pk for c in validated_data.get('components', [])]
         
-        if location_data is not None:
-            Location.objects.create(event=event, **location_data)
+        with transaction.atomic():
+            projector = Projector()
+            projector.load([validated_data['device'].pk] + component_ids)
+            
+            event = super(EventWritableSerializer, self).create(validated_data)
+            
+            if location_data is not None:
+                Location.objects.create(event=event, **location_data)
+            
+            projector.apply(event, component_ids)
+            projector.save()
         return event
 
 
@@ -172,11 +229,14 @@ class AllocateSerializer(EventWritableSerializer):
     
     def validate_owner(self, value):
         device = self.context['device']
-        if value in device.owners:
+        if device.has_owner(value):
             raise serializers.ValidationError(
                 "'%s' is already allocated to '%s'." % (device, value)
             )
-        agent_user, _ = AgentUser.objects.get_or_create(url=value)
+        # NOTE the owners can be provided by the context as 'owners_by_url'
+        agent_user = self.context.get('owners_by_url', {}).get(value, None)
+        if agent_user is None:
+            agent_user, _ = AgentUser.objects.get_or_create(url=value)
         return agent_user
     
     def to_internal_value(self, data):
@@ -191,12 +251,15 @@ class DeallocateSerializer(AllocateSerializer):
     
     def validate_owner(self, value):
         device = self.context['device']
-        if value not in device.owners:
+        if not device.has_owner(value):
             raise serializers.ValidationError(
                 "'%s' is not allocated to '%s'." % (device, value)
             )
         
-        return AgentUser.objects.get(url=value)
+        agent_user = self.context.get('owners_by_url', {}).get(value, None)
+        if agent_user is None:
+            agent_user = AgentUser.objects.get(url=value)
+        return agent_user
     
     def to_internal_value(self, data):
         # translate 'from' --> 'owner'
@@ -218,7 +281,7 @@ class ReceiveSerializer(EventWritableSerializer):
     
     def validate_receiver(self, value):
         device = self.context['device']
-        if value not in device.owners:
+        if not device.has_owner(value):
             raise serializers.ValidationError(
                 "'%s' is not allocated to '%s'." % (device, value)
             )
@@ -227,7 +290,8 @@ class ReceiveSerializer(EventWritableSerializer):
 
 
 class MigrateSerializer(EventWritableSerializer):
-    to = serializers.HyperlinkedRelatedField(
+    to = AgentHyperlinkedRelatedField(
+        source='to_agent',
         view_name='agent-detail',
         queryset=Agent.objects.all(),
     )
@@ -235,13 +299,6 @@ class MigrateSerializer(EventWritableSerializer):
     class Meta:
         model = Event
         fields = ('date', 'dhDate', 'byUser', 'components', 'to', 'location')
-    
-    def save(self, **kwargs):
-        to = self.validated_data.pop('to')
-        # convert all HStore data to string
-        self.validated_data['data'] = {'to': str(to.pk)}
-        
-        return super(MigrateSerializer, self).save(**kwargs)
 
 
 class AddSerializer(EventWritableSerializer):
@@ -249,8 +306,9 @@ class AddSerializer(EventWritableSerializer):
         pass
     
     def validate_components(self, value):
+        parents = Device.objects.get_parents(value)
         for device in value:
-            if device.parent is not None:
+            if parents[device.pk] is not None:
                 raise serializers.ValidationError(
                     "Device '%s' already has a parent." % device
                 )
@@ -264,8 +322,9 @@ class RemoveSerializer(EventWritableSerializer):
     def validate(self, data):
         device = self.context['device']
         
+        parents = Device.objects.get_parents(data['components'])
         for component in data['components']:
-            if component.parent != device:
+            if parents[component.pk] != device.pk:
                 raise serializers.ValidationError(
                     "Device '%s' is not a component of '%s'." % (component, device)
                 )
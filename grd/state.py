@@ -0,0 +1,623 @@
+"""
+Projection of the devices' state from the event log.
+
+The state of a device (its components, parent, owners, holder and
+usage) is defined by its whole history of events. Instead of replaying
+that history on every read, the Projector folds each new event into
+the stored DeviceState (and Ownership) of the devices that it affects.
+
+Usage (inside a transaction):
+    projector = Projector()
+    projector.load(device_ids)  # BEFORE inserting the event
+    event = Event.objects.create(...)
+    projector.apply(event, component_ids)
+    projector.save()
+
+Loading the devices takes a lock on them until the end of the
+transaction, so concurrent writers of the same device are serialized
+and each one folds its events into the state saved by the previous one.
+
+"""
+import functools
+import operator
+from collections import defaultdict
+
+from django.db import connection
+from django.db.models import F, Q
+
+from .models import DeviceCheckpoint, DeviceState, Event, Ownership
+from .pagination import filter_after
+
+
+# First key of the (transaction level) advisory locks of the projection,
+# the second one is the id of the device.
+LOCK_CLASS = 4730
+
+
+def lock_devices(device_ids):
+    """Lock the projection of the devices until the transaction ends."""
+    if not device_ids:
+        return
+    # NOTE the locks are taken in order to avoid deadlocks
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT pg_advisory_xact_lock(%s, "id") '
+            'FROM unnest(%s::integer[]) "id"',
+            [LOCK_CLASS, sorted(device_ids)]
+        )
+
+
+class DeviceFold(object):
+    """In-memory state of a device which events are folded into."""
+    
+    FIELDS = ('parent_id', 'holder_id', 'migrated', 'running_seconds',
+              'usage_start', 'recycled_on', 'registered_on')
+    
+    def __init__(self, device_id, stored=False):
+        self.device_id = device_id
+        self.stored = stored  # exists a DeviceState row?
+        
+        self.parent_id = None
+        self.component_ids = []
+        self.owner_ids = []
+        self.owner_events = {}  # {owner_id: allocate event id}
+        self.holder_id = None
+        self.migrated = False
+        self.running_seconds = 0.0
+        self.usage_start = None
+        self.recycled_on = None
+        self.registered_on = None
+        
+        # Add and Remove events of the device in order [(type, ids)],
+        # None if they haven't been loaded yet.
+        self.component_changes = None
+        
+        # Components and owners stored (in order of their rows), None
+        # if they are unknown.
+        self.stored_component_ids = None if stored else []
+        self.stored_owner_ids = None if stored else []
+    
+    @classmethod
+    def from_state(cls, state):
+        fold = cls(state.device_id, stored=True)
+        for field in cls.FIELDS:
+            setattr(fold, field, getattr(state, field))
+        return fold
+    
+    @classmethod
+    def from_checkpoint(cls, checkpoint):
+        fold = cls(checkpoint.device_id)
+        for field in cls.FIELDS:
+            setattr(fold, field, getattr(checkpoint, field))
+        fold.component_ids = list(checkpoint.component_ids)
+        fold.owner_ids = list(checkpoint.owner_ids)
+        return fold
+    
+    def values(self):
+        return dict((field, getattr(self, field)) for field in self.FIELDS)
+
+
+class Projector(object):
+    # Events that modify the relation between devices.
+    COMPONENT_EVENTS = [Event.REGISTER, Event.ADD, Event.REMOVE]
+    
+    def __init__(self):
+        self.folds = {}
+        self.touched = set()
+    
+    def load(self, device_ids, new_ids=(), rebuild=False):
+        """
+        Load the state of the devices that are going to be affected
+        by the events that will be applied.
+        
+        Devices without stored state are projected from the event log
+        so this method should be called BEFORE inserting the events.
+        Devices on `new_ids` are known to have no events at all.
+        If `rebuild` is True the stored state is ignored.
+        
+        The devices are locked until the end of the transaction (see
+        lock_devices) so it must be called inside one.
+        
+        """
+        pending = set(device_ids) - set(self.folds)
+        lock_devices(pending)
+        
+        for device_id in set(new_ids) & pending:
+            self.folds[device_id] = DeviceFold(device_id)
+            self.folds[device_id].component_changes = []
+            self.touched.add(device_id)
+        pending -= set(new_ids)
+        
+        if not pending:
+            return
+        
+        if rebuild:
+            stored = set(DeviceState.objects.filter(
+                pk__in=pending).values_list('pk', flat=True))
+        else:
+            loaded = []
+            for state in DeviceState.objects.filter(pk__in=pending):
+                self.folds[state.pk] = DeviceFold.from_state(state)
+                loaded.append(state.pk)
+            pending -= set(loaded)
+            self.load_components(loaded)
+            self.load_owners(loaded)
+            stored = set()
+        
+        if pending:
+            self.replay(pending, stored)
+    
+    def load_components(self, device_ids):
+        if not device_ids:
+            return
+        through = DeviceState.components.through.objects.filter(
+            devicestate_id__in=device_ids).order_by('pk')
+        for device_id, component_id in through.values_list('devicestate_id',
+                                                           'device_id'):
+            self.folds[device_id].component_ids.append(component_id)
+        for device_id in device_ids:
+            fold = self.folds[device_id]
+            fold.stored_component_ids = list(fold.component_ids)
+    
+    def load_owners(self, device_ids):
+        if not device_ids:
+            return
+        ownerships = Ownership.objects.filter(device__in=device_ids)
+        ownerships = ownerships.order_by('pk')
+        for device_id, owner_id, event_id in ownerships.values_list(
+                'device_id', 'owner_id', 'event_id'):
+            fold = self.folds[device_id]
+            fold.owner_ids.append(owner_id)
+            fold.owner_events[owner_id] = event_id
+        for device_id in device_ids:
+            fold = self.folds[device_id]
+            fold.stored_owner_ids = list(fold.owner_ids)
+    
+    def replay(self, device_ids, stored=()):
+        """Project the state of the devices from the event log."""
+        for device_id in device_ids:
+            fold = DeviceFold(device_id, stored=device_id in stored)
+            fold.component_changes = []
+            self.folds[device_id] = fold
+            self.touched.add(device_id)
+        
+        # NOTE events stored at once share their grdDate (e.g. the ones
+        # of grd_import) so they are ordered by id too.
+        events = Event.objects.filter(
+            Q(device__in=list(device_ids)) |
+            Q(components__in=list(device_ids))
+        ).distinct().order_by('grdDate', 'id').prefetch_related('components')
+        
+        for event in events:
+            component_ids = [c.pk for c in event.components.all()]
+            self.apply(event, component_ids, only=device_ids)
+    
+    def load_component_changes(self, device_ids):
+        """Load at once the Add and Remove events of the devices."""
+        folds = [self.folds[pk] for pk in device_ids
+                 if self.folds[pk].component_changes is None]
+        if not folds:
+            return
+        
+        for fold in folds:
+            fold.component_changes = []
+        events = Event.objects.filter(
+            device__in=[fold.device_id for fold in folds],
+            type__in=[Event.ADD, Event.REMOVE]
+        ).order_by('grdDate', 'id').prefetch_related('components')
+        for event in events:
+            self.folds[event.device_id].component_changes.append(
+                (event.type, [c.pk for c in event.components.all()])
+            )
+    
+    def apply(self, event, component_ids=None, only=None):
+        """
+        Fold the event into the state of its device and components.
+        If `only` is defined just the state of these devices is updated.
+        
+        """
+        if component_ids is None:
+            component_ids = list(event.components.values_list('pk', flat=True))
+        # NOTE the components of a request can be repeated (e.g. devices
+        # without hid) but they are stored once (see event.components)
+        component_ids = [pk for i, pk in enumerate(component_ids)
+                         if pk not in component_ids[:i]]
+        
+        if only is None or event.device_id in only:
+            fold = self.folds[event.device_id]
+            self.apply_to_device(fold, event, component_ids)
+            self.touched.add(fold.device_id)
+        
+        if event.type in self.COMPONENT_EVENTS:
+            for component_id in component_ids:
+                if only is not None and component_id not in only:
+                    continue
+                fold = self.folds[component_id]
+                if event.type == Event.REMOVE:
+                    fold.parent_id = None
+                else:
+                    fold.parent_id = event.device_id
+                self.touched.add(component_id)
+    
+    def apply_to_device(self, fold, event, component_ids):
+        if event.type == Event.REGISTER:
+            # The latest register defines the components but the add
+            # and remove events are also taken into account because
+            # the order of the operations affects the final result.
+            if fold.component_changes is None:
+                self.load_component_changes([fold.device_id])
+            components = list(component_ids)
+            for change, ids in fold.component_changes:
+                components = self.change_components(components, change, ids)
+            fold.component_ids = components
+            if not fold.migrated:
+                fold.holder_id = event.agent_id
+            # NOTE Register and Recycle don't require a date: they
+            # happened when they were registered at the latest.
+            if fold.registered_on is None:
+                fold.registered_on = event.date or event.grdDate
+        
+        elif event.type in [Event.ADD, Event.REMOVE]:
+            fold.component_ids = self.change_components(
+                fold.component_ids, event.type, component_ids
+            )
+            if fold.component_changes is not None:
+                fold.component_changes.append((event.type, component_ids))
+        
+        elif event.type == Event.MIGRATE:
+            fold.holder_id = event.to_agent_id
+            fold.migrated = True
+        
+        elif event.type == Event.ALLOCATE:
+            # NOTE an imported log can allocate the device twice to the
+            # same owner (the ownership is kept by the first event)
+            if event.owner_id not in fold.owner_ids:
+                fold.owner_ids.append(event.owner_id)
+                fold.owner_events[event.owner_id] = event.pk
+        
+        elif event.type == Event.DEALLOCATE:
+            if event.owner_id in fold.owner_ids:
+                fold.owner_ids.remove(event.owner_id)
+                fold.owner_events.pop(event.owner_id, None)
+        
+        elif event.type == Event.USAGEPROOF:
+            fold.usage_start = event.date
+        
+        elif event.type == Event.STOPUSAGE:
+            if fold.usage_start is not None and event.date is not None:
+                delta = event.date - fold.usage_start
+                fold.running_seconds += delta.total_seconds()
+            fold.usage_start = None
+        
+        elif event.type == Event.RECYCLE:
+            if fold.recycled_on is None:
+                fold.recycled_on = event.date or event.grdDate
+    
+    @staticmethod
+    def change_components(components, change, ids):
+        if change == Event.ADD:
+            return components + [pk for pk in ids if pk not in components]
+        # Event.REMOVE
+        return [pk for pk in components if pk not in ids]
+    
+    def save(self):
+        """Store the state of the devices affected by the events."""
+        folds = [self.folds[pk] for pk in self.touched]
+        if not folds:
+            return
+        
+        # NOTE the state may have been stored by another transaction
+        # after being read (e.g. by a writer that doesn't lock the
+        # devices) so it's updated instead of inserted twice.
+        new = [fold.device_id for fold in folds if not fold.stored]
+        if new:
+            for pk in DeviceState.objects.filter(pk__in=new).values_list(
+                    'pk', flat=True):
+                fold = self.folds[pk]
+                fold.stored = True
+                fold.stored_component_ids = fold.stored_owner_ids = None
+        DeviceState.objects.bulk_create([
+            DeviceState(device_id=fold.device_id, **fold.values())
+            for fold in folds if not fold.stored
+        ])
+        
+        # Group states with the same values to reduce the number of
+        # queries (e.g. the components of a registered device).
+        updates = defaultdict(list)
+        for fold in folds:
+            if fold.stored:
+                values = tuple(sorted(fold.values().items()))
+                updates[values].append(fold.device_id)
+        for values, pks in updates.items():
+            DeviceState.objects.filter(pk__in=pks).update(
+                version=F('version') + 1, **dict(values)
+            )
+        
+        # Only the rows of the components and owners that have changed
+        # are written (e.g. a UsageProof doesn't write any).
+        through = DeviceState.components.through
+        inserted = self.write_rows(
+            folds, through, 'devicestate_id', 'device_id',
+            'stored_component_ids', 'component_ids'
+        )
+        through.objects.bulk_create([
+            through(devicestate_id=fold.device_id, device_id=pk)
+            for fold, pk in inserted
+        ])
+        
+        # NOTE the rows are created in order of allocation (see owners)
+        inserted = self.write_rows(folds, Ownership, 'device_id', 'owner_id',
+                                   'stored_owner_ids', 'owner_ids')
+        Ownership.objects.bulk_create([
+            Ownership(device_id=fold.device_id, owner_id=pk,
+                      event_id=fold.owner_events[pk])
+            for fold, pk in inserted
+        ])
+        
+        for fold in folds:
+            fold.stored = True
+            fold.stored_component_ids = list(fold.component_ids)
+            fold.stored_owner_ids = list(fold.owner_ids)
+        self.touched = set()
+    
+    @staticmethod
+    def diff_rows(stored, current):
+        """
+        Return the ids whose rows have to be deleted (None for all of
+        them) and inserted to store `current` instead of `stored`.
+        The rows are kept in order: if the ones that remain aren't the
+        first of `current` all of them are replaced.
+        
+        """
+        if stored is None:
+            return None, current
+        kept = [pk for pk in stored if pk in current]
+        if current[:len(kept)] != kept:
+            return None, current
+        return [pk for pk in stored if pk not in current], current[len(kept):]
+    
+    def write_rows(self, folds, model, device_field, field, stored, current):
+        """
+        Delete the rows of `model` that the folds don't include anymore
+        and return the (fold, id) of the rows that have to be inserted.
+        
+        """
+        deleted = []
+        inserted = []
+        for fold in folds:
+            ids, new_ids = self.diff_rows(getattr(fold, stored),
+                                          getattr(fold, current))
+            if ids is None:
+                deleted.append(Q(**{device_field: fold.device_id}))
+            elif ids:
+                deleted.append(Q(**{device_field: fold.device_id,
+                                    field + '__in': ids}))
+            inserted += [(fold, pk) for pk in new_ids]
+        if deleted:
+            model.objects.filter(functools.reduce(operator.or_,
+                                                  deleted)).delete()
+        return inserted
+
+
+# Limit of the depth of the hierarchy (guards against cycles)
+MAX_DEPTH = 32
+
+DESCENDANTS_SQL = """
+WITH RECURSIVE "tree"("id", "parent_id", "depth") AS (
+    SELECT %(device)s, NULL::integer, 0
+  UNION ALL
+    SELECT s."device_id", s."parent_id", t."depth" + 1
+    FROM "grd_devicestate" s
+    JOIN "tree" t ON s."parent_id" = t."id"
+    WHERE t."depth" < %(max_depth)s
+)
+SELECT "id", "parent_id", "depth" FROM "tree" ORDER BY "depth", "id"
+"""
+
+ANCESTORS_SQL = """
+WITH RECURSIVE "tree"("id", "parent_id", "depth") AS (
+    SELECT %(device)s, (SELECT "parent_id" FROM "grd_devicestate"
+                        WHERE "device_id" = %(device)s), 0
+  UNION ALL
+    SELECT t."parent_id", s."parent_id", t."depth" + 1
+    FROM "tree" t
+    LEFT JOIN "grd_devicestate" s ON s."device_id" = t."parent_id"
+    WHERE t."parent_id" IS NOT NULL AND t."depth" < %(max_depth)s
+)
+SELECT "id", "parent_id", "depth" FROM "tree" ORDER BY "depth"
+"""
+
+
+def query_hierarchy(sql, device_id):
+    """
+    Run the recursive query and return the rows (id, parent_id, depth).
+    
+    NOTE the hierarchy is read from the projected state: devices whose
+    state hasn't been projected yet (see `grd_rebuild_state --missing`)
+    have neither components nor parent.
+    
+    """
+    params = {'device': device_id, 'max_depth': MAX_DEPTH}
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return cursor.fetchall()
+
+
+def get_descendants(device_id):
+    """
+    Devices whose current parent is the device, recursively, as a list
+    of (id, parent_id, depth) ordered by depth (the device has depth 0).
+    Like the ancestors, they follow the parent of the devices: a
+    component registered later in another device is only its
+    descendant.
+    
+    """
+    return query_hierarchy(DESCENDANTS_SQL, device_id)
+
+
+def get_ancestors(device_id):
+    """
+    Current parent of the device, recursively, as a list of
+    (id, parent_id, depth) ordered by depth (the device has depth 0).
+    
+    """
+    return query_hierarchy(ANCESTORS_SQL, device_id)
+
+
+# Number of versions of the state between two checkpoints of a device
+CHECKPOINT_INTERVAL = 100
+
+# Copy the state of the devices with CHECKPOINT_INTERVAL new versions
+# since their latest checkpoint. NOTE a single statement reads the state
+# and the position of the latest event consistently.
+CHECKPOINTS_SQL = """
+INSERT INTO "grd_devicecheckpoint" (
+    "device_id", "grdDate", "event_id", "version", "parent_id",
+    "component_ids", "owner_ids", "holder_id", "migrated",
+    "running_seconds", "usage_start", "recycled_on", "registered_on"
+)
+SELECT s."device_id", e."grdDate", e."id", s."version", s."parent_id",
+       ARRAY(SELECT c."device_id" FROM "grd_devicestate_components" c
+             WHERE c."devicestate_id" = s."device_id" ORDER BY c."id"),
+       ARRAY(SELECT o."owner_id" FROM "grd_ownership" o
+             WHERE o."device_id" = s."device_id" ORDER BY o."id"),
+       s."holder_id", s."migrated", s."running_seconds", s."usage_start",
+       s."recycled_on", s."registered_on"
+FROM "grd_devicestate" s
+CROSS JOIN LATERAL (
+    SELECT "grdDate", "id" FROM (
+        SELECT "grdDate", "id" FROM "grd_event"
+        WHERE "device_id" = s."device_id"
+      UNION ALL
+        SELECT e."grdDate", e."id" FROM "grd_event" e
+        JOIN "grd_event_components" c ON c."event_id" = e."id"
+        WHERE c."device_id" = s."device_id"
+    ) related ORDER BY "grdDate" DESC, "id" DESC LIMIT 1
+) e
+WHERE s."device_id" = ANY(%(devices)s)
+AND s."version" >= %(interval)s + COALESCE((
+    SELECT MAX(p."version") FROM "grd_devicecheckpoint" p
+    WHERE p."device_id" = s."device_id"), 0)
+"""
+
+
+def create_checkpoints(device_ids, interval=CHECKPOINT_INTERVAL):
+    """
+    Store a checkpoint of the devices whose state has changed at least
+    `interval` times since their latest one. Return how many were
+    created.
+    
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(CHECKPOINTS_SQL, {'devices': list(device_ids),
+                                         'interval': interval})
+        return cursor.rowcount
+
+
+def rebuild_state(device_ids):
+    """
+    Project again the state of the devices from their whole event log
+    (inside a transaction). Their checkpoints are deleted as they may
+    be copies of the wrong state that is being rebuilt.
+    
+    """
+    projector = Projector()
+    projector.load(device_ids, rebuild=True)
+    projector.save()
+    DeviceCheckpoint.objects.filter(device__in=list(device_ids)).delete()
+
+
+def get_state_as_of(device, date):
+    """
+    Return the state (a DeviceFold) of the device after the events
+    stored until `date` (grdDate), folding the events stored after the
+    latest previous checkpoint instead of its whole history.
+    
+    """
+    ordering = ('grdDate', 'id')
+    events = Event.objects.related_to_device(device).filter(grdDate__lte=date)
+    checkpoint = DeviceCheckpoint.objects.filter(
+        device=device, grdDate__lte=date
+    ).order_by('-grdDate', '-event_id').first()
+    if checkpoint is None:
+        fold = DeviceFold(device.pk)
+        fold.component_changes = []
+    else:
+        fold = DeviceFold.from_checkpoint(checkpoint)
+        events = filter_after(events, ordering,
+                              [checkpoint.grdDate, checkpoint.event_id])
+    events = list(events.prefetch_related('components'))
+    
+    # a Register applies the previous Add and Remove of the device
+    if fold.component_changes is None and any(
+            e.type == Event.REGISTER and e.device_id == device.pk
+            for e in events):
+        changes = Event.objects.filter(
+            Q(grdDate__lt=checkpoint.grdDate) |
+            Q(grdDate=checkpoint.grdDate, id__lte=checkpoint.event_id),
+            device=device, type__in=[Event.ADD, Event.REMOVE]
+        ).order_by(*ordering).prefetch_related('components')
+        fold.component_changes = [(e.type, [c.pk for c in e.components.all()])
+                                  for e in changes]
+    
+    projector = Projector()
+    projector.folds[device.pk] = fold
+    for event in events:
+        component_ids = [c.pk for c in event.components.all()]
+        projector.apply(event, component_ids, only=[device.pk])
+    return fold
+
+
+def verify(device):
+    """
+    Compare the stored state of the device with the result of
+    replaying its events. Return the names of the mismatched fields.
+    
+    """
+    try:
+        state = DeviceState.objects.get(pk=device.pk)
+    except DeviceState.DoesNotExist:
+        return ['state']
+    errors = []
+    
+    if set(c.pk for c in state.components.all()) != \
+       set(c.pk for c in device.replay_components()):
+        errors.append('components')
+    
+    owners = Ownership.objects.filter(device=device)
+    if sorted(owners.values_list('owner__url', flat=True)) != \
+       sorted(device.replay_owners()):
+        errors.append('owners')
+    
+    parent = device.replay_parent()
+    if state.parent_id != (parent.pk if parent is not None else None):
+        errors.append('parent')
+    
+    try:
+        holder = device.replay_holder()
+    except NotImplementedError:
+        holder = None
+    if state.holder_id != (holder.pk if holder is not None else None):
+        errors.append('holder')
+    
+    # NOTE allow some difference because of time spent on computation.
+    if abs(state.running_time - device.replay_running_time()) > 1:
+        errors.append('running_time')
+    
+    recycled = device.events.filter(type=Event.RECYCLE).exists()
+    if state.recycled != recycled:
+        errors.append('recycled')
+    
+    if state.recycled and recycled:
+        try:
+            durability = device.replay_durability()
+        except Event.DoesNotExist:
+            durability = None
+        try:
+            stored = state.get_durability(device.productionDate)
+        except ValueError:
+            stored = None
+        if stored != durability:
+            errors.append('durability')
+    
+    return errors
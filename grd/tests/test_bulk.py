@@ -0,0 +1,198 @@
+from unittest import mock
+from django.contrib.auth import get_user_model
+from rest_framework.test import APITestCase
+from grd.models import Agent, AgentUser, Device, Event, Ownership
+from grd.state import verify
+
+
+User = get_user_model()
+
+
+def register_data(number, components=()):
+    return {
+        'device': {
+            'url': 'http://example.org/device/%d/' % number,
+            'hid': 'XPS13-1111-%d' % number,
+            '@type': 'Computer',
+        },
+        'dhDate': '2015-09-18T12:38:20.604Z',
+        'byUser': 'http://example.org/users/foo',
+        'components': [{
+            'url': 'http://example.org/device/%s/' % component,
+            'hid': 'LED24-Acme-%s' % component,
+            '@type': 'Monitor',
+        } for component in components],
+    }
+
+
+class BulkRegisterTest(APITestCase):
+    def setUp(self):
+        super(BulkRegisterTest, self).setUp()
+        user = User.objects.create_superuser("ereuse", "ereuse@localhost",
+                                             "ereuse")
+        self.agent = Agent.objects.create(name="XSR", user=user)
+        self.client.force_authenticate(user=user)
+    
+    def register(self, items):
+        return self.client.post('/api/devices/register/bulk/', data=items)
+    
+    def test_register_devices(self):
+        items = [register_data(i, components=['%d-1' % i, '%d-2' % i])
+                 for i in range(10)]
+        items[0]['location'] = {'lat': 27.98, 'lon': 86.92}
+        response = self.register(items)
+        self.assertEqual(201, response.status_code, response.content)
+        self.assertEqual(10, len(response.data))
+        
+        self.assertEqual(30, Device.objects.count())
+        self.assertEqual(10, Event.objects.filter(type=Event.REGISTER).count())
+        
+        device = Device.objects.get(hid='XPS13-1111-0')
+        event = device.events.get()
+        self.assertEqual(27.98, event.location.lat)
+        self.assertEqual(2, len(device.components))
+        self.assertEqual(self.agent, device.holder)
+        for component in device.components:
+            self.assertEqual(device, component.parent)
+        
+        for device in Device.objects.all():
+            self.assertEqual([], verify(device))
+    
+    def test_register_already_registered_devices(self):
+        self.assertEqual(201, self.register([register_data(1, ['a'])]).status_code)
+        
+        # a new snapshot of the device with different components
+        response = self.register([register_data(1, ['b']),
+                                  register_data(2, ['a'])])
+        self.assertEqual(201, response.status_code, response.content)
+        self.assertEqual(4, Device.objects.count())
+        
+        device_one = Device.objects.get(hid='XPS13-1111-1')
+        device_two = Device.objects.get(hid='XPS13-1111-2')
+        self.assertEqual(['LED24-Acme-b'], [c.hid for c in device_one.components])
+        self.assertEqual(device_two, Device.objects.get(hid='LED24-Acme-a').parent)
+        for device in Device.objects.all():
+            self.assertEqual([], verify(device))
+    
+    def test_report_errors_per_item(self):
+        invalid = register_data(2)
+        invalid['device']['@type'] = 'foo'
+        duplicated_url = register_data(3)
+        duplicated_url['device']['url'] = 'http://example.org/device/1/'
+        
+        response = self.register([register_data(1), invalid, duplicated_url])
+        self.assertEqual(201, response.status_code, response.content)
+        self.assertIn('event', response.data[0])
+        self.assertIn('errors', response.data[1])
+        self.assertIn('errors', response.data[2])
+        self.assertEqual(1, Device.objects.count())
+    
+    def test_invalid_payload(self):
+        response = self.register({'foo': 'bar'})
+        self.assertEqual(400, response.status_code, response.content)
+
+
+class BulkEventsTest(APITestCase):
+    def setUp(self):
+        super(BulkEventsTest, self).setUp()
+        user = User.objects.create_superuser("ereuse", "ereuse@localhost",
+                                             "ereuse")
+        self.agent = Agent.objects.create(name="XSR", user=user)
+        self.client.force_authenticate(user=user)
+        response = self.client.post('/api/devices/register/bulk/', data=[
+            register_data(1, components=['a']), register_data(2)
+        ])
+        self.assertEqual(201, response.status_code, response.content)
+    
+    def event_data(self, type, device, **kwargs):
+        data = {
+            '@type': type,
+            'device': device,
+            'date': '2015-09-20T12:00:00.000Z',
+            'dhDate': '2015-09-20T12:00:00.000Z',
+            'byUser': 'http://example.org/users/foo',
+        }
+        data.update(kwargs)
+        return data
+    
+    def post_events(self, items):
+        return self.client.post('/api/events/bulk/', data=items)
+    
+    def test_mixed_events(self):
+        alice = 'http://example.org/user/alice/'
+        device_two = Device.objects.get(hid='XPS13-1111-2')
+        response = self.post_events([
+            self.event_data('Allocate', 'XPS13-1111-1', to=alice),
+            self.event_data('Remove', 'XPS13-1111-1',
+                            components=['LED24-Acme-a']),
+            self.event_data('Add', device_two.pk, components=['LED24-Acme-a']),
+            self.event_data('UsageProof', 'http://example.org/device/1/'),
+            self.event_data('StopUsage', 'XPS13-1111-1',
+                            date='2015-09-20T13:00:00.000Z'),
+            self.event_data('Receive', 'XPS13-1111-1', receiver=alice,
+                            receiverType='FinalUser'),
+            self.event_data('Deallocate', 'XPS13-1111-1', **{'from': alice}),
+        ])
+        self.assertEqual(201, response.status_code, response.content)
+        self.assertTrue(all('event' in r for r in response.data), response.data)
+        
+        device_one = Device.objects.get(hid='XPS13-1111-1')
+        component = Device.objects.get(hid='LED24-Acme-a')
+        self.assertEqual([], device_one.owners)
+        self.assertEqual([], device_one.components)
+        self.assertEqual(device_two, component.parent)
+        self.assertEqual(3600, device_one.running_time)
+        for device in Device.objects.all():
+            self.assertEqual([], verify(device))
+    
+    def test_owners_and_agents_resolved_at_once(self):
+        user = User.objects.create_user("other", "other@localhost", "other")
+        other = Agent.objects.create(name="Other", user=user)
+        other_url = 'http://testserver/api/agents/%d/' % other.pk
+        alice = 'http://example.org/user/alice/'
+        bob = 'http://example.org/user/bob/'
+        AgentUser.objects.create(url=bob)
+        
+        # the serializers don't query the owners one by one
+        with mock.patch.object(AgentUser.objects, 'get_or_create',
+                               side_effect=AssertionError), \
+                mock.patch.object(AgentUser.objects, 'get',
+                                  side_effect=AssertionError):
+            response = self.post_events([
+                self.event_data('Allocate', 'XPS13-1111-1', to=alice),
+                self.event_data('Allocate', 'XPS13-1111-2', to=bob),
+                self.event_data('Deallocate', 'XPS13-1111-1',
+                                **{'from': alice}),
+                self.event_data('Migrate', 'XPS13-1111-2', to=other_url),
+            ])
+        self.assertEqual(201, response.status_code, response.content)
+        self.assertTrue(all('event' in r for r in response.data), response.data)
+        
+        device_two = Device.objects.get(hid='XPS13-1111-2')
+        self.assertEqual([bob], device_two.owners)
+        self.assertEqual(other, device_two.holder)
+        self.assertEqual(1, AgentUser.objects.filter(url=alice).count())
+    
+    def test_validation_uses_previous_events(self):
+        alice = 'http://example.org/user/alice/'
+        response = self.post_events([
+            self.event_data('Allocate', 'XPS13-1111-1', to=alice),
+            # already allocated by the previous item
+            self.event_data('Allocate', 'XPS13-1111-1', to=alice),
+            # component not attached anymore
+            self.event_data('Remove', 'XPS13-1111-1',
+                            components=['LED24-Acme-a']),
+            self.event_data('Remove', 'XPS13-1111-1',
+                            components=['LED24-Acme-a']),
+            self.event_data('Register', 'XPS13-1111-1'),
+            self.event_data('Recycle', 'Does-Not-Exist'),
+        ])
+        self.assertEqual(201, response.status_code, response.content)
+        self.assertEqual(['event', 'errors', 'event', 'errors', 'errors',
+                          'errors'],
+                         [list(r.keys())[0] for r in response.data])
+        self.assertEqual(2, Event.objects.exclude(type=Event.REGISTER).count())
+        
+        ownership = Ownership.objects.get()
+        self.assertEqual(alice, ownership.owner.url)
+        self.assertEqual(Event.ALLOCATE, ownership.event.type)
@@ -1,5 +1,6 @@
 from datetime import date, timedelta
 from django.contrib.auth import get_user_model
+from django.core import management
 from django.test import TestCase
 from django.utils import timezone
 from grd.models import Agent, Device, Event
@@ -74,6 +75,18 @@ class ComponentsTest(TestCase):
         )
         event.components.add(self.device_two)
         self.assertIsNone(self.device_two.parent)
+    
+    def test_get_parents(self):
+        devices = [self.device_one, self.device_two]
+        with self.assertNumQueries(2):
+            parents = Device.objects.get_parents(devices)
+        self.assertEqual({self.device_one.pk: None,
+                          self.device_two.pk: self.device_one.pk}, parents)
+        
+        # Projected state
+        management.call_command('grd_rebuild_state', verbosity=0)
+        with self.assertNumQueries(1):
+            self.assertEqual(parents, Device.objects.get_parents(devices))
 
 
 class HolderTest(TestCase):
@@ -103,7 +116,7 @@ class HolderTest(TestCase):
             date="2015-09-08T12:58:20.604Z",
             dhDate="2015-09-08T12:58:20.604Z",
             byUser="http://example.org/users/foo",
-            data={'to': str(self.agent2.pk)}
+            to_agent=to
         )
     
     def test_holder(self):
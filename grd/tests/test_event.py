@@ -1,3 +1,5 @@
+from django.db import connection
+from django.db.models import Q
 from django.test import TestCase
 from django.utils import timezone
 from grd.models import Agent, Device, Event, Location
@@ -52,10 +54,10 @@ class EventTest(TestCase):
         )
         self.assertEqual(None, e.to)
         
-        migrate_to = str(Agent.objects.last().pk)
+        migrate_to = Agent.objects.last()
         e = Event.objects.create(
             type=Event.MIGRATE,
-            data={'to': migrate_to},
+            to_agent=migrate_to,
             date=timezone.now(),
             dhDate=timezone.now(),
             byUser='http://example.org/users/John',
@@ -75,3 +77,41 @@ class EventManagerTest(TestCase):
         qs = Event.objects.related_to_device(device)
         result = qs.values_list('id', flat=True)
         self.assertEqual(len(result), len(set(result)))
+    
+    def test_related_to_device(self):
+        # Same events as filtering by device OR component
+        device = Device.objects.get(pk=1)
+        component = Device.objects.get(pk=2)
+        event = Event.objects.create(
+            type=Event.ADD,
+            dhDate=timezone.now(),
+            byUser='http://example.org/users/John',
+            agent=Agent.objects.first(),
+            device=Device.objects.get(pk=3),
+        )
+        event.components.add(device)
+        
+        for dev in [device, component]:
+            expected = Event.objects.filter(
+                Q(device=dev) | Q(components__in=[dev])
+            ).distinct().order_by('grdDate', 'id')
+            self.assertEqual(list(expected),
+                             list(Event.objects.related_to_device(dev)))
+        
+        # The result is a regular queryset
+        qs = Event.objects.related_to_device(device).filter(type=Event.ADD)
+        self.assertEqual([event], list(qs))
+    
+    def test_committed_until(self):
+        self.assertLessEqual(Event.objects.committed_until(), timezone.now())
+        
+        # a transaction of another session which is writing
+        other = connection.get_new_connection(
+            connection.get_connection_params())
+        try:
+            with other.cursor() as cursor:
+                cursor.execute('SELECT now(), txid_current()')
+                started = cursor.fetchone()[0]
+            self.assertEqual(started, Event.objects.committed_until())
+        finally:
+            other.close()
@@ -0,0 +1,61 @@
+import itertools
+import json
+from django.contrib.auth import get_user_model
+from django.core import management
+from django.utils.six import StringIO
+from rest_framework.test import APITestCase
+from grd.export import EventExporter
+from grd.models import Event
+from grd.pagination import decode_cursor
+
+
+User = get_user_model()
+
+
+class EventExportTest(APITestCase):
+    fixtures = ['agents.json', 'devices.json', 'events.json', 'users.json']
+    
+    def setUp(self):
+        super(EventExportTest, self).setUp()
+        self.client.force_authenticate(user=User.objects.first())
+    
+    def get_export(self, **params):
+        response = self.client.get('/api/events/export.ndjson', params)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual('application/x-ndjson', response['Content-Type'])
+        content = b''.join(response.streaming_content).decode('utf-8')
+        return [json.loads(line) for line in content.splitlines()]
+    
+    def test_same_as_serializer(self):
+        response = self.client.get('/api/events/feed/')
+        content = b''.join(response.streaming_content).decode('utf-8')
+        feed = json.loads(content)
+        self.assertEqual(Event.objects.count(), len(feed['results']))
+        self.assertEqual(feed['results'], self.get_export())
+    
+    def test_resume(self):
+        events = list(EventExporter(chunk_size=2).iterate(Event.objects.all()))
+        
+        exporter = EventExporter(chunk_size=2)
+        first = list(itertools.islice(exporter.iterate(Event.objects.all()), 3))
+        position = decode_cursor(exporter.cursor)
+        rest = list(EventExporter(chunk_size=2).iterate(Event.objects.all(),
+                                                        position))
+        self.assertEqual(events, first + rest)
+        
+        export = self.get_export(since=exporter.cursor)
+        self.assertEqual(len(rest), len(export))
+    
+    def test_invalid_since(self):
+        response = self.client.get('/api/events/export.ndjson',
+                                   {'since': 'foo'})
+        self.assertEqual(400, response.status_code)
+    
+    def test_command(self):
+        stdout, stderr = StringIO(), StringIO()
+        management.call_command('grd_export', stdout=stdout, stderr=stderr,
+                                base_url='http://testserver')
+        lines = stdout.getvalue().splitlines()
+        self.assertEqual(Event.objects.count(), len(lines))
+        self.assertEqual(self.get_export(), [json.loads(l) for l in lines])
+        self.assertIn('--since', stderr.getvalue())
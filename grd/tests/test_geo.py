@@ -0,0 +1,128 @@
+from unittest import mock
+from django.contrib.auth import get_user_model
+from rest_framework.test import APITestCase
+from grd.models import Agent, Device, Event
+from grd.views import EventView
+
+
+User = get_user_model()
+
+BARCELONA = {'lat': 41.3851, 'lon': 2.1734}
+MADRID = {'lat': 40.4168, 'lon': -3.7038}
+# Polygon around Barcelona
+CATALONIA = 'POLYGON((0 40, 3.5 40, 3.5 43, 0 43, 0 40))'
+
+
+class SpatialQueriesTest(APITestCase):
+    def setUp(self):
+        super(SpatialQueriesTest, self).setUp()
+        user = User.objects.create_superuser("ereuse", "ereuse@localhost",
+                                             "ereuse")
+        self.agent = Agent.objects.create(name="XSR", user=user)
+        self.client.force_authenticate(user=user)
+        self.barcelona = self.register_device(1, BARCELONA)
+        self.madrid = self.register_device(2, MADRID)
+    
+    def register_device(self, number, location):
+        data = {
+            'device': {
+                'url': 'http://example.org/device/%d/' % number,
+                'hid': 'XPS13-1111-%d' % number,
+                '@type': 'Computer',
+            },
+            'dhDate': '2015-09-18T12:38:20.604Z',
+            'byUser': 'http://example.org/users/foo',
+            'components': [],
+            'location': location,
+        }
+        response = self.client.post('/api/devices/register/', data=data)
+        self.assertEqual(201, response.status_code, response.content)
+        return Device.objects.get(hid=data['device']['hid'])
+    
+    def get_events(self, **params):
+        response = self.client.get('/api/events/', params)
+        self.assertEqual(200, response.status_code, response.content)
+        return [e['device'] for e in response.data['results']]
+    
+    def test_geo_is_populated(self):
+        event = Event.objects.get(device=self.barcelona)
+        self.assertAlmostEqual(BARCELONA['lon'], event.geo.x)
+        self.assertAlmostEqual(BARCELONA['lat'], event.geo.y)
+    
+    def test_within(self):
+        # ~1 km away from the registered location
+        events = self.get_events(within='2.18,41.39,10000')
+        self.assertEqual(1, len(events))
+        self.assertIn(str(self.barcelona.pk), events[0])
+        
+        # Madrid is ~500 km away from Barcelona
+        self.assertEqual(2, len(self.get_events(within='2.18,41.39,600000')))
+    
+    def test_bbox(self):
+        events = self.get_events(bbox='-4,40,-3,41')
+        self.assertEqual(1, len(events))
+        self.assertIn(str(self.madrid.pk), events[0])
+    
+    def test_invalid_filter(self):
+        response = self.client.get('/api/events/', {'within': '2.18,41.39'})
+        self.assertEqual(400, response.status_code)
+    
+    def test_devices_located_within(self):
+        url = '/api/devices/located/'
+        response = self.client.get(url, {'polygon': CATALONIA})
+        self.assertEqual(200, response.status_code, response.content)
+        self.assertEqual([self.barcelona.hid],
+                         [d['hid'] for d in response.data['results']])
+        
+        # The device is moved to Madrid
+        response = self.client.post(
+            '/api/devices/%d/usage-proof/' % self.barcelona.pk,
+            data={
+                'dhDate': '2015-09-19T12:00:00.000Z',
+                'byUser': 'http://example.org/users/foo',
+                'location': MADRID,
+            }
+        )
+        self.assertEqual(201, response.status_code, response.content)
+        response = self.client.get(url, {'polygon': CATALONIA})
+        self.assertEqual([], response.data['results'])
+        
+        response = self.client.get(url, {'polygon': 'POINT(0 0)'})
+        self.assertEqual(400, response.status_code)
+    
+    def test_geo_aggregate(self):
+        url = '/api/events/geo-aggregate/'
+        response = self.client.get(url, {'zoom': 4, 'type': 'Register'})
+        self.assertEqual(200, response.status_code, response.content)
+        self.assertEqual(2, len(response.data['results']))
+        cell_size = response.data['cell_size']
+        for lon, lat, count in response.data['results']:
+            self.assertEqual(1, count)
+            location = BARCELONA if lon > 0 else MADRID
+            self.assertLessEqual(abs(location['lon'] - lon), cell_size / 2)
+            self.assertLessEqual(abs(location['lat'] - lat), cell_size / 2)
+        
+        # Cells of 45 degrees: Madrid is on the west of the meridian
+        response = self.client.get(url, {'zoom': 0})
+        self.assertEqual([[-22.5, 22.5, 1], [22.5, 22.5, 1]],
+                         sorted(list(cell) for cell in response.data['results']))
+        
+        response = self.client.get(url, {'zoom': 4, 'type': 'Allocate'})
+        self.assertEqual([], response.data['results'])
+        
+        response = self.client.get(url, {'zoom': 4, 'type': 'Foo'})
+        self.assertEqual(400, response.status_code)
+    
+    def test_geo_aggregate_limits(self):
+        url = '/api/events/geo-aggregate/'
+        response = self.client.get(url, {'zoom': 20})
+        self.assertEqual(400, response.status_code)
+        self.assertIn('bbox', response.data)
+        
+        response = self.client.get(url, {'zoom': 20, 'bbox': '0,40,3.5,43'})
+        self.assertEqual(200, response.status_code, response.content)
+        self.assertEqual(1, len(response.data['results']))
+        
+        with mock.patch.object(EventView, 'max_cells', 1):
+            response = self.client.get(url, {'zoom': 0})
+        self.assertEqual(400, response.status_code)
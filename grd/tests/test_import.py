@@ -0,0 +1,149 @@
+import json
+import tempfile
+from datetime import timedelta
+from unittest import mock
+from django.core import management
+from django.core.management.base import CommandError
+from django.test import TestCase
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.utils.six import StringIO
+from grd.models import Device, Event, Location
+from grd.state import create_checkpoints, verify
+
+
+class ImportCommandTest(TestCase):
+    fixtures = ['agents.json', 'devices.json', 'users.json']
+    
+    def setUp(self):
+        super(ImportCommandTest, self).setUp()
+        self.items = [
+            {
+                '@type': 'Register',
+                'device': {'hid': 'XPS13-5555-1', '@type': 'Computer',
+                           'url': 'http://example.org/device/5555/'},
+                'components': [{'hid': 'LED24-Acme-5555', '@type': 'Monitor',
+                                'url': 'http://example.org/device/5556/'}],
+                'dhDate': '2015-09-18T12:38:20.604Z',
+                'byUser': 'http://example.org/users/foo',
+                'location': {'lat': 41.38, 'lon': 2.17},
+            },
+            {
+                '@type': 'Allocate',
+                'device': 'XPS13-5555-1',
+                'owner': 'http://example.org/user/1/',
+                'dhDate': '2015-09-19T12:38:20.604Z',
+                'byUser': 'http://example.org/users/foo',
+            },
+        ]
+    
+    def import_items(self, items, **options):
+        with tempfile.NamedTemporaryFile('w', suffix='.ndjson') as f:
+            for item in items:
+                f.write(json.dumps(item) + '\n')
+            f.flush()
+            stdout = StringIO()
+            management.call_command('grd_import', f.name, agent='XSR',
+                                    stdout=stdout, **options)
+        return stdout.getvalue()
+    
+    def test_import(self):
+        output = self.import_items(self.items)
+        self.assertIn('rows/s', output)
+        
+        device = Device.objects.get(hid='XPS13-5555-1')
+        self.assertEqual([Event.REGISTER, Event.ALLOCATE],
+                         [e.type for e in device.events.order_by('pk')])
+        self.assertEqual(['LED24-Acme-5555'],
+                         [c.hid for c in device.components])
+        self.assertEqual(['http://example.org/user/1/'], device.owners)
+        self.assertEqual(1, Location.objects.filter(
+            event__device=device).count())
+        self.assertEqual([], verify(device))
+    
+    def test_events_without_grd_date(self):
+        # the events share the grdDate of the import
+        self.items.append({
+            '@type': 'Deallocate',
+            'device': 'XPS13-5555-1',
+            'owner': 'http://example.org/user/1/',
+            'dhDate': '2015-09-20T12:38:20.604Z',
+            'byUser': 'http://example.org/users/foo',
+        })
+        self.import_items(self.items)
+        
+        device = Device.objects.get(hid='XPS13-5555-1')
+        self.assertEqual([], device.owners)
+        self.assertFalse(device.ownerships.exists())
+    
+    def test_repeated_allocate(self):
+        self.items.append(dict(self.items[1], dhDate='2015-09-20T12:38:20Z'))
+        self.import_items(self.items)
+        
+        device = Device.objects.get(hid='XPS13-5555-1')
+        self.assertEqual(['http://example.org/user/1/'], device.owners)
+        self.assertEqual([], verify(device))
+    
+    def test_stored_on_import(self):
+        # the original grdDate is kept, the event is stored now
+        self.items[1]['grdDate'] = '2015-09-19T12:40:00Z'
+        self.import_items(self.items)
+        
+        event = Event.objects.get(type=Event.ALLOCATE,
+                                  device__hid='XPS13-5555-1')
+        self.assertEqual(parse_datetime('2015-09-19T12:40:00Z'), event.grdDate)
+        self.assertIsNone(event.date)
+        self.assertGreater(event.logDate, timezone.now() - timedelta(days=1))
+    
+    def test_existing_devices(self):
+        self.import_items(self.items[:1])
+        devices = Device.objects.count()
+        self.import_items(self.items[:1])
+        self.assertEqual(devices, Device.objects.count())
+    
+    def test_checkpoints_deleted(self):
+        self.import_items(self.items[:1])
+        device = Device.objects.get(hid='XPS13-5555-1')
+        self.assertEqual(1, create_checkpoints([device.pk], interval=0))
+        
+        self.import_items(self.items[1:])
+        self.assertFalse(device.checkpoints.exists())
+    
+    def test_unknown_agent(self):
+        self.items[0]['agent'] = 'foo'
+        with self.assertRaises(CommandError):
+            self.import_items(self.items)
+        self.assertFalse(Device.objects.filter(hid='XPS13-5555-1').exists())
+
+
+class ExportRoundTripTest(TestCase):
+    fixtures = ['agents.json', 'devices.json', 'events.json', 'users.json']
+    
+    def export(self):
+        stdout = StringIO()
+        management.call_command('grd_export', base_url='http://testserver',
+                                stdout=stdout, stderr=StringIO())
+        return [json.loads(line) for line in stdout.getvalue().splitlines()]
+    
+    def test_roundtrip(self):
+        # e.g. restoring the log of a GRD from its export
+        exported = self.export()
+        Event.objects.all().delete()
+        with tempfile.NamedTemporaryFile('w', suffix='.ndjson') as f:
+            for item in exported:
+                f.write(json.dumps(item) + '\n')
+            f.flush()
+            management.call_command('grd_import', f.name,
+                                    base_url='http://testserver',
+                                    by_user='http://example.org/users/foo',
+                                    stdout=StringIO())
+        
+        # the imported events have just been stored
+        with mock.patch('grd.export.FEED_LAG', timedelta(0)):
+            imported = self.export()
+        for item in exported + imported:
+            del item['url']
+        self.assertEqual(exported, imported)
+        # the device registered with its component (see events.json)
+        for device in Device.objects.filter(pk__in=[1, 2]):
+            self.assertEqual([], verify(device))
@@ -0,0 +1,67 @@
+from datetime import timedelta
+from django.contrib.auth import get_user_model
+from django.utils import timezone
+from rest_framework.test import APITestCase
+from grd.metrics import fleet_metrics
+from grd.models import Agent, Device, Event
+from grd.state import rebuild_state
+
+
+User = get_user_model()
+
+
+class FleetMetricsTest(APITestCase):
+    fixtures = ['agents.json', 'devices.json', 'events.json', 'users.json']
+    
+    def setUp(self):
+        super(FleetMetricsTest, self).setUp()
+        self.client.force_authenticate(user=User.objects.first())
+        self.agent = Agent.objects.first()
+        self.device = Device.objects.get(hid="LED24-Acme-44")
+        start = timezone.now() - timedelta(days=10)
+        for type, hours in [(Event.USAGEPROOF, 0), (Event.STOPUSAGE, 2),
+                            (Event.USAGEPROOF, 3), (Event.USAGEPROOF, 4),
+                            (Event.STOPUSAGE, 6)]:
+            self.device.events.create(
+                agent=self.agent,
+                type=type,
+                date=start + timedelta(hours=hours),
+                dhDate=start,
+                byUser='http://example.org/users/XSR',
+            )
+        # the metrics are aggregated from the projected state
+        rebuild_state(Device.objects.values_list('pk', flat=True))
+    
+    def test_same_as_replay(self):
+        metrics = fleet_metrics()
+        self.assertEqual(1, len(metrics))
+        fleet = metrics[0]
+        
+        devices = Device.objects.all()
+        self.assertEqual(len(devices), fleet['devices'])
+        running_time = sum(d.replay_running_time() for d in devices)
+        self.assertAlmostEqual(running_time, fleet['running_time']['total'])
+        self.assertEqual(4 * 3600, self.device.replay_running_time())
+        
+        durabilities = [d.replay_durability() for d in devices
+                        if d.events.filter(type=Event.RECYCLE).exists()]
+        self.assertEqual(len(durabilities), fleet['durability']['recycled'])
+        self.assertEqual(max(durabilities), fleet['durability']['max'])
+    
+    def test_group_by(self):
+        response = self.client.get('/api/metrics/fleet/',
+                                   {'group_by': 'type,agent'})
+        self.assertEqual(200, response.status_code, response.content)
+        results = response.data['results']
+        self.assertEqual(Device.objects.values('type').distinct().count(),
+                         len(set(r['type'] for r in results)))
+        self.assertEqual(Device.objects.count(),
+                         sum(r['devices'] for r in results))
+        for result in results:
+            self.assertIn(result['agent'], [None, 'http://testserver/api/'
+                                            'agents/%d/' % self.agent.pk])
+            self.assertNotIn('year', result)
+    
+    def test_invalid_group_by(self):
+        response = self.client.get('/api/metrics/fleet/', {'group_by': 'foo'})
+        self.assertEqual(400, response.status_code)
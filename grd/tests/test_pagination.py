@@ -0,0 +1,63 @@
+from datetime import timedelta
+from django.test import TestCase
+from django.utils import timezone
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+from grd.models import Agent, Device, Event
+from grd.pagination import EventPagination, decode_cursor, encode_cursor
+
+
+class EventPaginationTest(TestCase):
+    fixtures = ['agents.json', 'devices.json', 'users.json']
+    
+    def setUp(self):
+        super(EventPaginationTest, self).setUp()
+        device = Device.objects.first()
+        for i in range(5):
+            device.events.create(
+                agent=Agent.objects.first(),
+                type=Event.USAGEPROOF,
+                dhDate=timezone.now(),
+                byUser='http://example.org/users/foo',
+            )
+        # several events registered at the same time
+        Event.objects.update(grdDate=timezone.now() - timedelta(days=1))
+    
+    def paginate(self, params):
+        paginator = EventPagination()
+        paginator.page_size = 2
+        request = Request(APIRequestFactory().get('/api/events/', params))
+        page = paginator.paginate_queryset(Event.objects.all(), request)
+        return paginator, page
+    
+    def test_cursor_roundtrip(self):
+        now = timezone.now()
+        self.assertEqual([now.isoformat(), 3],
+                         decode_cursor(encode_cursor([now, 3])))
+        self.assertRaises(ValueError, decode_cursor, 'foo')
+    
+    def test_walk_all_pages(self):
+        pks = []
+        params = {'cursor': ''}
+        while True:
+            paginator, page = self.paginate(params)
+            pks += [event.pk for event in page]
+            if paginator.next_cursor is None:
+                break
+            params = {'cursor': paginator.next_cursor}
+        
+        expected = Event.objects.order_by('grdDate', 'id')
+        self.assertEqual(list(expected.values_list('pk', flat=True)), pks)
+    
+    def test_count_is_optional(self):
+        paginator, page = self.paginate({'cursor': ''})
+        self.assertIsNone(paginator.count)
+        self.assertNotIn('count', paginator.get_paginated_response([]).data)
+        
+        paginator, page = self.paginate({'cursor': '', 'count': 'true'})
+        self.assertEqual(5, paginator.get_paginated_response([]).data['count'])
+    
+    def test_page_number_mode(self):
+        paginator, page = self.paginate({})
+        self.assertFalse(paginator.keyset)
+        self.assertEqual(2, len(page))
@@ -0,0 +1,50 @@
+import datetime
+import unittest
+from django.db import connection
+from django.test import TestCase
+from django.utils import timezone
+from grd import partitions
+from grd.models import Agent, Device, Event
+
+
+class MonthsTest(unittest.TestCase):
+    def test_get_month(self):
+        date = datetime.datetime(2015, 12, 31, 23, 59, tzinfo=timezone.utc)
+        self.assertEqual(datetime.datetime(2015, 12, 1, tzinfo=timezone.utc),
+                         partitions.get_month(date))
+    
+    def test_add_months(self):
+        date = datetime.datetime(2015, 11, 1, tzinfo=timezone.utc)
+        self.assertEqual(datetime.datetime(2016, 1, 1, tzinfo=timezone.utc),
+                         partitions.add_months(date, 2))
+        self.assertEqual('grd_event_p201511',
+                         partitions.get_partition_name(date))
+
+
+@unittest.skipUnless(partitions.is_supported(connection),
+                     "The events aren't partitioned on this database.")
+class PartitionedEventsTest(TestCase):
+    fixtures = ['agents.json', 'devices.json', 'events.json', 'users.json']
+    
+    def test_partitions(self):
+        with connection.cursor() as cursor:
+            self.assertTrue(partitions.is_partitioned(cursor))
+            names = [name for name, _, _ in partitions.get_partitions(cursor)]
+            self.assertEqual(partitions.HISTORY, names[0])
+            self.assertEqual(partitions.DEFAULT, names[-1])
+            # the partitions of the following months already exist
+            self.assertEqual([], partitions.create_partitions(cursor, 1))
+    
+    def test_new_event(self):
+        device = Device.objects.first()
+        event = device.events.create(
+            agent=Agent.objects.first(),
+            type=Event.USAGEPROOF,
+            dhDate=timezone.now(),
+            byUser='http://example.org/users/foo',
+        )
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT tableoid::regclass FROM "grd_event" '
+                           'WHERE "id" = %s', [event.pk])
+            self.assertEqual(partitions.HISTORY, cursor.fetchone()[0])
+        self.assertIn(event, Event.objects.related_to_device(device))
@@ -1,7 +1,11 @@
 from django.test import TestCase
-
-from grd.models import Device
-from grd.serializers import DeviceRegisterSerializer
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIRequestFactory
+from grd.fastpath import FastDeviceSerializer, FastEventSerializer
+from grd.models import Agent, AgentUser, Device, Event, Location
+from grd.serializers import (DeviceRegisterSerializer, DeviceSerializer,
+                             EventSerializer, RegisterSerializer)
 
 
 class DeviceRegisterSerializerTest(TestCase):
@@ -74,3 +78,75 @@ class DeviceRegisterSerializerTest(TestCase):
         data['url'] = data.pop('sameAs')
         serializer = DeviceRegisterSerializer(data=data)
         self.assertTrue(serializer.is_valid(), serializer.errors)
+
+
+class RegisterSerializerTest(TestCase):
+    fixtures = ['agents.json', 'users.json']
+    
+    def test_repeated_components(self):
+        # e.g. components without hid resolve to the same device
+        component = {'url': 'http://example.org/device/2/',
+                     '@type': 'Monitor'}
+        data = {
+            'device': {'url': 'http://example.org/device/1/',
+                       'hid': 'XPS13-1111-2222', '@type': 'Computer'},
+            'components': [dict(component), dict(component)],
+            'dhDate': '2015-09-18T12:38:20.604Z',
+            'byUser': 'http://example.org/users/foo',
+        }
+        serializer = RegisterSerializer(data=data)
+        self.assertTrue(serializer.is_valid(), serializer.errors)
+        event = serializer.save(agent=Agent.objects.first())
+        
+        self.assertEqual(1, event.components.count())
+        self.assertEqual(list(event.components.all()),
+                         event.device.components)
+
+
+class FastSerializersTest(TestCase):
+    fixtures = ['agents.json', 'devices.json', 'events.json', 'users.json']
+    
+    def setUp(self):
+        self.request = APIRequestFactory().get('/api/events/')
+        # cover the fields which are empty on the fixtures
+        device = Device.objects.first()
+        event = device.events.create(
+            agent=Agent.objects.first(),
+            type=Event.ALLOCATE,
+            owner=AgentUser.objects.create(url='http://example.org/user/1/'),
+            dhDate=timezone.now(),
+            byUser='http://example.org/users/foo',
+        )
+        Location.objects.create(event=event, lat=41.38, lon=2.17)
+    
+    def assertSameJSON(self, expected, data):
+        renderer = JSONRenderer()
+        self.assertEqual(renderer.render(expected), renderer.render(data))
+    
+    def assertSameEvents(self, format=None):
+        events = Event.objects.order_by('grdDate', 'id')
+        context = {'request': self.request, 'format': format}
+        expected = EventSerializer(events, many=True, context=context).data
+        serializer = FastEventSerializer(request=self.request, format=format)
+        rows = list(serializer.get_rows(events))
+        self.assertSameJSON(expected, serializer.serialize(rows))
+    
+    def assertSameDevices(self, format=None):
+        devices = Device.objects.prefetch_state(
+            list(Device.objects.order_by('pk')))
+        context = {'request': self.request, 'format': format}
+        expected = DeviceSerializer(devices, many=True, context=context).data
+        serializer = FastDeviceSerializer(request=self.request, format=format)
+        self.assertSameJSON(expected, serializer.serialize(devices))
+    
+    def test_events(self):
+        self.assertSameEvents()
+    
+    def test_events_format(self):
+        self.assertSameEvents(format='json')
+    
+    def test_devices(self):
+        self.assertSameDevices()
+    
+    def test_devices_format(self):
+        self.assertSameDevices(format='json')
@@ -0,0 +1,222 @@
+from datetime import timedelta
+from django.contrib.auth import get_user_model
+from django.core import management
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from grd.models import Agent, AgentUser, Device, DeviceState, Event, Ownership
+from grd.state import (
+    LOCK_CLASS, Projector, create_checkpoints, get_state_as_of, verify
+)
+
+
+User = get_user_model()
+
+
+class ProjectorTest(TestCase):
+    fixtures = ['agents.json', 'devices.json', 'users.json']
+    
+    def setUp(self):
+        super(ProjectorTest, self).setUp()
+        self.agent = Agent.objects.first()
+        self.device_one = Device.objects.get(hid="XPS13-1111-2222")
+        self.device_two = Device.objects.get(hid="LED24-Acme-44")
+    
+    def create_event(self, device, type, components=(), **kwargs):
+        component_ids = [c.pk for c in components]
+        projector = Projector()
+        projector.load([device.pk] + component_ids)
+        kwargs.setdefault('date', timezone.now())
+        event = device.events.create(
+            agent=self.agent,
+            type=type,
+            dhDate=timezone.now(),
+            byUser='http://example.org/users/XSR',
+            **kwargs
+        )
+        event.components.add(*components)
+        projector.apply(event, component_ids)
+        projector.save()
+        return event
+    
+    def test_register(self):
+        self.create_event(self.device_one, Event.REGISTER, [self.device_two])
+        self.assertEqual([self.device_two], self.device_one.components)
+        self.assertEqual(self.device_one, self.device_two.parent)
+        self.assertEqual(self.agent, self.device_one.holder)
+        self.assertEqual([], verify(self.device_one))
+        self.assertEqual([], verify(self.device_two))
+    
+    def test_remove(self):
+        self.create_event(self.device_one, Event.REGISTER, [self.device_two])
+        self.create_event(self.device_one, Event.REMOVE, [self.device_two])
+        self.assertEqual([], self.device_one.components)
+        self.assertIsNone(self.device_two.parent)
+        self.assertEqual([], verify(self.device_one))
+        self.assertEqual([], verify(self.device_two))
+    
+    def test_allocate_deallocate(self):
+        alice = AgentUser.objects.create(url='http://example.org/user/alice/')
+        bob = AgentUser.objects.create(url='http://example.org/user/bob/')
+        self.create_event(self.device_one, Event.REGISTER)
+        self.create_event(self.device_one, Event.ALLOCATE, owner=alice)
+        self.create_event(self.device_one, Event.ALLOCATE, owner=bob)
+        self.create_event(self.device_one, Event.DEALLOCATE, owner=alice)
+        self.assertEqual([bob.url], self.device_one.owners)
+        self.assertTrue(self.device_one.has_owner(bob.url))
+        self.assertFalse(self.device_one.has_owner(alice.url))
+        self.assertEqual([], verify(self.device_one))
+        
+        ownership = Ownership.objects.get(device=self.device_one)
+        self.assertEqual(bob, ownership.owner)
+        self.assertEqual(Event.ALLOCATE, ownership.event.type)
+    
+    def test_load_locks_devices(self):
+        projector = Projector()
+        projector.load([self.device_one.pk, self.device_two.pk])
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT objid FROM pg_locks WHERE locktype = 'advisory' "
+                "AND classid = %s AND pid = pg_backend_pid() ORDER BY 1",
+                [LOCK_CLASS]
+            )
+            locked = [row[0] for row in cursor.fetchall()]
+        self.assertEqual(sorted([self.device_one.pk, self.device_two.pk]),
+                         locked)
+    
+    def test_concurrent_bootstrap(self):
+        # both projectors replay the device, the latest one stores it
+        first, second = Projector(), Projector()
+        first.load([self.device_one.pk])
+        second.load([self.device_one.pk])
+        second.save()
+        first.save()
+        self.assertEqual(1, DeviceState.objects.filter(
+            pk=self.device_one.pk).count())
+        self.assertEqual(1, DeviceState.objects.get(
+            pk=self.device_one.pk).version)
+    
+    def test_save_writes_changed_rows(self):
+        alice = AgentUser.objects.create(url='http://example.org/user/alice/')
+        bob = AgentUser.objects.create(url='http://example.org/user/bob/')
+        self.create_event(self.device_one, Event.REGISTER, [self.device_two])
+        self.create_event(self.device_one, Event.ALLOCATE, owner=alice)
+        ownership = Ownership.objects.get(device=self.device_one)
+        
+        with CaptureQueriesContext(connection) as context:
+            self.create_event(self.device_one, Event.USAGEPROOF)
+        writes = [q['sql'] for q in context.captured_queries
+                  if not q['sql'].startswith('SELECT') and
+                  ('grd_ownership' in q['sql'] or
+                   'grd_devicestate_components' in q['sql'])]
+        self.assertEqual([], writes)
+        
+        # the row of the previous owner is kept
+        self.create_event(self.device_one, Event.ALLOCATE, owner=bob)
+        self.assertEqual(ownership, Ownership.objects.get(
+            device=self.device_one, owner=alice))
+        self.assertEqual([alice.url, bob.url], self.device_one.owners)
+        self.assertEqual([], verify(self.device_one))
+    
+    def test_usage_metrics(self):
+        start = timezone.now() - timedelta(days=400)
+        self.create_event(self.device_one, Event.REGISTER, date=start)
+        self.create_event(self.device_one, Event.USAGEPROOF, date=start)
+        self.create_event(self.device_one, Event.STOPUSAGE,
+                          date=start + timedelta(hours=2))
+        self.create_event(self.device_one, Event.USAGEPROOF,
+                          date=start + timedelta(hours=3))
+        
+        state = DeviceState.objects.get(pk=self.device_one.pk)
+        self.assertEqual(2 * 3600, state.running_seconds)
+        self.assertEqual(start + timedelta(hours=3), state.usage_start)
+        with self.assertRaises(ValueError):
+            self.device_one.durability
+        
+        recycled_on = start + timedelta(hours=4)
+        self.create_event(self.device_one, Event.RECYCLE, date=recycled_on)
+        device = Device.objects.get(pk=self.device_one.pk)
+        self.assertEqual(3 * 3600, device.running_time)
+        self.assertEqual(recycled_on.year - start.year, device.durability)
+        self.assertEqual([], verify(device))
+    
+    def test_events_without_date(self):
+        register = self.create_event(self.device_one, Event.REGISTER,
+                                     date=None)
+        recycle = self.create_event(self.device_one, Event.RECYCLE,
+                                    date=None)
+        
+        state = DeviceState.objects.get(pk=self.device_one.pk)
+        self.assertEqual(register.grdDate, state.registered_on)
+        self.assertEqual(recycle.grdDate, state.recycled_on)
+        self.assertTrue(state.recycled)
+        self.assertEqual([], verify(self.device_one))
+    
+    def test_state_as_of(self):
+        owner = AgentUser.objects.create(url='http://example.org/user/1/')
+        register = self.create_event(self.device_one, Event.REGISTER,
+                                     [self.device_two])
+        allocate = self.create_event(self.device_one, Event.ALLOCATE,
+                                     owner=owner)
+        pks = [self.device_one.pk, self.device_two.pk]
+        self.assertEqual(1, create_checkpoints(pks, interval=1))
+        remove = self.create_event(self.device_one, Event.REMOVE,
+                                   [self.device_two])
+        
+        for event, components, owners in [
+                (register, [self.device_two.pk], []),
+                (allocate, [self.device_two.pk], [owner.pk]),
+                (remove, [], [owner.pk])]:
+            state = get_state_as_of(self.device_one, event.grdDate)
+            self.assertEqual(components, state.component_ids)
+            self.assertEqual(owners, state.owner_ids)
+            self.assertEqual(self.agent.pk, state.holder_id)
+        
+        state = get_state_as_of(self.device_two, allocate.grdDate)
+        self.assertEqual(self.device_one.pk, state.parent_id)
+        state = get_state_as_of(self.device_two, remove.grdDate)
+        self.assertIsNone(state.parent_id)
+        
+        # a Register after the checkpoint
+        register = self.create_event(self.device_one, Event.REGISTER,
+                                     [self.device_two])
+        state = get_state_as_of(self.device_one, register.grdDate)
+        stored = DeviceState.objects.get(pk=self.device_one.pk)
+        self.assertEqual([c.pk for c in stored.components.all()],
+                         state.component_ids)
+    
+    def test_state_bootstrapped_from_event_log(self):
+        # Events created before the projection existed
+        event = self.device_one.events.create(
+            agent=self.agent,
+            type=Event.REGISTER,
+            date=timezone.now(),
+            dhDate=timezone.now(),
+            byUser='http://example.org/users/XSR',
+        )
+        event.components.add(self.device_two)
+        self.assertFalse(DeviceState.objects.exists())
+        
+        self.create_event(self.device_one, Event.USAGEPROOF)
+        self.assertEqual(self.device_one, self.device_two.parent)
+        self.assertEqual([self.device_two], self.device_one.components)
+        self.assertEqual([], verify(self.device_one))
+
+
+class RebuildStateCommandTest(TestCase):
+    fixtures = ['agents.json', 'devices.json', 'events.json', 'users.json']
+    
+    def test_rebuild_state(self):
+        management.call_command('grd_rebuild_state', verbosity=0)
+        self.assertEqual(Device.objects.count(), DeviceState.objects.count())
+        
+        device = Device.objects.get(hid="XPS13-1111-2222")
+        self.assertTrue(device.state.recycled)
+        for device in Device.objects.all():
+            self.assertEqual([], verify(device))
+    
+    def test_verify_without_state(self):
+        with self.assertRaises(management.CommandError):
+            management.call_command('grd_rebuild_state', rebuild=False,
+                                    verbosity=0)
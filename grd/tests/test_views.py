@@ -0,0 +1,527 @@
+import json
+from datetime import timedelta
+
+from django.contrib.auth import get_user_model
+from django.core import management
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.utils.six import StringIO
+from rest_framework.test import APITestCase
+from grd.cache import device_payloads
+from grd.models import Agent, AgentUser, Device, DeviceState, Event
+from grd.serializers import RegisterSerializer
+from grd.state import Projector
+
+
+User = get_user_model()
+
+
+class DeviceListQueriesTest(APITestCase):
+    def setUp(self):
+        super(DeviceListQueriesTest, self).setUp()
+        user = User.objects.create_superuser("ereuse", "ereuse@localhost",
+                                             "ereuse")
+        self.agent = Agent.objects.create(name="XSR", user=user)
+        self.client.force_authenticate(user=user)
+        self.count = 0
+        device_payloads.cache.clear()
+    
+    def register_device(self):
+        """Register a device with a component using the API path."""
+        self.count += 1
+        data = {
+            'device': {
+                'url': 'http://example.org/device/%d/' % self.count,
+                'hid': 'XPS13-1111-%d' % self.count,
+                '@type': 'Computer',
+            },
+            'dhDate': '2015-09-18T12:38:20.604Z',
+            'byUser': 'http://example.org/users/foo',
+            'components': [{
+                'url': 'http://example.org/device/%d-1/' % self.count,
+                'hid': 'LED24-Acme-%d' % self.count,
+                '@type': 'Monitor',
+            }],
+        }
+        serializer = RegisterSerializer(data=data)
+        self.assertTrue(serializer.is_valid(), serializer.errors)
+        return serializer.save(agent=self.agent).device
+    
+    def register_device_without_state(self):
+        """Register and allocate a device whose state isn't projected."""
+        self.count += 1
+        device = Device.objects.create(
+            hid='XPS13-2222-%d' % self.count,
+            sameAs='http://example.org/device/%d/' % self.count,
+            type=Device.COMPUTER,
+        )
+        event = device.events.create(
+            agent=self.agent,
+            type=Event.REGISTER,
+            dhDate=timezone.now(),
+            byUser='http://example.org/users/foo',
+        )
+        event.components.add(self.register_device())
+        owner = AgentUser.objects.create(
+            url='http://example.org/user/%d/' % self.count
+        )
+        device.events.create(
+            agent=self.agent,
+            type=Event.ALLOCATE,
+            owner=owner,
+            dhDate=timezone.now(),
+            byUser='http://example.org/users/foo',
+        )
+        return device
+    
+    def count_list_queries(self):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get('/api/devices/')
+        self.assertEqual(200, response.status_code, response.content)
+        return len(context.captured_queries)
+    
+    def test_queries_do_not_depend_on_page_size(self):
+        self.register_device()
+        self.register_device_without_state()
+        queries = self.count_list_queries()
+        
+        for _ in range(5):
+            self.register_device()
+            self.register_device_without_state()
+        self.assertEqual(queries, self.count_list_queries())
+    
+    def test_device_without_state(self):
+        device = self.register_device_without_state()
+        response = self.client.get('/api/devices/')
+        self.assertEqual(200, response.status_code, response.content)
+        
+        listed = [d for d in response.data['results']
+                  if d['hid'] == device.hid][0]
+        self.assertEqual(device.owners, listed['owners'])
+        self.assertEqual(len(device.components), len(listed['components']))
+
+
+class HolderOwnerDevicesTest(APITestCase):
+    def setUp(self):
+        super(HolderOwnerDevicesTest, self).setUp()
+        user = User.objects.create_superuser("ereuse", "ereuse@localhost",
+                                             "ereuse")
+        self.agent = Agent.objects.create(name="XSR", user=user)
+        self.client.force_authenticate(user=user)
+        
+        self.devices = []
+        for i in range(3):
+            data = {
+                'device': {
+                    'url': 'http://example.org/device/%d/' % i,
+                    'hid': 'XPS13-3333-%d' % i,
+                    '@type': 'Computer',
+                },
+                'dhDate': '2015-09-18T12:38:20.604Z',
+                'byUser': 'http://example.org/users/foo',
+                'components': [],
+            }
+            serializer = RegisterSerializer(data=data)
+            self.assertTrue(serializer.is_valid(), serializer.errors)
+            self.devices.append(serializer.save(agent=self.agent).device)
+    
+    def test_agent_devices(self):
+        other = Agent.objects.create(
+            name="Other",
+            user=User.objects.create_user("other", "other@localhost", "other")
+        )
+        response = self.client.post(
+            '/api/devices/%d/migrate/' % self.devices[0].pk,
+            data={
+                'dhDate': '2015-09-19T12:00:00.000Z',
+                'byUser': 'http://example.org/users/foo',
+                'to': 'http://testserver/api/agents/%d/' % other.pk,
+            }
+        )
+        self.assertEqual(201, response.status_code, response.content)
+        
+        url = '/api/agents/%d/devices/' % self.agent.pk
+        response = self.client.get(url, {'cursor': ''})
+        self.assertEqual(200, response.status_code, response.content)
+        self.assertEqual([self.devices[1].hid, self.devices[2].hid],
+                         [d['hid'] for d in response.data['results']])
+        self.assertIsNone(response.data['next'])
+        
+        response = self.client.get('/api/agents/%d/devices/' % other.pk)
+        self.assertEqual([self.devices[0].hid],
+                         [d['hid'] for d in response.data['results']])
+    
+    def test_agent_devices_keyset(self):
+        # paginated by cursor by default (no OFFSET), count is opt-in
+        url = '/api/agents/%d/devices/' % self.agent.pk
+        response = self.client.get(url, {'page': 2})
+        self.assertEqual(200, response.status_code, response.content)
+        self.assertNotIn('count', response.data)
+        self.assertIsNone(response.data['next'])
+        self.assertEqual([d.hid for d in self.devices],
+                         [d['hid'] for d in response.data['results']])
+        
+        response = self.client.get(url, {'count': 'true'})
+        self.assertEqual(3, response.data['count'])
+    
+    def test_devices_by_owner(self):
+        alice = 'http://example.org/user/alice/'
+        for device in self.devices[:2]:
+            response = self.client.post(
+                '/api/devices/%d/allocate/' % device.pk,
+                data={
+                    'dhDate': '2015-09-19T12:00:00.000Z',
+                    'byUser': 'http://example.org/users/foo',
+                    'to': alice,
+                }
+            )
+            self.assertEqual(201, response.status_code, response.content)
+        response = self.client.post(
+            '/api/devices/%d/deallocate/' % self.devices[0].pk,
+            data={
+                'dhDate': '2015-09-20T12:00:00.000Z',
+                'byUser': 'http://example.org/users/foo',
+                'from': alice,
+            }
+        )
+        self.assertEqual(201, response.status_code, response.content)
+        
+        response = self.client.get('/api/devices/', {'owner': alice})
+        self.assertEqual(200, response.status_code, response.content)
+        self.assertEqual([self.devices[1].hid],
+                         [d['hid'] for d in response.data['results']])
+
+
+class DeviceLookupTest(APITestCase):
+    fixtures = ['agents.json', 'devices.json', 'events.json', 'users.json']
+    
+    def setUp(self):
+        super(DeviceLookupTest, self).setUp()
+        self.client.force_authenticate(user=User.objects.first())
+        self.device = Device.objects.exclude(hid=None).first()
+    
+    def get_device(self, lookup):
+        response = self.client.get('/api/devices/%s/' % lookup)
+        self.assertEqual(200, response.status_code, response.content)
+        return response.data
+    
+    def test_lookup_by_hid(self):
+        self.assertEqual(self.device.sameAs,
+                         self.get_device(self.device.hid)['sameAs'])
+    
+    def test_lookup_by_same_as(self):
+        lookup = self.device.sameAs.replace('/', '!')
+        self.assertEqual(self.device.hid, self.get_device(lookup)['hid'])
+
+
+class ConditionalGetTest(APITestCase):
+    fixtures = ['agents.json', 'devices.json', 'events.json', 'users.json']
+    
+    def setUp(self):
+        super(ConditionalGetTest, self).setUp()
+        self.client.force_authenticate(user=User.objects.first())
+        self.device = Device.objects.exclude(hid=None).first()
+        self.url = '/api/devices/%d/' % self.device.pk
+    
+    def test_device_not_modified(self):
+        response = self.client.get(self.url)
+        self.assertEqual(200, response.status_code, response.content)
+        etag = response['ETag']
+        
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(304, response.status_code)
+        self.assertEqual(etag, response['ETag'])
+        
+        # a new event changes the representation of the device
+        for i in range(2):
+            projector = Projector()
+            projector.load([self.device.pk])
+            event = self.device.events.create(
+                agent=Agent.objects.first(),
+                type=Event.USAGEPROOF,
+                dhDate=timezone.now(),
+                byUser='http://example.org/users/foo',
+            )
+            projector.apply(event)
+            projector.save()
+            
+            response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(200, response.status_code)
+            self.assertNotEqual(etag, response['ETag'])
+            etag = response['ETag']
+    
+    def test_device_list_not_modified(self):
+        response = self.client.get('/api/devices/?cursor=')
+        self.assertEqual(200, response.status_code, response.content)
+        
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/devices/?cursor=',
+                                       HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(304, response.status_code)
+        num_queries = len(queries)
+        
+        # the devices aren't serialized
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/devices/?cursor=')
+        self.assertLess(num_queries, len(queries))
+    
+    def test_event_not_modified(self):
+        event = Event.objects.first()
+        url = '/api/events/%d/' % event.pk
+        response = self.client.get(url)
+        self.assertEqual(200, response.status_code, response.content)
+        self.assertIn('max-age', response['Cache-Control'])
+        
+        response = self.client.get(
+            url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(304, response.status_code)
+
+
+class DevicePayloadCacheTest(APITestCase):
+    fixtures = ['agents.json', 'devices.json', 'events.json', 'users.json']
+    
+    def setUp(self):
+        super(DevicePayloadCacheTest, self).setUp()
+        user = User.objects.create_superuser("ereuse", "ereuse@localhost",
+                                             "ereuse")
+        self.client.force_authenticate(user=user)
+        projector = Projector()
+        projector.load(Device.objects.values_list('pk', flat=True))
+        projector.save()
+        self.device = Device.objects.exclude(hid=None).first()
+        self.url = '/api/devices/%d/' % self.device.pk
+        device_payloads.cache.clear()
+    
+    def get_device(self):
+        response = self.client.get(self.url)
+        self.assertEqual(200, response.status_code, response.content)
+        return response.data
+    
+    def test_hit(self):
+        data = self.get_device()
+        self.assertEqual({'hits': 0, 'misses': 1},
+                         dict(device_payloads.get_stats()))
+        self.assertEqual(data, self.get_device())
+        self.assertEqual({'hits': 1, 'misses': 1},
+                         dict(device_payloads.get_stats()))
+        
+        response = self.client.get('/api/devices/cache-stats/')
+        self.assertEqual(200, response.status_code, response.content)
+        self.assertEqual(1, response.data['hits'])
+    
+    def test_list(self):
+        response = self.client.get('/api/devices/')
+        self.assertEqual(200, response.status_code, response.content)
+        misses = device_payloads.get_stats()['misses']
+        
+        cached = self.client.get('/api/devices/')
+        self.assertEqual(response.data['results'], cached.data['results'])
+        self.assertEqual(misses, device_payloads.get_stats()['hits'])
+    
+    def test_event_bumps_version(self):
+        self.get_device()
+        owner = AgentUser.objects.create(url='http://example.org/user/1/')
+        projector = Projector()
+        projector.load([self.device.pk])
+        event = self.device.events.create(
+            agent=Agent.objects.first(),
+            type=Event.ALLOCATE,
+            owner=owner,
+            dhDate=timezone.now(),
+            byUser='http://example.org/users/foo',
+        )
+        projector.apply(event)
+        projector.save()
+        
+        self.assertEqual([owner.url], self.get_device()['owners'])
+        self.assertEqual(2, device_payloads.get_stats()['misses'])
+    
+    def test_device_updated(self):
+        self.get_device()
+        self.device.sameAs = 'http://example.org/device/updated/'
+        self.device.save()
+        self.assertEqual(self.device.sameAs, self.get_device()['sameAs'])
+
+
+class DeviceAsOfTest(APITestCase):
+    fixtures = ['agents.json', 'devices.json', 'events.json', 'users.json']
+    
+    def setUp(self):
+        super(DeviceAsOfTest, self).setUp()
+        self.client.force_authenticate(user=User.objects.first())
+        self.register = Event.objects.filter(type=Event.REGISTER).first()
+        self.device = self.register.device
+    
+    def test_as_of(self):
+        url = '/api/devices/%d/' % self.device.pk
+        before = self.register.grdDate - timedelta(seconds=1)
+        response = self.client.get(url, {'as_of': before.isoformat()})
+        self.assertEqual(200, response.status_code, response.content)
+        self.assertEqual([], response.data['components'])
+        self.assertIsNone(response.data['holder'])
+        
+        response = self.client.get(
+            url, {'as_of': self.register.grdDate.isoformat()})
+        self.assertEqual(self.register.components.count(),
+                         len(response.data['components']))
+        self.assertTrue(response.data['holder'].endswith(
+            '/api/agents/%d/' % self.register.agent_id))
+        
+        response = self.client.get(url + 'events/',
+                                   {'as_of': before.isoformat()})
+        self.assertEqual([], response.data)
+    
+    def test_as_of_with_offset(self):
+        # the '+' of the offset isn't escaped (decoded as a space)
+        url = '/api/devices/%d/?as_of=%s' % (
+            self.device.pk, self.register.grdDate.isoformat())
+        self.assertIn('+00:00', url)
+        response = self.client.get(url)
+        self.assertEqual(200, response.status_code, response.content)
+        self.assertEqual(self.register.components.count(),
+                         len(response.data['components']))
+    
+    def test_invalid_as_of(self):
+        response = self.client.get('/api/devices/%d/' % self.device.pk,
+                                   {'as_of': 'yesterday'})
+        self.assertEqual(400, response.status_code)
+
+
+class DeviceTreeTest(APITestCase):
+    def setUp(self):
+        super(DeviceTreeTest, self).setUp()
+        user = User.objects.create_superuser("ereuse", "ereuse@localhost",
+                                             "ereuse")
+        self.agent = Agent.objects.create(name="XSR", user=user)
+        self.client.force_authenticate(user=user)
+        
+        self.computer = self.create_device('Computer', 'XPS13-1111-1')
+        self.motherboard = self.create_device('Motherboard', 'MB-Acme-1')
+        self.processor = self.create_device('Processor', 'CPU-Acme-1')
+        self.drive = self.create_device('HardDrive', 'HDD-Acme-1')
+    
+    def create_device(self, type, hid):
+        return Device.objects.create(type=type, hid=hid,
+                                     sameAs='http://example.org/%s/' % hid)
+    
+    def create_event(self, device, type, components, project=True):
+        projector = Projector()
+        projector.load([device.pk] + [c.pk for c in components])
+        event = device.events.create(
+            agent=self.agent,
+            type=type,
+            dhDate=timezone.now(),
+            byUser='http://example.org/users/foo',
+        )
+        event.components.add(*components)
+        if project:
+            projector.apply(event)
+            projector.save()
+    
+    def test_tree(self):
+        # Events without projected state (e.g. previous to the projection)
+        self.create_event(self.computer, Event.REGISTER,
+                          [self.motherboard, self.drive], project=False)
+        self.create_event(self.motherboard, Event.ADD, [self.processor],
+                          project=False)
+        
+        # reading the hierarchy doesn't write the missing state
+        response = self.client.get('/api/devices/%d/tree/' % self.computer.pk)
+        self.assertEqual(200, response.status_code, response.content)
+        self.assertEqual([], response.data['components'])
+        self.assertFalse(DeviceState.objects.exists())
+        
+        management.call_command('grd_rebuild_state', missing=True,
+                                stdout=StringIO())
+        response = self.client.get('/api/devices/%d/tree/' % self.computer.pk)
+        self.assertEqual(200, response.status_code, response.content)
+        tree = response.data
+        self.assertEqual(self.computer.hid, tree['hid'])
+        self.assertEqual(set([self.motherboard.hid, self.drive.hid]),
+                         set(c['hid'] for c in tree['components']))
+        motherboard = [c for c in tree['components']
+                       if c['hid'] == self.motherboard.hid][0]
+        self.assertEqual([self.processor.hid],
+                         [c['hid'] for c in motherboard['components']])
+    
+    def test_tree_of_moved_component(self):
+        # the drive is registered again in another computer
+        laptop = self.create_device('Computer', 'XPS13-1111-2')
+        self.create_event(self.computer, Event.REGISTER, [self.drive])
+        self.create_event(laptop, Event.REGISTER, [self.drive])
+        
+        response = self.client.get('/api/devices/%d/tree/' % self.computer.pk)
+        self.assertEqual([], response.data['components'])
+        response = self.client.get('/api/devices/%d/tree/' % laptop.pk)
+        self.assertEqual([self.drive.hid],
+                         [c['hid'] for c in response.data['components']])
+    
+    def test_ancestors(self):
+        self.create_event(self.computer, Event.REGISTER, [self.motherboard])
+        self.create_event(self.motherboard, Event.ADD, [self.processor])
+        
+        response = self.client.get('/api/devices/%d/ancestors/' %
+                                   self.processor.pk)
+        self.assertEqual(200, response.status_code, response.content)
+        self.assertEqual([self.motherboard.hid, self.computer.hid],
+                         [d['hid'] for d in response.data])
+        
+        response = self.client.get('/api/devices/%d/ancestors/' %
+                                   self.computer.pk)
+        self.assertEqual([], response.data)
+
+
+class EventFeedTest(APITestCase):
+    fixtures = ['agents.json', 'devices.json', 'events.json', 'users.json']
+    
+    def setUp(self):
+        super(EventFeedTest, self).setUp()
+        self.client.force_authenticate(user=User.objects.first())
+    
+    def get_feed(self, **params):
+        response = self.client.get('/api/events/feed/', params)
+        self.assertEqual(200, response.status_code)
+        content = b''.join(response.streaming_content).decode('utf-8')
+        return json.loads(content)
+    
+    def test_incremental_feed(self):
+        feed = self.get_feed()
+        self.assertEqual(Event.objects.count(), len(feed['results']))
+        self.assertEqual(
+            [e['url'] for e in feed['results']],
+            ['http://testserver/api/events/%d/' % pk for pk in
+             Event.objects.order_by('logDate', 'id').values_list('pk', flat=True)]
+        )
+        
+        # there are no new events
+        since = feed['next']
+        feed = self.get_feed(since=since)
+        self.assertEqual([], feed['results'])
+        self.assertEqual(since, feed['next'])
+        
+        event = Event.objects.create(
+            type=Event.USAGEPROOF,
+            dhDate=timezone.now(),
+            byUser='http://example.org/users/foo',
+            agent=Agent.objects.first(),
+            device=Device.objects.first(),
+        )
+        # e.g. imported from another GRD
+        Event.objects.filter(pk=event.pk).update(
+            grdDate=timezone.now() - timedelta(days=365),
+            logDate=timezone.now() - timedelta(minutes=1)
+        )
+        feed = self.get_feed(since=since)
+        self.assertEqual(1, len(feed['results']))
+        self.assertEqual('UsageProof', feed['results'][0]['@type'])
+    
+    def test_limit(self):
+        feed = self.get_feed(limit=1)
+        self.assertEqual(1, len(feed['results']))
+        feed = self.get_feed(since=feed['next'])
+        self.assertEqual(Event.objects.count() - 1, len(feed['results']))
+    
+    def test_invalid_watermark(self):
+        response = self.client.get('/api/events/feed/', {'since': 'foo'})
+        self.assertEqual(400, response.status_code)
@@ -10,6 +10,7 @@ router = routers.DefaultRouter()
 router.register(r'agents', views.AgentView)
 router.register(r'devices', views.DeviceView)
 router.register(r'events', views.EventView)
+router.register(r'metrics', views.MetricsView, base_name='metrics')
 
 urlpatterns = [
     url(r'^admin/', include(admin.site.urls)),
@@ -1,31 +1,164 @@
+import hashlib
+import itertools
+import json
+import re
+from collections import OrderedDict
+
 from django.core.exceptions import ValidationError
 from django.core.validators import URLValidator
+from django.http import StreamingHttpResponse
 from django.shortcuts import get_object_or_404
-from rest_framework import status, viewsets
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.utils.http import (
+    http_date, parse_etags, parse_http_date_safe, quote_etag
+)
+from rest_framework import exceptions, status, viewsets
 from rest_framework.decorators import detail_route, list_route
 from rest_framework.permissions import IsAdminUser, IsAuthenticated
+from rest_framework.renderers import JSONRenderer
 from rest_framework.response import Response
+from rest_framework.reverse import reverse
 from urllib import parse
 
-from .models import Agent, Device, Event
+from .bulk import BulkEvents, BulkRegister
+from .cache import device_payloads
+from .export import (
+    FEED_ORDERING, EventExporter, NDJSONRenderer, filter_committed
+)
+from .fastpath import FastDeviceSerializer, FastEventSerializer
+from .geo import (
+    aggregate_grid, filter_bbox, filter_located_within, filter_within,
+    parse_floats, parse_polygon
+)
+from .metrics import fleet_metrics
+from .models import Agent, AgentUser, Device, Event
+from .pagination import (
+    DevicePagination, EventPagination, HeldDevicePagination, decode_cursor,
+    encode_cursor, get_position, iterate_after
+)
 from .serializers import (
     AddSerializer, AgentSerializer, AllocateSerializer, DeallocateSerializer,
     DeviceSerializer, DeviceMetricsSerializer, EventSerializer,
     EventWritableSerializer, MigrateSerializer, ReceiveSerializer,
     RegisterSerializer, RemoveSerializer
 )
+from .state import get_ancestors, get_descendants, get_state_as_of
+
+
+class BulkMixin(object):
+    """Helpers of the endpoints which process batches of items."""
+    bulk_max_items = 10000
+    
+    def get_bulk_items(self, request):
+        items = request.data
+        if not isinstance(items, list):
+            raise exceptions.ValidationError(
+                {'non_field_errors': ['Expected a list of items.']}
+            )
+        if len(items) > self.bulk_max_items:
+            raise exceptions.ValidationError(
+                {'non_field_errors': ['Too many items (max %d).' %
+                                      self.bulk_max_items]}
+            )
+        return items
+    
+    def get_bulk_response(self, request, events, errors):
+        results = []
+        for event, item_errors in zip(events, errors):
+            if event is None:
+                results.append({'errors': item_errors})
+            else:
+                results.append({'event': reverse('event-detail',
+                                                 args=[event.pk],
+                                                 request=request)})
+        
+        if any(event is not None for event in events):
+            status_code = status.HTTP_201_CREATED
+        else:
+            status_code = status.HTTP_400_BAD_REQUEST
+        return Response(results, status=status_code)
+
+
+class ConditionalMixin(object):
+    """
+    Helpers to answer conditional GET requests (If-None-Match and
+    If-Modified-Since) before serializing the items.
+    
+    """
+    @staticmethod
+    def get_etag(*values):
+        return hashlib.md5(repr(values).encode('utf-8')).hexdigest()
+    
+    @staticmethod
+    def is_not_modified(request, etag, last_modified):
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH', None)
+        if if_none_match is not None:
+            # If-None-Match takes precedence over If-Modified-Since
+            etags = parse_etags(if_none_match)
+            return etag in etags or '*' in etags
+        
+        if_modified_since = parse_http_date_safe(
+            request.META.get('HTTP_IF_MODIFIED_SINCE', '')
+        )
+        if if_modified_since is not None and last_modified is not None:
+            return int(last_modified.timestamp()) <= if_modified_since
+        return False
+    
+    def get_conditional_response(self, request, etag, last_modified,
+                                 get_response, cache_control=None):
+        """
+        Return 304 if the client has the current representation or
+        the response built by `get_response` otherwise, so the items
+        are only serialized when needed.
+        
+        """
+        if self.is_not_modified(request, etag, last_modified):
+            response = Response(status=status.HTTP_304_NOT_MODIFIED)
+        else:
+            response = get_response()
+        response['ETag'] = quote_etag(etag)
+        if last_modified is not None:
+            response['Last-Modified'] = http_date(last_modified.timestamp())
+        if cache_control is not None:
+            response['Cache-Control'] = cache_control
+        return response
+    
+    def get_page_etag(self, page, *values):
+        """ETag of a page defined by its items and the pagination."""
+        return self.get_etag(self.request.get_full_path(),
+                             self.paginator.get_count(),
+                             self.paginator.get_next_link(), page, *values)
 
 
 class AgentView(viewsets.ModelViewSet):
     queryset = Agent.objects.all()
     serializer_class = AgentSerializer
     permission_classes = (IsAdminUser,)
+    
+    @detail_route(methods=['get'], permission_classes=[IsAuthenticated])
+    def devices(self, request, pk=None):
+        """
+        Devices currently held by the agent, paginated by `cursor`
+        (the total count is only computed on demand).
+        
+        """
+        agent = self.get_object()
+        queryset = Device.objects.filter(state__holder=agent).order_by('pk')
+        
+        paginator = HeldDevicePagination()
+        devices = paginator.paginate_queryset(queryset, request, view=self)
+        Device.objects.prefetch_state(devices)
+        serializer = DeviceSerializer(devices, many=True,
+                                      context={'request': request})
+        return paginator.get_paginated_response(serializer.data)
 
 
-class DeviceView(viewsets.ModelViewSet):
-    queryset = Device.objects.all()
+class DeviceView(BulkMixin, ConditionalMixin, viewsets.ModelViewSet):
+    queryset = Device.objects.select_related('state')
     serializer_class = DeviceSerializer
     permission_classes= (IsAuthenticated,)
+    pagination_class = DevicePagination
     lookup_value_regex = (
         r'[^/.]+|'  # TODO pk regex?
         r'https?:!![^/]+|'  # sameAs
@@ -35,26 +168,176 @@ class DeviceView(viewsets.ModelViewSet):
     # FIXME current work around replace by '!'
     # URL regex http://stackoverflow.com/a/7995979/1538221
     
-    def get_object(self):
-        queryset = self.get_queryset()
-        queryset = self.filter_queryset(queryset)
-        lookup_value = self.kwargs[self.lookup_field]
+    def get_queryset(self):
+        queryset = super(DeviceView, self).get_queryset()
+        owner = self.request.query_params.get('owner', None)
+        if owner is not None and self.action == 'list':
+            # devices currently allocated to the user
+            queryset = queryset.filter(ownerships__owner__url=owner)
+        return queryset
+    
+    @list_route(methods=['get'])
+    def located(self, request):
+        """Devices whose latest location is inside the `polygon`."""
+        try:
+            polygon = parse_polygon(request.query_params.get('polygon', ''))
+        except ValueError as e:
+            raise exceptions.ValidationError({'polygon': [str(e)]})
+        queryset = filter_located_within(self.get_queryset(), polygon)
         
+        page = self.paginate_queryset(queryset)
+        Device.objects.prefetch_state(page)
+        serializer = self.get_serializer(page, many=True)
+        return self.get_paginated_response(serializer.data)
+    
+    @list_route(methods=['get'], permission_classes=[IsAdminUser],
+                url_path='cache-stats')
+    def cache_stats(self, request):
+        """Hits and misses of the cache of serialized devices."""
+        return Response(device_payloads.get_stats())
+    
+    def get_object(self):
+        # memoize the device: it's retrieved several times per request
+        if getattr(self, '_object', None) is None:
+            self._object = self.lookup_object()
+        return self._object
+    
+    def get_lookup_filter(self, lookup_value):
         # lookup by pk
         try:
             pk = int(lookup_value)
-            filter = {self.lookup_field: pk}
+            return {self.lookup_field: pk}
         except ValueError:
             try:
                 unquoted_value = parse.unquote_plus(lookup_value).replace('!', '/')
                 URLValidator(schemes=['http', 'https'])(unquoted_value)
-                filter = {'sameAs': unquoted_value}
+                return {'sameAs': unquoted_value}
             except ValidationError:
                 # TODO validate hid regex?
-                filter = {'hid': lookup_value}
-        
+                return {'hid': lookup_value}
+    
+    def lookup_object(self):
+        queryset = self.get_queryset()
+        queryset = self.filter_queryset(queryset)
+        lookup_value = self.kwargs[self.lookup_field]
+        filter = self.get_lookup_filter(lookup_value)
         return get_object_or_404(queryset, **filter)
     
+    @staticmethod
+    def get_version(device):
+        """
+        Version of the representation of the device: the version of its
+        state is increased every time an event affecting it is stored
+        (None while the state hasn't been projected).
+        
+        """
+        state = device.current_state
+        return state.version if state is not None else None
+    
+    def get_device_etag(self, device):
+        return self.get_etag(device.pk, device.hid, device.sameAs,
+                             device.type, self.get_version(device))
+    
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+        
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            # the state has been read along with the devices
+            etag = self.get_page_etag([(d.pk, d.hid, d.sameAs, d.type,
+                                        self.get_version(d)) for d in page])
+            
+            def get_response():
+                data = self.serialize_devices(page)
+                return self.get_paginated_response(data)
+            
+            return self.get_conditional_response(request, etag, None,
+                                                 get_response)
+        
+        devices = Device.objects.prefetch_state(list(queryset))
+        serializer = self.get_serializer(devices, many=True)
+        return Response(serializer.data)
+    
+    def get_as_of(self, request):
+        """Date of the `as_of` parameter (None if it isn't defined)."""
+        value = request.query_params.get('as_of', None)
+        if value is None:
+            return None
+        # an unescaped '+' of the UTC offset is decoded as a space
+        value = re.sub(r'(:\d{2}(\.\d+)?) (\d{2}(:?\d{2})?)$', r'\1+\3', value)
+        try:
+            date = parse_datetime(value)
+        except ValueError:
+            date = None
+        if date is None:
+            raise exceptions.ValidationError(
+                {'as_of': ['Expected a date like 2015-09-18T12:38:20Z.']}
+            )
+        if timezone.is_naive(date):
+            date = timezone.make_aware(date, timezone.get_current_timezone())
+        return date
+    
+    def retrieve(self, request, *args, **kwargs):
+        device = self.get_object()
+        as_of = self.get_as_of(request)
+        if as_of is not None:
+            return Response(self.serialize_as_of(device, as_of))
+        
+        def get_response():
+            return Response(self.serialize_devices([device])[0])
+        
+        return self.get_conditional_response(
+            request, self.get_device_etag(device), None, get_response
+        )
+    
+    def serialize_as_of(self, device, date):
+        """
+        Device with its components, owners, parent and holder after
+        the events stored until the date.
+        
+        """
+        fold = get_state_as_of(device, date)
+        pks = list(fold.component_ids)
+        if fold.parent_id is not None:
+            pks.append(fold.parent_id)
+        devices = Device.objects.in_bulk(pks)
+        owners = dict(AgentUser.objects.filter(
+            pk__in=fold.owner_ids).values_list('pk', 'url'))
+        
+        device._replayed_components = [devices[pk]
+                                       for pk in fold.component_ids]
+        device._replayed_owners = [owners[pk] for pk in fold.owner_ids]
+        device._replayed_parent = devices.get(fold.parent_id, None)
+        data = self.get_serializer(device).data
+        
+        data['parent'] = None
+        if fold.parent_id is not None:
+            data['parent'] = reverse('device-detail', args=[fold.parent_id],
+                                     request=self.request)
+        data['holder'] = None
+        if fold.holder_id is not None:
+            data['holder'] = reverse('agent-detail', args=[fold.holder_id],
+                                     request=self.request)
+        data['as_of'] = date
+        return data
+    
+    def serialize_devices(self, devices):
+        """Serialize the devices reusing the cached representations."""
+        scope = device_payloads.get_scope(self.request, self.format_kwarg)
+        # NOTE the version of the state has been read along with the
+        # devices so the stored payloads are never older than it.
+        payloads = device_payloads.get_many(devices, scope)
+        missing = [d for d in devices if d.pk not in payloads]
+        if missing:
+            Device.objects.prefetch_state(missing)
+            serializer = FastDeviceSerializer(request=self.request,
+                                              format=self.format_kwarg)
+            computed = dict(zip([d.pk for d in missing],
+                                serializer.serialize(missing)))
+            device_payloads.set_many(missing, computed, scope)
+            payloads.update(computed)
+        return [payloads[d.pk] for d in devices]
+    
     def get_success_event_creation_response(self, request, event):
         serializer = EventSerializer(event, context={'request': request})
         headers = self.get_success_headers(serializer.data)
@@ -88,10 +371,40 @@ class DeviceView(viewsets.ModelViewSet):
     def events(self, request, pk=None):
         device = self.get_object()
         queryset = Event.objects.related_to_device(device)
+        as_of = self.get_as_of(request)
+        if as_of is not None:
+            queryset = queryset.filter(grdDate__lte=as_of)
         serializer = EventSerializer(queryset, many=True,
                                      context={'request': request})
         return Response(serializer.data)
     
+    @detail_route(methods=['get'])
+    def tree(self, request, pk=None):
+        """Device with its components nested recursively."""
+        device = self.get_object()
+        rows = get_descendants(device.pk)
+        devices = Device.objects.in_bulk([row[0] for row in rows])
+        Device.objects.prefetch_state(list(devices.values()))
+        
+        nodes = {}
+        for device_id, parent_id, depth in rows:
+            node = self.get_serializer(devices[device_id]).data
+            node['components'] = []
+            if depth > 0:
+                nodes[parent_id]['components'].append(node)
+            nodes[device_id] = node
+        return Response(nodes[device.pk])
+    
+    @detail_route(methods=['get'])
+    def ancestors(self, request, pk=None):
+        """Parent of the device recursively (from parent to root)."""
+        device = self.get_object()
+        pks = [row[0] for row in get_ancestors(device.pk)[1:]]
+        devices = Device.objects.in_bulk(pks)
+        devices = Device.objects.prefetch_state([devices[pk] for pk in pks])
+        serializer = self.get_serializer(devices, many=True)
+        return Response(serializer.data)
+    
     @detail_route(methods=['get'])
     def metrics(self, request, pk=None):
         device = self.get_object()
@@ -109,6 +422,15 @@ class DeviceView(viewsets.ModelViewSet):
         
         return self.get_success_event_creation_response(request, event)
     
+    @list_route(methods=['post'], permission_classes=[IsAuthenticated],
+                url_path='register/bulk')
+    def register_bulk(self, request):
+        items = self.get_bulk_items(request)
+        bulk = BulkRegister(agent=request.user.agent,
+                            context={'request': request})
+        events = bulk.save(items)
+        return self.get_bulk_response(request, events, bulk.errors)
+    
     @detail_route(methods=['post'], permission_classes=[IsAuthenticated])
     def add(self, request, pk=None):
         return self.post_event(request, Event.ADD, AddSerializer)
@@ -152,7 +474,234 @@ class DeviceView(viewsets.ModelViewSet):
         return self.post_event(request, Event.STOPUSAGE)
 
 
-class EventView(viewsets.ReadOnlyModelViewSet):
+class EventView(BulkMixin, ConditionalMixin, viewsets.ReadOnlyModelViewSet):
     queryset = Event.objects.all()
     serializer_class = EventSerializer
     permission_classes= (IsAuthenticated,)
+    pagination_class = EventPagination
+    
+    def get_queryset(self):
+        queryset = super(EventView, self).get_queryset()
+        params = self.request.query_params
+        try:
+            if 'within' in params:
+                # lon,lat,radius (meters)
+                lon, lat, radius = parse_floats(params['within'], 3)
+                queryset = filter_within(queryset, lon, lat, radius)
+            if 'bbox' in params:
+                # min_lon,min_lat,max_lon,max_lat
+                queryset = filter_bbox(queryset,
+                                       *parse_floats(params['bbox'], 4))
+        except ValueError as e:
+            raise exceptions.ValidationError({'location': [str(e)]})
+        return queryset
+    
+    # Events are immutable once registered
+    event_cache_control = 'private, max-age=31536000'
+    
+    def list(self, request, *args, **kwargs):
+        # the events are serialized from rows (see grd.fastpath)
+        serializer = FastEventSerializer(request=request,
+                                         format=self.format_kwarg)
+        queryset = self.filter_queryset(self.get_queryset())
+        queryset = serializer.get_rows(queryset)
+        
+        page = self.paginate_queryset(queryset)
+        if page is None:
+            return Response(serializer.serialize(list(queryset)))
+        
+        last_modified = max([e['grdDate'] for e in page]) if page else None
+        etag = self.get_page_etag([e['id'] for e in page])
+        
+        def get_response():
+            return self.get_paginated_response(serializer.serialize(page))
+        
+        return self.get_conditional_response(request, etag, last_modified,
+                                             get_response)
+    
+    def retrieve(self, request, *args, **kwargs):
+        event = self.get_object()
+        
+        def get_response():
+            serializer = self.get_serializer(event)
+            return Response(serializer.data)
+        
+        return self.get_conditional_response(
+            request, self.get_etag(event.pk, event.grdDate), event.grdDate,
+            get_response, cache_control=self.event_cache_control
+        )
+    
+    @list_route(methods=['post'])
+    def bulk(self, request):
+        items = self.get_bulk_items(request)
+        bulk = BulkEvents(agent=request.user.agent,
+                          context={'request': request})
+        events = bulk.save(items)
+        return self.get_bulk_response(request, events, bulk.errors)
+    
+    # Each map tile of the zoom level is split into grid_cells x grid_cells
+    grid_cells = 8
+    max_zoom = 20
+    # Deeper zoom levels require a `bbox` and the number of cells of the
+    # response is limited (otherwise there would be a cell per event).
+    max_zoom_without_bbox = 4
+    max_cells = 10000
+    
+    @list_route(methods=['get'], url_path='geo-aggregate')
+    def geo_aggregate(self, request):
+        """
+        Number of located events per cell of a grid whose size depends
+        on the `zoom` level of the map, optionally filtered by `type`
+        (comma separated) and by location (e.g. `bbox`, required for
+        zoom levels deeper than max_zoom_without_bbox).
+        
+        """
+        try:
+            zoom = int(request.query_params.get('zoom', 0))
+        except ValueError:
+            zoom = -1
+        if not 0 <= zoom <= self.max_zoom:
+            raise exceptions.ValidationError(
+                {'zoom': ['Expected an integer between 0 and %d.' %
+                          self.max_zoom]}
+            )
+        if zoom > self.max_zoom_without_bbox and \
+           'bbox' not in request.query_params:
+            raise exceptions.ValidationError(
+                {'bbox': ['Required for zoom levels deeper than %d.' %
+                          self.max_zoom_without_bbox]}
+            )
+        
+        queryset = self.get_queryset()
+        types = request.query_params.get('type', None)
+        if types is not None:
+            types = types.split(',')
+            valid_types = [t for t, _ in Event.TYPES]
+            invalid_types = [t for t in types if t not in valid_types]
+            if invalid_types:
+                raise exceptions.ValidationError(
+                    {'type': ["Invalid event type '%s'." % invalid_types[0]]}
+                )
+            queryset = queryset.filter(type__in=types)
+        
+        cell_size = 360.0 / 2 ** zoom / self.grid_cells
+        cells = aggregate_grid(queryset, cell_size, limit=self.max_cells + 1)
+        if len(cells) > self.max_cells:
+            raise exceptions.ValidationError(
+                {'bbox': ['Too many cells (max %d), reduce the bbox or the '
+                          'zoom level.' % self.max_cells]}
+            )
+        return Response(OrderedDict([
+            ('zoom', zoom),
+            ('cell_size', cell_size),
+            ('results', cells),
+        ]))
+    
+    feed_limit = 1000
+    feed_max_limit = 10000
+    
+    def get_feed_limit(self, request):
+        try:
+            limit = int(request.query_params.get('limit', self.feed_limit))
+        except ValueError:
+            raise exceptions.ValidationError({'limit': ['Invalid limit.']})
+        return max(1, min(limit, self.feed_max_limit))
+    
+    def get_since_position(self, request):
+        since = request.query_params.get('since') or None
+        if since is None:
+            return None
+        try:
+            return decode_cursor(since)
+        except ValueError as e:
+            raise exceptions.ValidationError({'since': [str(e)]})
+    
+    @list_route(methods=['get'])
+    def feed(self, request):
+        """
+        Stream the events stored after the `since` watermark (the
+        `next` token returned by the previous request) in order.
+        
+        """
+        since = request.query_params.get('since') or None
+        position = self.get_since_position(request)
+        
+        # NOTE events being stored aren't included (see FEED_LAG)
+        queryset = filter_committed(self.get_queryset()).select_related(
+            'location', 'owner').prefetch_related('components')
+        ordering = FEED_ORDERING
+        try:
+            events = iterate_after(queryset, ordering, position)
+            events = itertools.islice(events, self.get_feed_limit(request))
+            first = list(itertools.islice(events, 1))
+        except (ValueError, ValidationError) as e:
+            raise exceptions.ValidationError({'since': [str(e)]})
+        
+        content = self.stream_feed(request, itertools.chain(first, events),
+                                   since)
+        return StreamingHttpResponse(content, content_type='application/json')
+    
+    def stream_feed(self, request, events, since):
+        renderer = JSONRenderer()
+        context = {'request': request}
+        ordering = FEED_ORDERING
+        
+        yield b'{"results": ['
+        last_event = None
+        for event in events:
+            if last_event is not None:
+                yield b','
+            yield renderer.render(EventSerializer(event, context=context).data)
+            last_event = event
+        
+        if last_event is not None:
+            since = encode_cursor(get_position(last_event, ordering))
+        yield ('], "next": %s}' % json.dumps(since)).encode('utf-8')
+    
+    @list_route(methods=['get'], renderer_classes=[NDJSONRenderer])
+    def export(self, request):
+        """
+        Stream the whole event log as newline delimited JSON, e.g.
+        /api/events/export.ndjson, optionally resuming after the
+        `since` position (the cursor of the latest exported event).
+        
+        """
+        position = self.get_since_position(request)
+        queryset = filter_committed(self.get_queryset())
+        exporter = EventExporter(request=request)
+        lines = exporter.lines(queryset, position)
+        try:
+            first = list(itertools.islice(lines, 1))
+        except (ValueError, ValidationError) as e:
+            raise exceptions.ValidationError({'since': [str(e)]})
+        return StreamingHttpResponse(itertools.chain(first, lines),
+                                     content_type=NDJSONRenderer.media_type)
+
+
+class MetricsView(viewsets.ViewSet):
+    permission_classes = (IsAuthenticated,)
+    
+    @list_route(methods=['get'])
+    def fleet(self, request):
+        """
+        Running time (seconds) and durability (years) of all the devices
+        optionally grouped by `group_by` (comma separated list of
+        'type', 'agent' which holds them and 'year' of production).
+        
+        """
+        group_by = request.query_params.get('group_by', '')
+        group_by = [name for name in group_by.split(',') if name]
+        try:
+            results = fleet_metrics(group_by)
+        except ValueError as e:
+            raise exceptions.ValidationError({'group_by': [str(e)]})
+        if 'agent' in group_by:
+            for result in results:
+                if result['agent'] is not None:
+                    result['agent'] = reverse('agent-detail',
+                                              args=[result['agent']],
+                                              request=request)
+        return Response(OrderedDict([
+            ('group_by', group_by),
+            ('results', results),
+        ]))